@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+
+# Measures the steady-state cost of kvm consoles to answer how many consoles fit on one host: starts Java and HTML5
+# consoles against a local stand-in BMC and samples the CPU time, RSS, PSS and network traffic of every container in an
+# idle phase and in an active phase. In the active phase, a scripted RFB client per Java console clicks on the desktop
+# (which opens and closes the window manager menu) and requests framebuffer updates like noVNC, and a scripted HTTP
+# client per HTML5 console requests the console page through the proxy. The result is a cost table per Docker image,
+# for example with `python3 -m benchmarks.density --java 4 --html5 4`.
+#
+# The benchmark needs Docker and the images of the configured `java_version` (see `make build`); the BMC is reached by
+# the containers with the gateway address of the default Docker bridge network. With `--fake-docker`, it runs offline
+# against the fake `docker` command of the other benchmarks, which only checks the benchmark itself.
+
+import argparse
+import asyncio
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.request
+
+try:
+    from typing import Any, Dict, List, Text, Tuple  # noqa: F401  # pylint: disable=unused-import
+except ImportError:
+    pass
+
+from nojava_ipmi_kvm.config import config, JavaHostConfig
+from nojava_ipmi_kvm.images import get_docker_image
+from nojava_ipmi_kvm.kvm import KvmViewer, aclose_all_kvm_viewers, add_sudo_if_configured, start_kvm_container
+from .fake_bmc import FakeBmcServer
+from .launch_latency import setup_fake_docker
+from .rfb_client import RfbClient, RfbError
+
+CONFIG_TEMPLATE = """
+general:
+  share_java_containers: {share_java_containers}
+  max_shared_sessions: {max_shared_sessions}
+templates:
+  fake-java:
+    login_endpoint: cgi/login.cgi
+    download_endpoint: cgi/url_redirect.cgi?url_name=ikvm&url_type=jwsk
+    java_version: {java_version}
+    allow_insecure_ssl: true
+  fake-html5:
+    login_endpoint: cgi/login.cgi
+    html5_endpoint: cgi/url_redirect.cgi?url_name=man_ikvm_html5_bootstrap
+    allow_insecure_ssl: true
+hosts:
+  density-java:
+    based_on: fake-java
+    full_hostname: {bmc_hostname}
+  density-html5:
+    based_on: fake-html5
+    full_hostname: {bmc_hostname}
+"""
+
+# Prints the memory of all processes of a container (`SAMPLE_PIDS` for the fake docker), the CPU time of its cgroup and
+# the traffic of its network interfaces
+SAMPLE_SCRIPT = r"""
+if [ -n "${SAMPLE_PIDS}" ]; then
+    pids="${SAMPLE_PIDS}"
+else
+    pids="$(cd /proc && echo [0-9]*)"
+fi
+for pid in ${pids}; do cat "/proc/${pid}/smaps_rollup" 2>/dev/null; done | \
+    awk '$1 == "Rss:" { rss += $2 } $1 == "Pss:" { pss += $2 } END { printf "memory %d %d\n", rss * 1024, pss * 1024 }'
+if [ -n "${SAMPLE_PIDS}" ]; then
+    for pid in ${pids}; do cat "/proc/${pid}/stat" 2>/dev/null; done | \
+        awk -v ticks="$(getconf CLK_TCK)" \
+            '{ sub(/^.*\) /, ""); cpu += $12 + $13 } END { printf "cpu %.3f\n", cpu / ticks }'
+elif [ -f /sys/fs/cgroup/cpu.stat ]; then
+    awk '$1 == "usage_usec" { printf "cpu %.3f\n", $2 / 1000000 }' /sys/fs/cgroup/cpu.stat
+else
+    awk '{ printf "cpu %.3f\n", $1 / 1000000000 }' /sys/fs/cgroup/cpuacct/cpuacct.usage
+fi
+awk 'NR > 2 { sub(/^ */, ""); split($0, f, /[: ]+/); if (f[1] != "lo") { rx += f[2]; tx += f[10] } }
+     END { printf "network %d %d\n", rx, tx }' /proc/net/dev
+"""
+
+
+def get_argumentparser():
+    # type: () -> argparse.ArgumentParser
+    parser = argparse.ArgumentParser(description="Benchmark the steady-state cost of idle and active kvm consoles.")
+    parser.add_argument("--java", type=int, default=2, help="number of Java consoles (default: %(default)s)")
+    parser.add_argument("--html5", type=int, default=2, help="number of HTML5 consoles (default: %(default)s)")
+    parser.add_argument(
+        "--java-version", default="8u242", help="`java_version` of the Java consoles (default: %(default)s)"
+    )
+    parser.add_argument("--shared", action="store_true", help="run Java consoles in shared containers")
+    parser.add_argument(
+        "--phase-duration", type=float, default=30.0, help="duration of each phase in seconds (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--sample-interval", type=float, default=5.0, help="seconds between two samples (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=10.0,
+        help="requests per second of every scripted viewer in the active phase (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--bmc-address",
+        help="address of this host which is reachable from containers (default: gateway of the Docker bridge network)",
+    )
+    parser.add_argument(
+        "--fake-docker", action="store_true", help="use the fake `docker` command (only checks the benchmark)"
+    )
+    return parser
+
+
+def get_docker_bridge_gateway():
+    # type: () -> Text
+    return (
+        subprocess.check_output(
+            add_sudo_if_configured(
+                ["docker", "network", "inspect", "bridge", "--format", "{{(index .IPAM.Config 0).Gateway}}"]
+            )
+        )
+        .decode("utf-8")
+        .strip()
+    )
+
+
+def create_certificate(temp_dir, common_name):
+    # type: (Text, Text) -> Tuple[Text, Text]
+    # The BMC is accessed with HTTPS from the containers
+    certfile = os.path.join(temp_dir, "bmc.pem")
+    keyfile = os.path.join(temp_dir, "bmc.key")
+    subprocess.check_call(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            "/CN={}".format(common_name),
+        ]
+        + ["-keyout", keyfile, "-out", certfile],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return certfile, keyfile
+
+
+async def sample_container(container_name):
+    # type: (Text) -> Dict[Text, float]
+    process = await asyncio.create_subprocess_exec(
+        *add_sudo_if_configured(["docker", "exec", container_name, "sh", "-c", SAMPLE_SCRIPT]),
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+    output, _ = await process.communicate()
+    sample = {"time": time.monotonic()}  # type: Dict[Text, float]
+    for line in output.decode("utf-8").splitlines():
+        fields = line.split()
+        if fields[0] == "memory":
+            sample["rss"], sample["pss"] = float(fields[1]), float(fields[2])
+        elif fields[0] == "cpu":
+            sample["cpu"] = float(fields[1])
+        elif fields[0] == "network":
+            sample["rx"], sample["tx"] = float(fields[1]), float(fields[2])
+    return sample
+
+
+async def sample_phase(container_names, duration, interval):
+    # type: (List[Text], float, float) -> Dict[Text, List[Dict[Text, float]]]
+    samples = {container_name: [] for container_name in container_names}  # type: Dict[Text, List[Dict[Text, float]]]
+    end_time = time.monotonic() + duration
+    while True:
+        for container_name, sample in zip(
+            container_names, await asyncio.gather(*(sample_container(name) for name in container_names))
+        ):
+            samples[container_name].append(sample)
+        if time.monotonic() + interval > end_time:
+            break
+        await asyncio.sleep(interval)
+    return samples
+
+
+def drive_java_console(kvm_viewer, rate, stop_event, errors):
+    # type: (Any, float, threading.Event, List[Text]) -> None
+    rfb_client = RfbClient(kvm_viewer.external_vnc_dns, kvm_viewer.web_port, kvm_viewer.vnc_password)
+    try:
+        rfb_client.connect()
+        rfb_client.request_update(incremental=False)
+        rfb_client.read_update()
+        step = 0
+        while not stop_event.wait(1.0 / rate):
+            # Every second click is a right click, which opens the root menu of fluxbox; the next left click closes it
+            x, y = (rfb_client.width // 4 + step * 37) % rfb_client.width, rfb_client.height // 2
+            button_mask = 4 if step % 2 == 0 else 1
+            rfb_client.pointer_event(x, y, button_mask)
+            rfb_client.pointer_event(x, y, 0)
+            rfb_client.request_update()
+            rfb_client.read_update()
+            step += 1
+    except (OSError, RfbError) as e:
+        errors.append("{}: {}".format(kvm_viewer.container_name, e))
+    finally:
+        rfb_client.close()
+
+
+def drive_html5_console(kvm_viewer, rate, stop_event, errors):
+    # type: (Any, float, threading.Event, List[Text]) -> None
+    try:
+        while not stop_event.wait(1.0 / rate):
+            urllib.request.urlopen(kvm_viewer.url, timeout=10).read()
+    except OSError as e:
+        errors.append("{}: {}".format(kvm_viewer.container_name, e))
+
+
+def summarize(samples):
+    # type: (List[Dict[Text, float]]) -> Dict[Text, float]
+    # Rates between the first and the last sample and mean memory usage of one container
+    first_sample, last_sample = samples[0], samples[-1]
+    duration = max(last_sample["time"] - first_sample["time"], 1e-9)
+    return {
+        "cpu": 100.0 * (last_sample.get("cpu", 0.0) - first_sample.get("cpu", 0.0)) / duration,
+        "rss": sum(sample.get("rss", 0.0) for sample in samples) / len(samples),
+        "pss": sum(sample.get("pss", 0.0) for sample in samples) / len(samples),
+        "rx": (last_sample.get("rx", 0.0) - first_sample.get("rx", 0.0)) / duration,
+        "tx": (last_sample.get("tx", 0.0) - first_sample.get("tx", 0.0)) / duration,
+    }
+
+
+def print_report(phase_samples, kvm_viewers):
+    # type: (List[Tuple[Text, Dict[Text, List[Dict[Text, float]]]]], List[Tuple[Text, KvmViewer]]) -> None
+    consoles_per_container = {}  # type: Dict[Text, int]
+    image_of_container = {}  # type: Dict[Text, Text]
+    for image, kvm_viewer in kvm_viewers:
+        consoles_per_container[kvm_viewer.container_name] = consoles_per_container.get(kvm_viewer.container_name, 0) + 1
+        image_of_container[kvm_viewer.container_name] = image
+    print(
+        "\n{:<52} {:<7} {:>8} {:>10} {:>12} {:>12} {:>10} {:>10}".format(
+            "image", "phase", "consoles", "CPU [%]", "RSS [MiB]", "PSS [MiB]", "rx [KiB/s]", "tx [KiB/s]"
+        )
+    )
+    for image in sorted(set(image_of_container.values())):
+        container_names = [name for name, container_image in image_of_container.items() if container_image == image]
+        console_count = sum(consoles_per_container[name] for name in container_names)
+        for phase, samples in phase_samples:
+            totals = {"cpu": 0.0, "rss": 0.0, "pss": 0.0, "rx": 0.0, "tx": 0.0}
+            for container_name in container_names:
+                for key, value in summarize(samples[container_name]).items():
+                    totals[key] += value
+            # Costs per console (shared containers host several consoles)
+            print(
+                "{:<52} {:<7} {:>8} {:>10.2f} {:>12.1f} {:>12.1f} {:>10.2f} {:>10.2f}".format(
+                    image,
+                    phase,
+                    console_count,
+                    totals["cpu"] / console_count,
+                    totals["rss"] / console_count / 2**20,
+                    totals["pss"] / console_count / 2**20,
+                    totals["rx"] / console_count / 2**10,
+                    totals["tx"] / console_count / 2**10,
+                )
+            )
+
+
+async def run_benchmark(args):
+    # type: (argparse.Namespace) -> None
+    hostnames = ["density-java"] * args.java + ["density-html5"] * args.html5
+    launched_kvm_viewers = await asyncio.gather(
+        *(start_kvm_container(config[hostname], "password") for hostname in hostnames)
+    )
+    kvm_viewers = [
+        (get_docker_image(config[hostname]), kvm_viewer)
+        for hostname, kvm_viewer in zip(hostnames, launched_kvm_viewers)
+    ]
+    container_names = sorted(set(kvm_viewer.container_name for _, kvm_viewer in kvm_viewers))
+    try:
+        phase_samples = [("idle", await sample_phase(container_names, args.phase_duration, args.sample_interval))]
+        stop_event = threading.Event()
+        errors = []  # type: List[Text]
+        threads = [
+            threading.Thread(
+                target=drive_java_console if isinstance(config[hostname], JavaHostConfig) else drive_html5_console,
+                args=(kvm_viewer, args.rate, stop_event, errors),
+                daemon=True,
+            )
+            for hostname, (_, kvm_viewer) in zip(hostnames, kvm_viewers)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            phase_samples.append(
+                ("active", await sample_phase(container_names, args.phase_duration, args.sample_interval))
+            )
+        finally:
+            stop_event.set()
+            for thread in threads:
+                thread.join()
+        for error in errors:
+            print("Scripted viewer failed: {}".format(error))
+        print_report(phase_samples, kvm_viewers)
+    finally:
+        await aclose_all_kvm_viewers()
+
+
+def main():
+    # type: () -> None
+    args = get_argumentparser().parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    temp_dir = tempfile.mkdtemp(prefix="nojava-ipmi-kvm-benchmark-")
+    bmc_server = None
+    try:
+        if args.fake_docker:
+            args.boot_time, args.docker_latency = 0.5, 0.0
+            setup_fake_docker(temp_dir, args)
+            bmc_server = FakeBmcServer()
+            bmc_hostname = bmc_server.hostname
+        else:
+            bmc_address = args.bmc_address or get_docker_bridge_gateway()
+            certfile, keyfile = create_certificate(temp_dir, bmc_address)
+            bmc_server = FakeBmcServer(host="0.0.0.0", certfile=certfile, keyfile=keyfile)
+            bmc_hostname = "{}:{}".format(bmc_address, bmc_server.server_address[1])
+        bmc_server.start()
+        config_filepath = os.path.join(temp_dir, "nojava-ipmi-kvmrc.yaml")
+        with open(config_filepath, "w") as f:
+            f.write(
+                CONFIG_TEMPLATE.format(
+                    bmc_hostname=bmc_hostname,
+                    java_version=args.java_version,
+                    share_java_containers=str(args.shared).lower(),
+                    max_shared_sessions=max(1, args.java),
+                )
+            )
+        config.read_config(config_filepath)
+        asyncio.get_event_loop().run_until_complete(run_benchmark(args))
+    finally:
+        if bmc_server is not None:
+            bmc_server.stop()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
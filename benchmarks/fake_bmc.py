@@ -0,0 +1,143 @@
+import http.server
+import socket
+import socketserver
+import ssl
+import threading
+import time
+import uuid
+
+try:
+    from typing import Any, Optional, Text, Tuple  # noqa: F401  # pylint: disable=unused-import
+except ImportError:
+    pass
+
+SESSION_COOKIE_KEY = "SID"
+
+JNLP_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<jnlp spec="1.0+" codebase="{base_url}">
+  <information>
+    <title>Fake BMC kvm viewer</title>
+    <vendor>nojava-ipmi-kvm benchmarks</vendor>
+  </information>
+  <resources>
+    <j2se version="1.6+"/>
+    <jar href="iKVM.jar" main="true"/>
+  </resources>
+  <application-desc main-class="tw.com.aten.ikvm.KVMMain"/>
+</jnlp>
+"""
+
+HTML5_PAGE = """<!DOCTYPE html>
+<html><head><title>Fake BMC HTML5 kvm viewer</title></head><body><canvas id="kvm"></canvas></body></html>
+"""
+
+
+class FakeBmcRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are sent separately, which stalls keep-alive connections on delayed ACKs with Nagle's algorithm
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        # type: (Text, *Any) -> None
+        pass
+
+    def _send(self, status, body=b"", content_type="text/html", extra_headers=None):
+        # type: (int, bytes, Text, Optional[Tuple[Tuple[Text, Text], ...]]) -> None
+        time.sleep(self.server.latency)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in extra_headers or ():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _has_session(self):
+        # type: () -> bool
+        cookies = self.headers.get("Cookie", "")
+        return any(
+            cookie.strip() == "{}={}".format(SESSION_COOKIE_KEY, session_id)
+            for cookie in cookies.split(";")
+            for session_id in self.server.session_ids
+        )
+
+    def do_HEAD(self):
+        # type: () -> None
+        self.do_GET()
+
+    def do_GET(self):
+        # type: () -> None
+        if self.path == "/":
+            self._send(200, b"<html><body>Fake BMC</body></html>")
+        elif self.path.startswith("/cgi/url_redirect.cgi?url_name=ikvm"):
+            if not self._has_session():
+                self._send(403)
+                return
+            scheme = "https" if self.server.is_https else "http"
+            base_url = "{}://{}:{}".format(scheme, *self.server.server_address[:2])
+            self._send(200, JNLP_TEMPLATE.format(base_url=base_url).encode("utf-8"), "application/x-java-jnlp-file")
+        elif self.path.startswith("/cgi/url_redirect.cgi?url_name=man_ikvm_html5_bootstrap"):
+            if not self._has_session():
+                self._send(403)
+                return
+            self._send(200, HTML5_PAGE.encode("utf-8"))
+        else:
+            self._send(404)
+
+    def do_POST(self):
+        # type: () -> None
+        content_length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(content_length)
+        if self.path == "/cgi/login.cgi":
+            session_id = uuid.uuid4().hex
+            self.server.session_ids.add(session_id)
+            self._send(
+                200,
+                b"<html><body>ok</body></html>",
+                extra_headers=(("Set-Cookie", "{}={}; path=/".format(SESSION_COOKIE_KEY, session_id)),),
+            )
+        else:
+            self._send(404)
+
+
+# Stand-in for the web interface of a BMC (login, JNLP download and HTML5 console endpoints). Every response is delayed
+# by `latency` seconds. If `certfile` is given, the server speaks HTTPS in addition to plain HTTP on the same port (like a
+# BMC, which is checked for reachability with HTTP but accessed with HTTPS).
+class FakeBmcServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, certfile=None, keyfile=None):
+        # type: (Text, int, float, Optional[Text], Optional[Text]) -> None
+        super().__init__((host, port), FakeBmcRequestHandler)
+        self.latency = latency
+        self.session_ids = set()  # type: set
+        self.is_https = certfile is not None
+        self._ssl_context = None  # type: Optional[ssl.SSLContext]
+        if certfile is not None:
+            self._ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self._ssl_context.load_cert_chain(certfile, keyfile)
+        self._thread = None  # type: Optional[threading.Thread]
+
+    def get_request(self):
+        # type: () -> Tuple[socket.socket, Any]
+        request, client_address = super().get_request()
+        # TLS connections start with a handshake record (content type 22)
+        if self._ssl_context is not None and request.recv(1, socket.MSG_PEEK) == b"\x16":
+            request = self._ssl_context.wrap_socket(request, server_side=True)
+        return request, client_address
+
+    @property
+    def hostname(self):
+        # type: () -> Text
+        return "{}:{}".format(*self.server_address[:2])
+
+    def start(self):
+        # type: () -> None
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        # type: () -> None
+        self.shutdown()
+        self.server_close()
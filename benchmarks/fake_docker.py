@@ -0,0 +1,587 @@
+#!/usr/bin/env python3
+
+# Stand-in for the `docker` command line client. Containers are simulated by local processes which wait a configurable
+# boot time, log in to the (fake) BMC given in `KVM_HOSTNAME` and then serve HTTP on a free local port like the noVNC or
+# HTML5 proxy web server of a real container.
+#
+# Environment variables:
+#   FAKE_DOCKER_STATE          directory for the container state (required)
+#   FAKE_DOCKER_CLI_LATENCY    seconds every client call takes additionally (default: 0.05)
+#   FAKE_DOCKER_BOOT_TIME      seconds a container needs to boot (default: 1.0)
+#   FAKE_DOCKER_SESSION_TIME   seconds a session of a shared container needs to start (default: 0.3)
+
+import contextlib
+import fcntl
+import hashlib
+import http.server
+import json
+import os
+import re
+import signal
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import time
+import urllib.request
+import uuid
+import zlib
+
+try:
+    from typing import Any, Dict, Iterator, List, Optional, Text  # noqa: F401  # pylint: disable=unused-import
+except ImportError:
+    pass
+
+from .rfb_client import encode_websocket_frame, get_websocket_accept_key, read_websocket_frame
+
+STATE_DIR = os.environ.get("FAKE_DOCKER_STATE", "")
+CLI_LATENCY = float(os.environ.get("FAKE_DOCKER_CLI_LATENCY", "0.05"))
+BOOT_TIME = float(os.environ.get("FAKE_DOCKER_BOOT_TIME", "1.0"))
+SESSION_TIME = float(os.environ.get("FAKE_DOCKER_SESSION_TIME", "0.3"))
+FRAMEBUFFER_SIZE = (64, 48)
+
+
+class ContainerRequestHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        # type: (Text, *Any) -> None
+        pass
+
+    def do_HEAD(self):
+        # type: () -> None
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        # type: () -> None
+        if self.headers.get("Upgrade", "").lower() == "websocket":
+            self.serve_rfb()
+            return
+        body = b"<html><body>Fake kvm console</body></html>"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def serve_rfb(self):
+        # type: () -> None
+        # Websocket (like websockify) with an RFB server without authentication which answers every framebuffer
+        # update request with a changed screen
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header(
+            "Sec-WebSocket-Accept", get_websocket_accept_key(self.headers["Sec-WebSocket-Key"].encode("ascii")).decode()
+        )
+        self.send_header("Sec-WebSocket-Protocol", "binary")
+        self.end_headers()
+        buffer = bytearray()
+
+        def read(length):
+            # type: (int) -> bytes
+            while len(buffer) < length:
+                opcode, payload = read_websocket_frame(self.rfile.read)
+                if opcode == 0x8:
+                    raise EOFError()
+                buffer.extend(payload)
+            data = bytes(buffer[:length])
+            del buffer[:length]
+            return data
+
+        def send(data):
+            # type: (bytes) -> None
+            self.wfile.write(encode_websocket_frame(data, mask=False))
+            self.wfile.flush()
+
+        send(b"RFB 003.008\n")
+        read(12)
+        send(b"\x01\x01")
+        read(1)
+        send(b"\x00\x00\x00\x00")
+        read(1)
+        name = b"fake"
+        send(struct.pack(">HH16sI", FRAMEBUFFER_SIZE[0], FRAMEBUFFER_SIZE[1], b"\x20\x18\x00\x01", len(name)) + name)
+        # Lengths of the client messages after the message type (fixed lengths only)
+        message_lengths = {0: 19, 3: 9, 4: 7, 5: 5}
+        try:
+            while True:
+                (message_type,) = struct.unpack(">B", read(1))
+                if message_type == 2:
+                    _, encoding_count = struct.unpack(">BH", read(3))
+                    read(4 * encoding_count)
+                elif message_type == 6:
+                    _, length = struct.unpack(">3sI", read(7))
+                    read(length)
+                else:
+                    read(message_lengths[message_type])
+                if message_type == 3:
+                    data = zlib.compress(os.urandom(256))
+                    send(
+                        struct.pack(">BBH", 0, 0, 1)
+                        + struct.pack(">HHHHi", 0, 0, FRAMEBUFFER_SIZE[0], FRAMEBUFFER_SIZE[1], 16)
+                        + struct.pack(">I", len(data))
+                        + data
+                    )
+        except (EOFError, KeyError, ValueError, OSError, struct.error):
+            pass
+
+
+class ContainerServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # Websocket connections stay open, so every connection gets its own thread
+    daemon_threads = True
+
+
+def state_filepath(name):
+    # type: (Text) -> Text
+    return os.path.join(STATE_DIR, "{}.json".format(name))
+
+
+def read_state(name):
+    # type: (Text) -> Optional[Dict[Text, Any]]
+    try:
+        with open(state_filepath(name), "r") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+@contextlib.contextmanager
+def locked_state(name):
+    # type: (Text) -> Iterator[None]
+    # Serializes concurrent read-modify-write cycles of `docker exec` calls (for example parallel session removals)
+    with open(state_filepath(name) + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def write_state(name, state):
+    # type: (Text, Dict[Text, Any]) -> None
+    temp_filepath = state_filepath(name) + ".{}.tmp".format(os.getpid())
+    with open(temp_filepath, "w") as f:
+        json.dump(state, f)
+    os.rename(temp_filepath, state_filepath(name))
+
+
+def events_filepath():
+    # type: () -> Text
+    return os.path.join(STATE_DIR, "events.jsonl")
+
+
+def log_die_event(name, exit_code, labels):
+    # type: (Text, int, Dict[Text, Text]) -> None
+    # Appended with a single write, so concurrent writers do not interleave
+    event = {"time": time.time(), "name": name, "exitCode": exit_code, "labels": labels}
+    with open(events_filepath(), "a") as f:
+        f.write(json.dumps(event) + "\n")
+
+
+def is_process_alive(pid):
+    # type: (int) -> bool
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def is_running(name):
+    # type: (Text) -> bool
+    state = read_state(name)
+    return state is not None and is_process_alive(state["pid"])
+
+
+def find_free_port():
+    # type: () -> int
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def login(kvm_hostname):
+    # type: (Text) -> None
+    request = urllib.request.Request("http://{}/cgi/login.cgi".format(kvm_hostname), data=b"name=ADMIN&pwd=x")
+    urllib.request.urlopen(request).read()
+
+
+def serve(name, port, boot_time, kvm_hostname, timings_filepath):
+    # type: (Text, int, float, Optional[Text], Text) -> None
+    signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(0))
+    timings = []
+    start_time = time.time()
+    time.sleep(boot_time)
+    timings.append(("boot", time.time() - start_time))
+    if kvm_hostname:
+        start_time = time.time()
+        try:
+            login(kvm_hostname)
+        except IOError:
+            # Sessions of shared containers end without stopping their container
+            state = read_state(name)
+            if state is not None and state["pid"] == os.getpid():
+                log_die_event(name, 3, state["labels"])
+            sys.exit(3)
+        timings.append(("login", time.time() - start_time))
+    with open(timings_filepath, "w") as f:
+        f.writelines("{} {:.3f}\n".format(phase, duration) for phase, duration in timings)
+    server = ContainerServer(("127.0.0.1", port), ContainerRequestHandler)
+    server.serve_forever()
+
+
+def parse_run_args(args):
+    # type: (List[Text]) -> Dict[Text, Any]
+    options = {
+        "detach": False,
+        "interactive": False,
+        "name": None,
+        "env": {},
+        "labels": {},
+        "host_port": None,
+    }  # type: Dict
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == "-d":
+            options["detach"] = True
+        elif arg == "-i":
+            options["interactive"] = True
+        elif arg == "--name":
+            options["name"] = args[i + 1]
+            i += 1
+        elif arg == "-e":
+            key, value = args[i + 1].split("=", 1)
+            options["env"][key] = value
+            i += 1
+        elif arg == "--label":
+            key, _, value = args[i + 1].partition("=")
+            options["labels"][key] = value
+            i += 1
+        elif arg == "-p":
+            options["host_port"] = int(args[i + 1].split(":")[0])
+            i += 1
+        elif arg.startswith("-") and "=" not in arg and arg not in ("-P", "--rm", "--read-only"):
+            # Options with a value which are not simulated (for example `-v` or `--expose`)
+            i += 1
+        elif not arg.startswith("-"):
+            options["image"] = arg
+            options["args"] = args[i + 1 :]
+            break
+        i += 1
+    if options["name"] is None:
+        options["name"] = uuid.uuid4().hex[:12]
+    return options
+
+
+def command_run(args):
+    # type: (List[Text]) -> int
+    options = parse_run_args(args)
+    name = options["name"]
+    if is_running(name):
+        sys.stderr.write('Conflict. The container name "/{}" is already in use.\n'.format(name))
+        return 125
+    port = options["host_port"] if options["host_port"] is not None else find_free_port()
+    state = {"pid": os.getpid(), "port": port, "sessions": {}, "env": options["env"], "labels": options["labels"]}
+    kvm_hostname = None if "SHARED_SESSIONS" in options["env"] else options["env"].get("KVM_HOSTNAME")
+    if options["interactive"]:
+        sys.stdin.readline()
+    # The port is published before the container process is started (the state is updated with its pid afterwards)
+    write_state(name, state)
+    # The container is always a separate process, so it survives a killed client like a real container
+    process = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.fake_docker", "_serve"]
+        + [name, str(port), str(BOOT_TIME), kvm_hostname or "", state_filepath(name) + ".timings"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    state["pid"] = process.pid
+    write_state(name, state)
+    if options["detach"]:
+        print(uuid.uuid4().hex)
+        return 0
+    # Attached clients forward termination signals to the container (like `--sig-proxy`)
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signal_number, lambda sig, frame: process.send_signal(sig))
+    return process.wait()
+
+
+def command_port(args):
+    # type: (List[Text]) -> int
+    state = read_state(args[0])
+    if state is None or not is_process_alive(state["pid"]):
+        sys.stderr.write("Error: No such container: {}\n".format(args[0]))
+        return 1
+    if len(args) > 1:
+        container_port = int(args[1].split("/")[0])
+        if container_port == 8080:
+            port = state["port"]
+        elif str(container_port - 8080) in state["sessions"]:
+            port = state["sessions"][str(container_port - 8080)]["port"]
+        else:
+            return 1
+        print("0.0.0.0:{}".format(port))
+    else:
+        print("8080/tcp -> 0.0.0.0:{}".format(state["port"]))
+    return 0
+
+
+def kill_container(name):
+    # type: (Text) -> bool
+    state = read_state(name)
+    if state is None:
+        return False
+    for session in state["sessions"].values():
+        kill_process(session["pid"])
+    kill_process(state["pid"])
+    log_die_event(name, 137, state.get("labels", {}))
+    for filepath in (state_filepath(name), state_filepath(name) + ".timings"):
+        if os.path.exists(filepath):
+            os.remove(filepath)
+    return True
+
+
+def kill_process(pid):
+    # type: (int) -> None
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except OSError:
+        pass
+
+
+def command_kill(args):
+    # type: (List[Text]) -> int
+    return_code = 0
+    for name in args:
+        if kill_container(name):
+            print(name)
+        else:
+            sys.stderr.write("Error: No such container: {}\n".format(name))
+            return_code = 1
+    return return_code
+
+
+def command_inspect(args):
+    # type: (List[Text]) -> int
+    name = args[-1]
+    if read_state(name) is None:
+        sys.stderr.write("Error: No such object: {}\n".format(name))
+        return 1
+    print("true" if is_running(name) else "false")
+    return 0
+
+
+def command_image(args):
+    # type: (List[Text]) -> int
+    # All images are present locally, their id and digest are derived from the name
+    if args[0] != "inspect":
+        return 1
+    image = args[-1]
+    digest = "sha256:{}".format(hashlib.sha256(image.split("@")[0].encode("utf-8")).hexdigest())
+    if "RepoDigests" in args[args.index("--format") + 1]:
+        repository = image.split("@")[0]
+        if ":" in repository.rsplit("/", 1)[-1]:
+            repository = repository.rsplit(":", 1)[0]
+        print("{}@{}".format(repository, digest))
+    else:
+        print(digest)
+    return 0
+
+
+def command_pull(args):
+    # type: (List[Text]) -> int
+    # Prints the progress output of a pull with three layers
+    image = args[-1]
+    print("{}: Pulling from {}".format(image.rsplit(":", 1)[-1], image.rsplit(":", 1)[0]))
+    layer_ids = [hashlib.sha256("{}{}".format(image, i).encode("utf-8")).hexdigest()[:12] for i in range(3)]
+    for layer_id in layer_ids:
+        print("{}: Pulling fs layer".format(layer_id))
+    for layer_id in layer_ids:
+        time.sleep(CLI_LATENCY)
+        print("{}: Pull complete".format(layer_id))
+        sys.stdout.flush()
+    print("Status: Downloaded newer image for {}".format(image))
+    return 0
+
+
+def command_ps(args):
+    # type: (List[Text]) -> int
+    # Supports `--filter label=<key>[=<value>]` and `--format` with `{{.Names}}` and `{{.Label "<key>"}}`
+    label_filters = [value[len("label=") :] for option, value in zip(args, args[1:]) if option == "--filter"]
+    output_format = args[args.index("--format") + 1] if "--format" in args else "{{.Names}}"
+    for filename in sorted(os.listdir(STATE_DIR)):
+        name = filename[: -len(".json")]
+        if not filename.endswith(".json") or not is_running(name):
+            continue
+        labels = read_state(name).get("labels", {})  # type: ignore
+        if any(
+            key not in labels or (sep and labels[key] != value)
+            for key, sep, value in (label_filter.partition("=") for label_filter in label_filters)
+        ):
+            continue
+        line = output_format.replace("{{.Names}}", name)
+        print(re.sub(r'\{\{\.Label "([^"]*)"\}\}', lambda match: labels.get(match.group(1), ""), line))
+    return 0
+
+
+def command_stats(args):
+    # type: (List[Text]) -> int
+    for filename in sorted(os.listdir(STATE_DIR)):
+        name = filename[: -len(".json")]
+        if filename.endswith(".json") and is_running(name):
+            print("{}\t0.50%\t42.5MiB / 1.944GiB".format(name))
+    return 0
+
+
+def command_events(args):
+    # type: (List[Text]) -> int
+    # Streams the logged `die` events; supports `--since`, `--filter label=<key>=<value>` (other filters are ignored) and
+    # `--format` with `{{.Actor.Attributes.name}}` and `{{.Actor.Attributes.exitCode}}`
+    since = float(args[args.index("--since") + 1]) if "--since" in args else time.time()
+    label_filters = [
+        value[len("label=") :].partition("=")
+        for option, value in zip(args, args[1:])
+        if option == "--filter" and value.startswith("label=")
+    ]
+    output_format = args[args.index("--format") + 1]
+    open(events_filepath(), "a").close()
+    with open(events_filepath(), "rb") as f:
+        while True:
+            line = f.readline()
+            if not line.endswith(b"\n"):
+                f.seek(-len(line), os.SEEK_CUR)
+                time.sleep(0.05)
+                continue
+            event = json.loads(line.decode("utf-8"))
+            if event["time"] < since or any(event["labels"].get(key) != value for key, _, value in label_filters):
+                continue
+            print(
+                output_format.replace("{{.Actor.Attributes.name}}", event["name"]).replace(
+                    "{{.Actor.Attributes.exitCode}}", str(event["exitCode"])
+                )
+            )
+            sys.stdout.flush()
+
+
+def command_exec(args):
+    # type: (List[Text]) -> int
+    with locked_state(get_exec_container_name(args)):
+        return run_exec_command(args)
+
+
+def get_exec_container_name(args):
+    # type: (List[Text]) -> Text
+    while args[0].startswith("-"):
+        args = args[2:] if args[0] == "-e" else args[1:]
+    return args[0]
+
+
+def run_exec_command(args):
+    # type: (List[Text]) -> int
+    env = {}
+    while args[0].startswith("-"):
+        if args[0] == "-e":
+            key, value = args[1].split("=", 1)
+            env[key] = value
+            args = args[2:]
+        else:
+            args = args[1:]
+    name, command = args[0], args[1:]
+    state = read_state(name)
+    if state is None or not is_process_alive(state["pid"]):
+        sys.stderr.write("Error: No such container: {}\n".format(name))
+        return 1
+    if command[0] == "cat":
+        if command[1] == "/tmp/timings":
+            timings_filepath = state_filepath(name) + ".timings"
+        else:
+            timings_filepath = state_filepath(name) + ".{}.timings".format(command[1].split("/")[3])
+        if not os.path.exists(timings_filepath):
+            return 1
+        with open(timings_filepath, "r") as f:
+            sys.stdout.write(f.read())
+        return 0
+    elif command[:2] == ["kvm-session", "add"]:
+        sys.stdin.readline()
+        session = 0
+        while str(session) in state["sessions"]:
+            session += 1
+        port = find_free_port()
+        process = subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.fake_docker", "_serve", name, str(port), str(SESSION_TIME)]
+            + [env.get("KVM_HOSTNAME", ""), state_filepath(name) + ".{}.timings".format(session)],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        state["sessions"][str(session)] = {"pid": process.pid, "port": port}
+        write_state(name, state)
+        print(session)
+        return 0
+    elif command[0] == "sh" and command[-1] == state["env"].get("SECRET_FIFO"):
+        # The password or config of a detached container, which is not checked
+        sys.stdin.read()
+        return 0
+    elif command[0] == "sh":
+        # Commands like the resource sampling of `benchmarks.density` run on the host; `SAMPLE_PIDS` tells them the
+        # processes of the container
+        pids = [state["pid"]] + [session["pid"] for session in state["sessions"].values()]
+        return subprocess.call(command, env=dict(os.environ, SAMPLE_PIDS=" ".join(str(pid) for pid in pids)))
+    elif command[0] == "kvm-viewer":
+        # Viewers only get access to the web server of their console, which is not checked
+        viewers = state.setdefault("viewers", {})
+        if command[1] == "add":
+            secret = sys.stdin.readline().strip()
+            viewer_args = [arg for arg in command[2:] if arg != "--view-only"]
+            viewers[viewer_args[0]] = {"view_only": "--view-only" in command, "secret": secret}
+        else:
+            viewers.pop(command[2], None)
+        write_state(name, state)
+        return 0
+    elif command[:2] == ["kvm-session", "remove"]:
+        session = state["sessions"].pop(command[2], None)
+        if session is not None:
+            kill_process(session["pid"])
+        write_state(name, state)
+        print(len(state["sessions"]))
+        return 0
+    elif command[:2] == ["kvm-session", "count"]:
+        print(len(state["sessions"]))
+        return 0
+    return 0
+
+
+def main():
+    # type: () -> None
+    if not STATE_DIR:
+        sys.stderr.write("FAKE_DOCKER_STATE is not set.\n")
+        sys.exit(1)
+    command, args = sys.argv[1], sys.argv[2:]
+    if command == "_serve":
+        serve(args[0], int(args[1]), float(args[2]), args[3] or None, args[4])
+        sys.exit(0)
+    time.sleep(CLI_LATENCY)
+    commands = {
+        "events": command_events,
+        "exec": command_exec,
+        "image": command_image,
+        "inspect": command_inspect,
+        "kill": command_kill,
+        "port": command_port,
+        "ps": command_ps,
+        "pull": command_pull,
+        "run": command_run,
+        "stats": command_stats,
+    }
+    if command not in commands:
+        sys.stderr.write("docker: '{}' is not a docker command.\n".format(command))
+        sys.exit(1)
+    sys.exit(commands[command](args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+# Load test of the HTTP proxy of the HTML5 image (`docker/kvm-html5/main.js`): starts an HTML5 container against a local
+# stand-in BMC and requests the console page through the proxy from several keep-alive connections, with a browser-like
+# `Cookie` header (authorization cookie and some unrelated cookies) and a `Referer` header. It reports the requests per
+# second, latency percentiles and the CPU time of the container per request.
+#
+# The benchmark needs Docker and the HTML5 image (`make build-html5`). To compare two versions of the proxy, the image is
+# kept and another `main.js` is mounted over the built one, for example:
+#
+#   git show HEAD~1:docker/kvm-html5/main.js > /tmp/main.js
+#   python3 -m benchmarks.html5_proxy --main-js /tmp/main.js
+#   python3 -m benchmarks.html5_proxy --main-js docker/kvm-html5/main.js
+
+import argparse
+import asyncio
+import http.client
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+
+try:
+    from typing import Any, Dict, List, Optional, Text  # noqa: F401  # pylint: disable=unused-import
+except ImportError:
+    pass
+
+from nojava_ipmi_kvm.config import config
+from nojava_ipmi_kvm.kvm import add_sudo_if_configured, create_html5_docker_args, read_docker_port
+from .density import create_certificate, get_docker_bridge_gateway, sample_container
+from .fake_bmc import FakeBmcServer
+from .launch_latency import percentile
+
+CONFIG_TEMPLATE = """
+hosts:
+  proxy-html5:
+    login_endpoint: cgi/login.cgi
+    html5_endpoint: cgi/url_redirect.cgi?url_name=man_ikvm_html5_bootstrap
+    allow_insecure_ssl: true
+    full_hostname: {bmc_hostname}
+"""
+
+AUTHORIZATION_KEY = "nojava-ipmi-kvm-authorization"
+PROXY_PORT = 8080
+STARTUP_TIMEOUT = 60.0
+
+
+def get_argumentparser():
+    # type: () -> argparse.ArgumentParser
+    parser = argparse.ArgumentParser(description="Load test the HTTP proxy of the HTML5 kvm image.")
+    parser.add_argument(
+        "--connections", type=int, default=8, help="number of concurrent connections (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--duration", type=float, default=20.0, help="measured duration in seconds (default: %(default)s)"
+    )
+    parser.add_argument("--warmup", type=float, default=3.0, help="unmeasured warmup in seconds (default: %(default)s)")
+    parser.add_argument(
+        "--cookies",
+        type=int,
+        default=5,
+        help="number of unrelated browser cookies sent with every request (default: %(default)s)",
+    )
+    parser.add_argument("--main-js", help="mount this `main.js` into the container instead of the built one")
+    parser.add_argument("--log-level", help="`LOG_LEVEL` of the proxy (default: default of the proxy)")
+    parser.add_argument(
+        "--bmc-address",
+        help="address of this host which is reachable from containers (default: gateway of the Docker bridge network)",
+    )
+    return parser
+
+
+def start_proxy_container(container_name, host_config, authorization_value, args):
+    # type: (Text, Any, Text, argparse.Namespace) -> subprocess.Popen
+    extra_args, environment_variables, docker_image, stdin = create_html5_docker_args(
+        host_config, "password", AUTHORIZATION_KEY, authorization_value
+    )
+    if args.log_level is not None:
+        environment_variables = environment_variables + ["-e", "LOG_LEVEL={}".format(args.log_level)]
+    mount_args = []  # type: List[Text]
+    if args.main_js is not None:
+        mount_args = ["-v", "{}:/usr/local/kvm-html5/main.js:ro".format(os.path.abspath(args.main_js))]
+    process = subprocess.Popen(
+        add_sudo_if_configured(
+            ["docker", "run", "-i", "--rm", "--name", container_name, "-p", "127.0.0.1::{}".format(PROXY_PORT)]
+            + environment_variables
+            + mount_args
+            + [docker_image]
+            + extra_args
+        ),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+    )
+    process.stdin.write(stdin.encode("utf-8"))
+    process.stdin.close()
+    return process
+
+
+def wait_for_proxy(container_name, process, path, headers):
+    # type: (Text, subprocess.Popen, Text, Dict[Text, Text]) -> int
+    # The proxy listens after it logged in to the BMC
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("The proxy container terminated with return code {}.".format(process.returncode))
+        try:
+            port = read_docker_port(container_name, subprocess.DEVNULL, PROXY_PORT)
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            connection.request("GET", path, headers=headers)
+            status = connection.getresponse().status
+            connection.close()
+            if status == 200:
+                return port
+        except (OSError, ValueError, IndexError, subprocess.CalledProcessError, http.client.HTTPException):
+            pass
+        time.sleep(0.5)
+    raise RuntimeError("The proxy did not respond within {} seconds.".format(STARTUP_TIMEOUT))
+
+
+def run_connection(port, path, headers, measure_time, stop_time, latencies, errors):
+    # type: (int, Text, Dict[Text, Text], float, float, List[float], List[int]) -> None
+    connection = None  # type: Optional[http.client.HTTPConnection]
+    while True:
+        start_time = time.monotonic()
+        if start_time >= stop_time:
+            break
+        try:
+            if connection is None:
+                connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+            connection.request("GET", path, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            ok = response.status == 200
+        except (OSError, http.client.HTTPException):
+            if connection is not None:
+                connection.close()
+            connection = None
+            ok = False
+        if start_time >= measure_time:
+            # `list.append` is atomic, no lock is needed
+            if ok:
+                latencies.append(time.monotonic() - start_time)
+            else:
+                errors.append(1)
+    if connection is not None:
+        connection.close()
+
+
+def run_load(container_name, port, path, headers, args):
+    # type: (Text, int, Text, Dict[Text, Text], argparse.Namespace) -> None
+    loop = asyncio.get_event_loop()
+    latencies = []  # type: List[float]
+    errors = []  # type: List[int]
+    measure_time = time.monotonic() + args.warmup
+    stop_time = measure_time + args.duration
+    threads = [
+        threading.Thread(
+            target=run_connection,
+            args=(port, path, headers, measure_time, stop_time, latencies, errors),
+            daemon=True,
+        )
+        for _ in range(args.connections)
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(max(0.0, measure_time - time.monotonic()))
+    first_sample = loop.run_until_complete(sample_container(container_name))
+    time.sleep(max(0.0, stop_time - time.monotonic()))
+    last_sample = loop.run_until_complete(sample_container(container_name))
+    for thread in threads:
+        thread.join()
+
+    print("\nproxy: {}".format(args.main_js or "built into the image"))
+    print("{:<28} {:>12}".format("connections", args.connections))
+    print("{:<28} {:>12}".format("requests", len(latencies)))
+    print("{:<28} {:>12}".format("errors", len(errors)))
+    print("{:<28} {:>12.1f}".format("requests per second", len(latencies) / args.duration))
+    if latencies:
+        for p in (50, 90, 99):
+            print("{:<28} {:>12.2f}".format("p{} latency [ms]".format(p), 1000.0 * percentile(latencies, p)))
+        cpu_time = last_sample.get("cpu", 0.0) - first_sample.get("cpu", 0.0)
+        # After the login, the proxy is the only busy process of the container
+        print("{:<28} {:>12.3f}".format("CPU per request [ms]", 1000.0 * cpu_time / len(latencies)))
+
+
+def main():
+    # type: () -> None
+    args = get_argumentparser().parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    temp_dir = tempfile.mkdtemp(prefix="nojava-ipmi-kvm-benchmark-")
+    bmc_server = None
+    process = None
+    container_name = "nojava-ipmi-kvm-proxy-benchmark-{}".format(uuid.uuid4())
+    try:
+        bmc_address = args.bmc_address or get_docker_bridge_gateway()
+        certfile, keyfile = create_certificate(temp_dir, bmc_address)
+        bmc_server = FakeBmcServer(host="0.0.0.0", certfile=certfile, keyfile=keyfile)
+        bmc_server.start()
+        config_filepath = os.path.join(temp_dir, "nojava-ipmi-kvmrc.yaml")
+        with open(config_filepath, "w") as f:
+            f.write(CONFIG_TEMPLATE.format(bmc_hostname="{}:{}".format(bmc_address, bmc_server.server_address[1])))
+        config.read_config(config_filepath)
+        host_config = config["proxy-html5"]
+
+        authorization_value = uuid.uuid4().hex
+        path = "/{}".format(host_config.html5_endpoint)
+        cookies = ["cookie{}={}".format(i, uuid.uuid4().hex) for i in range(args.cookies)]
+        cookies.insert(len(cookies) // 2, "{}={}".format(AUTHORIZATION_KEY, authorization_value))
+        headers = {
+            "Cookie": "; ".join(cookies),
+            "Referer": "http://127.0.0.1:{}{}".format(PROXY_PORT, path),
+            "User-Agent": "nojava-ipmi-kvm-benchmark",
+        }
+
+        process = start_proxy_container(container_name, host_config, authorization_value, args)
+        port = wait_for_proxy(container_name, process, path, headers)
+        run_load(container_name, port, path, headers, args)
+    finally:
+        if process is not None:
+            subprocess.call(
+                add_sudo_if_configured(["docker", "kill", container_name]),
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            process.wait()
+        if bmc_server is not None:
+            bmc_server.stop()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
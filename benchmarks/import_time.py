@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+# Checks that quick invocations of the command line interface do not import more than necessary: every entry point is
+# run with `python -X importtime` and the cumulative import time of all modules which are not loaded by the interpreter
+# startup itself is compared with a budget. Exits with code 1 if a budget is exceeded, for example with
+# `make import-time-check` or `python3 -m benchmarks.import_time --budget 40`.
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+try:
+    from typing import List, Set, Text, Tuple  # noqa: F401  # pylint: disable=unused-import
+except ImportError:
+    pass
+
+# (name, command line arguments, budget in milliseconds); `{config}` is replaced by the path of a small config file
+ENTRY_POINTS = (
+    ("--version", ["--version"], 40.0),
+    ("--help", ["--help"], 40.0),
+    ("--print-default-config", ["--print-default-config"], 60.0),
+    ("--list-hosts", ["-f", "{config}", "--list-hosts"], 40.0),
+)
+
+CONFIG = """
+templates:
+  kvm-template:
+    java_version: 8u242
+hosts:
+  mykvmhost:
+    based_on: kvm-template
+    full_hostname: mykvmhost.org
+"""
+
+ENTRY_POINT_CODE = (
+    "import sys; sys.argv = ['nojava-ipmi-kvm'] + sys.argv[1:]; from nojava_ipmi_kvm.cli import main; main()"
+)
+
+
+def get_argumentparser():
+    # type: () -> argparse.ArgumentParser
+    parser = argparse.ArgumentParser(description="Check the import time of command line entry points.")
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=5, help="runs per entry point, the fastest is used (default: %(default)s)"
+    )
+    parser.add_argument("--budget", type=float, help="budget in milliseconds for all entry points (overrides defaults)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print the slowest imports of every entry point")
+    return parser
+
+
+def run_importtime(code, args):
+    # type: (Text, List[Text]) -> List[Tuple[Text, int, int]]
+    # Returns (module name, self time in us, cumulative time in us) for every top level import
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + (
+        os.pathsep + env["PYTHONPATH"] if "PYTHONPATH" in env else ""
+    )
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code] + args,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        env=env,
+    )
+    imports = []  # type: List[Tuple[Text, int, int]]
+    for line in process.stderr.decode("utf-8").splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_time, cumulative_time, name = line[len("import time:") :].split("|")
+        # Only top level imports are counted, nested imports are part of their cumulative time
+        if not name[1:].startswith(" "):
+            imports.append((name.strip(), int(self_time), int(cumulative_time)))
+    return imports
+
+
+def measure(args, startup_modules, repeat):
+    # type: (List[Text], Set[Text], int) -> Tuple[float, List[Tuple[Text, int, int]]]
+    best_time = None
+    best_imports = []  # type: List[Tuple[Text, int, int]]
+    for _ in range(repeat):
+        imports = [entry for entry in run_importtime(ENTRY_POINT_CODE, args) if entry[0] not in startup_modules]
+        total_time = sum(cumulative_time for _, _, cumulative_time in imports) / 1000.0
+        if best_time is None or total_time < best_time:
+            best_time, best_imports = total_time, imports
+    return best_time or 0.0, best_imports
+
+
+def main():
+    # type: () -> None
+    args = get_argumentparser().parse_args()
+    startup_modules = set(name for name, _, _ in run_importtime("pass", []))
+    temp_dir = tempfile.mkdtemp(prefix="nojava-ipmi-kvm-import-time-")
+    try:
+        budget_exceeded = check_entry_points(args, startup_modules, temp_dir)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    sys.exit(1 if budget_exceeded else 0)
+
+
+def check_entry_points(args, startup_modules, temp_dir):
+    # type: (argparse.Namespace, Set[Text], Text) -> bool
+    config_filepath = os.path.join(temp_dir, "nojava-ipmi-kvmrc.yaml")
+    with open(config_filepath, "w") as f:
+        f.write(CONFIG)
+    # Keep the config index and host name cache out of the user's cache directory
+    os.environ["XDG_CACHE_HOME"] = os.path.join(temp_dir, "cache")
+    budget_exceeded = False
+    for name, entry_point_args, default_budget in ENTRY_POINTS:
+        budget = args.budget if args.budget is not None else default_budget
+        entry_point_args = [arg.format(config=config_filepath) for arg in entry_point_args]
+        import_time, imports = measure(entry_point_args, startup_modules, args.repeat)
+        exceeded = import_time > budget
+        budget_exceeded = budget_exceeded or exceeded
+        print(
+            "{:<25} {:>8.1f} ms (budget {:.1f} ms){}".format(
+                name, import_time, budget, "  BUDGET EXCEEDED" if exceeded else ""
+            )
+        )
+        if args.verbose or exceeded:
+            for module_name, _, cumulative_time in sorted(imports, key=lambda entry: -entry[2])[:10]:
+                print("    {:<40} {:>8.1f} ms".format(module_name, cumulative_time / 1000.0))
+    return budget_exceeded
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+# Measures the launch latency of `start_kvm_container` against a fake BMC and a fake `docker` command. Runs offline and
+# without Docker, for example with `make benchmark` or `python3 -m benchmarks.launch_latency --parallel 10`.
+
+import argparse
+import asyncio
+import logging
+import math
+import os
+import shutil
+import stat
+import sys
+import tempfile
+
+try:
+    from typing import Dict, List, Text  # noqa: F401  # pylint: disable=unused-import
+except ImportError:
+    pass
+
+from nojava_ipmi_kvm.config import config
+from nojava_ipmi_kvm.kvm import start_kvm_container
+from nojava_ipmi_kvm.trace import LaunchTrace
+from .fake_bmc import FakeBmcServer
+
+CONFIG_TEMPLATE = """
+general:
+  share_java_containers: {share_java_containers}
+  preflight_cache_ttls: {preflight_cache_ttls}
+templates:
+  fake-java:
+    login_endpoint: cgi/login.cgi
+    download_endpoint: cgi/url_redirect.cgi?url_name=ikvm&url_type=jwsk
+    java_version: 8u242
+  fake-html5:
+    login_endpoint: cgi/login.cgi
+    html5_endpoint: cgi/url_redirect.cgi?url_name=man_ikvm_html5_bootstrap
+hosts:
+  bench-java:
+    based_on: fake-java
+    full_hostname: {bmc_hostname}
+  bench-html5:
+    based_on: fake-html5
+    full_hostname: {bmc_hostname}
+"""
+
+# Every launch runs all preflight checks, instead of skipping them after the first launch
+DISABLED_PREFLIGHT_CACHE_TTLS = "{docker: 0, docker_image: 0, webserver: 0}"
+
+
+def get_argumentparser():
+    # type: () -> argparse.ArgumentParser
+    parser = argparse.ArgumentParser(description="Benchmark the launch latency of kvm consoles.")
+    parser.add_argument("-n", "--runs", type=int, default=5, help="launches per scenario (default: %(default)s)")
+    parser.add_argument(
+        "-p",
+        "--parallel",
+        type=int,
+        default=5,
+        help="concurrent launches in the parallel scenarios (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--bmc-latency",
+        type=float,
+        default=0.05,
+        help="response delay of the fake BMC in seconds (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--boot-time", type=float, default=1.0, help="boot time of fake containers in seconds (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--docker-latency",
+        type=float,
+        default=0.05,
+        help="additional latency of every fake docker call in seconds (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--kinds",
+        default="java,html5",
+        help="comma-separated list of console kinds to benchmark (default: %(default)s)",
+    )
+    parser.add_argument("--shared", action="store_true", help="run Java consoles in shared containers")
+    parser.add_argument(
+        "--preflight-cache",
+        action="store_true",
+        help="keep the preflight cache enabled, so all but the first launches measure cached preflight checks",
+    )
+    return parser
+
+
+def percentile(values, p):
+    # type: (List[float], float) -> float
+    # Nearest-rank method
+    sorted_values = sorted(values)
+    index = max(0, min(len(sorted_values) - 1, int(math.ceil(p / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+async def launch(hostname):
+    # type: (Text) -> Dict[Text, float]
+    launch_trace = LaunchTrace()
+    kvm_viewer = await start_kvm_container(config[hostname], "password", launch_trace=launch_trace)
+    durations = {}  # type: Dict[Text, float]
+    for span in launch_trace.spans:
+        durations[span.name] = durations.get(span.name, 0.0) + span.duration
+    durations["total"] = launch_trace.duration
+    for phase, duration in launch_trace.container_phases:
+        durations["container.{}".format(phase)] = duration
+    kvm_viewer.kill_process()
+    return durations
+
+
+async def run_scenario(hostname, runs, parallel):
+    # type: (Text, int, int) -> List[Dict[Text, float]]
+    results = []  # type: List[Dict[Text, float]]
+    for _ in range(runs):
+        results.extend(await asyncio.gather(*(launch(hostname) for _ in range(parallel))))
+    return results
+
+
+def print_report(scenario, results):
+    # type: (Text, List[Dict[Text, float]]) -> None
+    phases = []  # type: List[Text]
+    for durations in results:
+        phases.extend(phase for phase in durations if phase not in phases)
+    print("\n{} ({} launches)".format(scenario, len(results)))
+    print("{:<32} {:>9} {:>9} {:>9} {:>9}".format("phase", "p50 [s]", "p90 [s]", "p99 [s]", "max [s]"))
+    for phase in phases:
+        values = [durations[phase] for durations in results if phase in durations]
+        print(
+            "{:<32} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}".format(
+                phase, percentile(values, 50), percentile(values, 90), percentile(values, 99), max(values)
+            )
+        )
+
+
+def setup_fake_docker(temp_dir, args):
+    # type: (Text, argparse.Namespace) -> None
+    bin_dir = os.path.join(temp_dir, "bin")
+    state_dir = os.path.join(temp_dir, "state")
+    os.mkdir(bin_dir)
+    os.mkdir(state_dir)
+    docker_filepath = os.path.join(bin_dir, "docker")
+    with open(docker_filepath, "w") as f:
+        f.write('#!/bin/sh\nexec "{}" -m benchmarks.fake_docker "$@"\n'.format(sys.executable))
+    os.chmod(docker_filepath, os.stat(docker_filepath).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+    os.environ["PYTHONPATH"] = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + (
+        os.pathsep + os.environ["PYTHONPATH"] if "PYTHONPATH" in os.environ else ""
+    )
+    os.environ["FAKE_DOCKER_STATE"] = state_dir
+    os.environ["FAKE_DOCKER_BOOT_TIME"] = str(args.boot_time)
+    os.environ["FAKE_DOCKER_CLI_LATENCY"] = str(args.docker_latency)
+    # Keep the preflight cache of the fake Docker out of the user's cache directory
+    os.environ["XDG_CACHE_HOME"] = os.path.join(temp_dir, "cache")
+
+
+def main():
+    # type: () -> None
+    args = get_argumentparser().parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    bmc_server = FakeBmcServer(latency=args.bmc_latency)
+    bmc_server.start()
+    temp_dir = tempfile.mkdtemp(prefix="nojava-ipmi-kvm-benchmark-")
+    try:
+        setup_fake_docker(temp_dir, args)
+        config_filepath = os.path.join(temp_dir, "nojava-ipmi-kvmrc.yaml")
+        with open(config_filepath, "w") as f:
+            f.write(
+                CONFIG_TEMPLATE.format(
+                    bmc_hostname=bmc_server.hostname,
+                    share_java_containers=str(args.shared).lower(),
+                    preflight_cache_ttls="{}" if args.preflight_cache else DISABLED_PREFLIGHT_CACHE_TTLS,
+                )
+            )
+        config.read_config(config_filepath)
+
+        loop = asyncio.get_event_loop()
+        for kind in args.kinds.split(","):
+            hostname = "bench-{}".format(kind)
+            print_report("{}, single".format(kind), loop.run_until_complete(run_scenario(hostname, args.runs, 1)))
+            print_report(
+                "{}, {} parallel".format(kind, args.parallel),
+                loop.run_until_complete(run_scenario(hostname, args.runs, args.parallel)),
+            )
+    finally:
+        bmc_server.stop()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+# Minimal RFB (VNC) client which connects through the websocket of a noVNC web server (websockify) like the noVNC page
+# in a browser. It only parses as much of the protocol as needed to keep a session busy: framebuffer updates are
+# requested and consumed, but not decoded.
+
+import base64
+import hashlib
+import os
+import socket
+import struct
+
+try:
+    from typing import Callable, Optional, Text, Tuple  # noqa: F401  # pylint: disable=unused-import
+except ImportError:
+    pass
+
+WEBSOCKET_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+SECURITY_NONE = 1
+SECURITY_VNC_AUTH = 2
+
+ENCODING_RAW = 0
+ENCODING_COPY_RECT = 1
+ENCODING_ZRLE = 16
+ENCODING_DESKTOP_SIZE = -223
+
+# 32 bits per pixel, depth 24, little endian, true colour, 8 bits per channel
+PIXEL_FORMAT = struct.pack(">BBBBHHHBBB3x", 32, 24, 0, 1, 255, 255, 255, 16, 8, 0)
+
+
+class RfbError(Exception):
+    pass
+
+
+def get_websocket_accept_key(key):
+    # type: (bytes) -> bytes
+    return base64.b64encode(hashlib.sha1(key + WEBSOCKET_GUID).digest())
+
+
+def encode_websocket_frame(payload, opcode=OPCODE_BINARY, mask=True):
+    # type: (bytes, int, bool) -> bytes
+    # Frames of clients must be masked, frames of servers must not
+    header = bytearray([0x80 | opcode])
+    mask_bit = 0x80 if mask else 0
+    if len(payload) < 126:
+        header.append(mask_bit | len(payload))
+    elif len(payload) < 1 << 16:
+        header.append(mask_bit | 126)
+        header.extend(struct.pack(">H", len(payload)))
+    else:
+        header.append(mask_bit | 127)
+        header.extend(struct.pack(">Q", len(payload)))
+    if not mask:
+        return bytes(header) + payload
+    masking_key = os.urandom(4)
+    return bytes(header) + masking_key + bytes(b ^ masking_key[i % 4] for i, b in enumerate(payload))
+
+
+def read_websocket_frame(read_exactly):
+    # type: (Callable[[int], bytes]) -> Tuple[int, bytes]
+    first_byte, second_byte = read_exactly(2)
+    opcode = first_byte & 0x0F
+    length = second_byte & 0x7F
+    if length == 126:
+        (length,) = struct.unpack(">H", read_exactly(2))
+    elif length == 127:
+        (length,) = struct.unpack(">Q", read_exactly(8))
+    masking_key = read_exactly(4) if second_byte & 0x80 else None
+    payload = read_exactly(length)
+    if masking_key is not None:
+        payload = bytes(b ^ masking_key[i % 4] for i, b in enumerate(payload))
+    return opcode, payload
+
+
+def get_vnc_auth_response(password, challenge):
+    # type: (Text, bytes) -> bytes
+    # VNC authentication encrypts the challenge with DES, using the password with mirrored bits in every byte as key
+    try:
+        from Crypto.Cipher import DES
+    except ImportError:
+        raise RfbError("VNC authentication requires the `pycryptodome` package.")
+    key = bytes(int("{:08b}".format(b)[::-1], 2) for b in password.encode("latin-1")[:8].ljust(8, b"\0"))
+    return DES.new(key, DES.MODE_ECB).encrypt(challenge)
+
+
+class RfbClient:
+    def __init__(self, host, port, password=None, path="websockify", timeout=10.0):
+        # type: (Text, int, Optional[Text], Text, float) -> None
+        self._host = host
+        self._port = port
+        self._password = password
+        self._path = path
+        self._timeout = timeout
+        self._socket = None  # type: Optional[socket.socket]
+        # Received websocket data which is not parsed yet and RFB data of parsed websocket frames
+        self._socket_buffer = bytearray()
+        self._buffer = bytearray()
+        self._width = 0
+        self._height = 0
+        self._received_bytes = 0
+
+    @property
+    def width(self):
+        # type: () -> int
+        return self._width
+
+    @property
+    def height(self):
+        # type: () -> int
+        return self._height
+
+    @property
+    def received_bytes(self):
+        # type: () -> int
+        # Framebuffer update data received so far
+        return self._received_bytes
+
+    def connect(self):
+        # type: () -> None
+        self._socket = socket.create_connection((self._host, self._port), timeout=self._timeout)
+        self._websocket_handshake()
+        self._rfb_handshake()
+
+    def close(self):
+        # type: () -> None
+        if self._socket is not None:
+            try:
+                self._socket.sendall(encode_websocket_frame(b"", OPCODE_CLOSE))
+            except OSError:
+                pass
+            self._socket.close()
+            self._socket = None
+
+    def request_update(self, incremental=True):
+        # type: (bool) -> None
+        self._send(struct.pack(">BBHHHH", 3, int(incremental), 0, 0, self._width, self._height))
+
+    def pointer_event(self, x, y, button_mask=0):
+        # type: (int, int, int) -> None
+        self._send(struct.pack(">BBHH", 5, button_mask, x, y))
+
+    def read_update(self):
+        # type: () -> int
+        # Reads server messages until a framebuffer update is complete and returns its number of rectangles
+        while True:
+            (message_type,) = struct.unpack(">B", self._read(1))
+            if message_type == 0:
+                return self._read_framebuffer_update()
+            elif message_type == 1:
+                _, _, color_count = struct.unpack(">BHH", self._read(5))
+                self._read(6 * color_count)
+            elif message_type == 2:
+                pass
+            elif message_type == 3:
+                _, length = struct.unpack(">3sI", self._read(7))
+                self._read(length)
+            else:
+                raise RfbError("Unsupported server message type {}.".format(message_type))
+
+    def _read_framebuffer_update(self):
+        # type: () -> int
+        _, rectangle_count = struct.unpack(">BH", self._read(3))
+        for _ in range(rectangle_count):
+            _, _, width, height, encoding = struct.unpack(">HHHHi", self._read(12))
+            if encoding == ENCODING_RAW:
+                self._received_bytes += len(self._read(width * height * 4))
+            elif encoding == ENCODING_COPY_RECT:
+                self._read(4)
+            elif encoding == ENCODING_ZRLE:
+                (length,) = struct.unpack(">I", self._read(4))
+                self._received_bytes += len(self._read(length))
+            elif encoding == ENCODING_DESKTOP_SIZE:
+                self._width, self._height = width, height
+            else:
+                raise RfbError("Unsupported encoding {}.".format(encoding))
+        return rectangle_count
+
+    def _websocket_handshake(self):
+        # type: () -> None
+        key = base64.b64encode(os.urandom(16))
+        request = (
+            "GET /{path} HTTP/1.1\r\n"
+            "Host: {host}:{port}\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            "Sec-WebSocket-Key: {key}\r\n"
+            "Sec-WebSocket-Protocol: binary\r\n"
+            "Sec-WebSocket-Version: 13\r\n"
+            "\r\n"
+        ).format(path=self._path, host=self._host, port=self._port, key=key.decode("ascii"))
+        self._socket.sendall(request.encode("ascii"))
+        response = b""
+        while b"\r\n\r\n" not in response:
+            data = self._socket.recv(4096)
+            if not data:
+                raise RfbError("The web server closed the connection during the websocket handshake.")
+            response += data
+        response, remaining_data = response.split(b"\r\n\r\n", 1)
+        self._socket_buffer.extend(remaining_data)
+        status_line = response.split(b"\r\n", 1)[0]
+        if b" 101 " not in status_line:
+            raise RfbError("Websocket upgrade failed: {}".format(status_line.decode("latin-1")))
+        if get_websocket_accept_key(key) not in response:
+            raise RfbError("Invalid websocket accept key.")
+
+    def _rfb_handshake(self):
+        # type: () -> None
+        self._read(12)
+        self._send(b"RFB 003.008\n")
+        (security_type_count,) = struct.unpack(">B", self._read(1))
+        if security_type_count == 0:
+            (length,) = struct.unpack(">I", self._read(4))
+            raise RfbError("Connection refused: {}".format(self._read(length).decode("utf-8", errors="replace")))
+        security_types = self._read(security_type_count)
+        if SECURITY_NONE in security_types:
+            self._send(struct.pack(">B", SECURITY_NONE))
+        elif SECURITY_VNC_AUTH in security_types:
+            if self._password is None:
+                raise RfbError("The VNC server requires a password.")
+            self._send(struct.pack(">B", SECURITY_VNC_AUTH))
+            self._send(get_vnc_auth_response(self._password, self._read(16)))
+        else:
+            raise RfbError("No supported security type offered ({}).".format(list(security_types)))
+        (security_result,) = struct.unpack(">I", self._read(4))
+        if security_result != 0:
+            raise RfbError("VNC authentication failed.")
+        # Shared session, like noVNC
+        self._send(struct.pack(">B", 1))
+        self._width, self._height, _, name_length = struct.unpack(">HH16sI", self._read(24))
+        self._read(name_length)
+        self._send(struct.pack(">BBBB", 0, 0, 0, 0) + PIXEL_FORMAT)
+        encodings = (ENCODING_ZRLE, ENCODING_COPY_RECT, ENCODING_RAW, ENCODING_DESKTOP_SIZE)
+        self._send(struct.pack(">BBH", 2, 0, len(encodings)) + struct.pack(">{}i".format(len(encodings)), *encodings))
+
+    def _send(self, data):
+        # type: (bytes) -> None
+        self._socket.sendall(encode_websocket_frame(data))
+
+    def _read(self, length):
+        # type: (int) -> bytes
+        # Reads RFB data, which is split into websocket frames arbitrarily
+        while len(self._buffer) < length:
+            opcode, payload = read_websocket_frame(self._read_socket)
+            if opcode in (OPCODE_BINARY, OPCODE_CONTINUATION):
+                self._buffer.extend(payload)
+            elif opcode == OPCODE_PING:
+                self._socket.sendall(encode_websocket_frame(payload, OPCODE_PONG))
+            elif opcode == OPCODE_CLOSE:
+                raise RfbError("The web server closed the websocket.")
+        data = bytes(self._buffer[:length])
+        del self._buffer[:length]
+        return data
+
+    def _read_socket(self, length):
+        # type: (int) -> bytes
+        # Reads websocket data; the first frames can already be received with the handshake response
+        while len(self._socket_buffer) < length:
+            chunk = self._socket.recv(max(4096, length - len(self._socket_buffer)))
+            if not chunk:
+                raise RfbError("The web server closed the connection.")
+            self._socket_buffer.extend(chunk)
+        data = bytes(self._socket_buffer[:length])
+        del self._socket_buffer[:length]
+        return data
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# Compares stopping many kvm consoles one after another with `close_all_kvm_viewers` against a fake BMC and a fake
+# `docker` command, for example with `python3 -m benchmarks.teardown --consoles 40`.
+
+import argparse
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+try:
+    from typing import List, Text  # noqa: F401  # pylint: disable=unused-import
+except ImportError:
+    pass
+
+from nojava_ipmi_kvm.config import config
+from nojava_ipmi_kvm.kvm import KvmViewer, aclose_all_kvm_viewers, live_kvm_viewers, start_kvm_container
+from .fake_bmc import FakeBmcServer
+from .launch_latency import CONFIG_TEMPLATE, DISABLED_PREFLIGHT_CACHE_TTLS, setup_fake_docker
+
+
+def get_argumentparser():
+    # type: () -> argparse.ArgumentParser
+    parser = argparse.ArgumentParser(description="Benchmark the teardown of many kvm consoles.")
+    parser.add_argument(
+        "-c", "--consoles", type=int, default=20, help="kvm consoles per scenario (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--docker-latency",
+        type=float,
+        default=0.2,
+        help="additional latency of every fake docker call in seconds (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--kind", default="html5", choices=("java", "html5"), help="console kind to benchmark (default: %(default)s)"
+    )
+    parser.add_argument("--shared", action="store_true", help="run Java consoles in shared containers")
+    return parser
+
+
+async def launch_consoles(hostname, count):
+    # type: (Text, int) -> List[KvmViewer]
+    return await asyncio.gather(*(start_kvm_container(config[hostname], "password") for _ in range(count)))
+
+
+def main():
+    # type: () -> None
+    args = get_argumentparser().parse_args()
+    args.boot_time = 0.2
+    logging.basicConfig(level=logging.WARNING)
+    bmc_server = FakeBmcServer(latency=0.0)
+    bmc_server.start()
+    temp_dir = tempfile.mkdtemp(prefix="nojava-ipmi-kvm-benchmark-")
+    try:
+        setup_fake_docker(temp_dir, args)
+        config_filepath = os.path.join(temp_dir, "nojava-ipmi-kvmrc.yaml")
+        with open(config_filepath, "w") as f:
+            f.write(
+                CONFIG_TEMPLATE.format(
+                    bmc_hostname=bmc_server.hostname,
+                    share_java_containers=str(args.shared).lower(),
+                    preflight_cache_ttls=DISABLED_PREFLIGHT_CACHE_TTLS,
+                )
+            )
+        config.read_config(config_filepath)
+        hostname = "bench-{}".format(args.kind)
+
+        loop = asyncio.get_event_loop()
+        kvm_viewers = loop.run_until_complete(launch_consoles(hostname, args.consoles))
+        start_time = time.monotonic()
+        for kvm_viewer in kvm_viewers:
+            kvm_viewer.kill_process()
+        sequential_duration = time.monotonic() - start_time
+
+        loop.run_until_complete(launch_consoles(hostname, args.consoles))
+        start_time = time.monotonic()
+        loop.run_until_complete(aclose_all_kvm_viewers())
+        bulk_duration = time.monotonic() - start_time
+
+        print("{} {} consoles, {} live viewers left".format(args.consoles, args.kind, len(live_kvm_viewers)))
+        print("{:<32} {:>9}".format("teardown", "total [s]"))
+        print("{:<32} {:>9.3f}".format("kill_process one by one", sequential_duration))
+        print("{:<32} {:>9.3f}".format("aclose_all_kvm_viewers", bulk_duration))
+    finally:
+        bmc_server.stop()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,82 @@
-# bash completion for `nojava-ipmi-kvm` (hostnames only)
+# bash completion for `nojava-ipmi-kvm` (hostnames and the config file option)
+
+# Makes a path absolute and removes `.` and `..` segments and duplicate slashes without resolving symbolic links, like
+# `os.path.abspath` which builds the cache file name
+_nojava-ipmi-kvm_absolute_path() {
+    local path segment
+    local -a segments normalized_segments
+
+    path="$1"
+    [[ "${path}" == /* ]] || path="${PWD}/${path}"
+    IFS=/ read -r -a segments <<< "${path}"
+    for segment in "${segments[@]}"; do
+        case "${segment}" in
+            ""|.)
+                ;;
+            ..)
+                (( ${#normalized_segments[@]} > 0 )) && unset "normalized_segments[${#normalized_segments[@]}-1]"
+                ;;
+            *)
+                normalized_segments+=( "${segment}" )
+                ;;
+        esac
+    done
+    path="$(IFS=/ && echo "${normalized_segments[*]}")"
+    echo "/${path}"
+}
+
+_nojava-ipmi-kvm_read_hosts() {
+    local config_filepath cache_filepath line source_path
+
+    config_filepath="$1"
+    config_filepath="$(_nojava-ipmi-kvm_absolute_path "${config_filepath/#\~/${HOME}}")"
+    # `nojava-ipmi-kvm` keeps a list of all host names in this file (path separators are replaced by `%`)
+    cache_filepath="${XDG_CACHE_HOME:-${HOME}/.cache}/nojava-ipmi-kvm/hostnames/${config_filepath//\//%}"
+
+    if [[ -f "${cache_filepath}" ]]; then
+        # The cache starts with `#source <path>` lines for all config files and included directories
+        while IFS= read -r line && [[ "${line}" == "#source "* ]]; do
+            source_path="${line#\#source }"
+            if [[ ! -e "${source_path}" || "${source_path}" -nt "${cache_filepath}" ]]; then
+                line=""
+                break
+            fi
+        done < "${cache_filepath}"
+        if [[ -n "${line}" ]]; then
+            grep -v '^#source ' "${cache_filepath}"
+            return
+        fi
+    fi
+    # The cache is missing or outdated, `--list-hosts` regenerates it
+    nojava-ipmi-kvm -f "${config_filepath}" --list-hosts 2>/dev/null
+}
 
 _nojava-ipmi-kvm_completions() {
-    local hosts
+    local config_filepath current_word previous_word i
 
-    _nojava-ipmi-kvm_read_hosts_from_config() {
-        python <<-EOF 2>/dev/null
-			import os
-			import yaml
+    current_word="${COMP_WORDS[COMP_CWORD]}"
+    previous_word="${COMP_WORDS[COMP_CWORD-1]}"
+    if [[ "${previous_word}" == "-f" || "${previous_word}" == "--config-file" ]]; then
+        COMPREPLY=($(compgen -f -- "${current_word}"))
+        return
+    fi
+    if [[ "${current_word}" == -* ]]; then
+        return
+    fi
 
-			with open(os.path.expanduser("~/.nojava-ipmi-kvmrc.yaml"), "r") as config_file:
-			    print("\n".join(yaml.safe_load(config_file)["hosts"].keys()))
-		EOF
-    }
+    config_filepath="${HOME}/.nojava-ipmi-kvmrc.yaml"
+    for (( i=1; i < COMP_CWORD; i++ )); do
+        case "${COMP_WORDS[i]}" in
+            -f|--config-file)
+                config_filepath="${COMP_WORDS[i+1]}"
+                ;;
+            --config-file=*)
+                config_filepath="${COMP_WORDS[i]#--config-file=}"
+                ;;
+        esac
+    done
 
-    hosts=( $(_nojava-ipmi-kvm_read_hosts_from_config) )
-    COMPREPLY=($(compgen -W "${hosts[*]}" "${COMP_WORDS[1]}"))
+    COMPREPLY=($(compgen -W "$(_nojava-ipmi-kvm_read_hosts "${config_filepath}")" -- "${current_word}"))
 }
 
 complete -F _nojava-ipmi-kvm_completions nojava-ipmi-kvm
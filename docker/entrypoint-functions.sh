@@ -0,0 +1,91 @@
+# Functions shared by `docker-entrypoint` and `kvm-session`
+
+: ${TIMING_FILE:=/tmp/timings}
+export TIMING_FILE
+
+# Usage: timed <phase> <command> [<args>...]
+# Runs the command and appends a `<phase> <duration in seconds>` line to `${TIMING_FILE}`
+timed () {
+    local phase start_time return_code
+
+    phase="$1"
+    shift
+    start_time="$(date +%s.%N)"
+    "$@"
+    return_code="$?"
+    awk -v phase="${phase}" -v start_time="${start_time}" -v end_time="$(date +%s.%N)" \
+        'BEGIN { printf "%s %.3f\n", phase, end_time - start_time }' >> "${TIMING_FILE}"
+    return "${return_code}"
+}
+
+install_java () {
+    # Select the needed Java version; all versions are installed at image build time and the JRE paths of the image
+    # (`/usr/local/bin/javaws` for Oracle Java, `/usr/lib/jvm/java-<major version>-openjdk-amd64` and
+    # `/etc/java-<major version>-openjdk` for OpenJDK) are symlinks to `/tmp/java`, so the root filesystem can be
+    # read-only
+    : ${JAVA_VERSION:=7u181}
+    mkdir -p /tmp/java
+    # Check if a Oracle Java version is requested
+    if [[ "${JAVA_VERSION%-oracle}" != "${JAVA_VERSION}" ]]; then
+        JAVA_VERSION="${JAVA_VERSION%-oracle}"
+        JAVA_MAJOR_VERSION="${JAVA_VERSION%%u*}"
+        JAVA_PATCH_LEVEL="${JAVA_VERSION#*u}"
+        [[ -d "/opt/oracle/jre1.${JAVA_MAJOR_VERSION}.0_${JAVA_PATCH_LEVEL}" ]] && \
+        ln -sfn "/opt/oracle/jre1.${JAVA_MAJOR_VERSION}.0_${JAVA_PATCH_LEVEL}" /tmp/java/jre && \
+        # Set the lowest possible security level (the deployment directory is created by hand since initializing it with
+        # `javaws -import` would need the jnlp file and therefore the login to finish first)
+        mkdir -p "/root/.java/deployment" && \
+        echo "deployment.security.level=MEDIUM" >> "/root/.java/deployment/deployment.properties" || return
+        export PATH="/opt/oracle/jre1.${JAVA_MAJOR_VERSION}.0_${JAVA_PATCH_LEVEL}/bin:${PATH}"
+        export JAVA_SECURITY_DIR="/root/.java/deployment/security"
+    else
+        JAVA_VERSION="${JAVA_VERSION%-openjdk}"
+        JAVA_MAJOR_VERSION="${JAVA_VERSION%%u*}"
+        [[ -d "/opt/java/${JAVA_VERSION}" ]] && \
+        ln -sfn "/opt/java/${JAVA_VERSION}/jvm" /tmp/java/jvm && \
+        ln -sfn "/opt/java/${JAVA_VERSION}/etc" /tmp/java/etc || return
+        # Write the settings directly instead of calling `itweb-settings` (which starts a JVM for every setting)
+        mkdir -p "/root/.config/icedtea-web"
+        {
+            echo "deployment.security.level=ALLOW_UNSIGNED"
+            echo "deployment.security.jsse.hostmismatch.warning=false"
+            if [[ "${JAVA_MAJOR_VERSION}" -eq 7 ]]; then
+                echo "deployment.manifest.attributes.check=false"
+            else
+                echo "deployment.manifest.attributes.check=NONE"
+            fi
+            #echo "deployment.security.notinca.warning=false"
+            echo "deployment.security.expired.warning=false"
+        } >> "/root/.config/icedtea-web/deployment.properties"
+        export JAVA_SECURITY_DIR="/root/.config/icedtea-web/security"
+    fi
+    mkdir -p "${JAVA_SECURITY_DIR}"
+    # Store the Java environment for later `kvm-session` calls (shared container mode)
+    echo "export PATH=\"${PATH}\" JAVA_SECURITY_DIR=\"${JAVA_SECURITY_DIR}\"" > /tmp/java.env
+}
+
+# Usage: fetch_kvm_host_certificate <pem file>
+fetch_kvm_host_certificate () {
+    echo | openssl s_client -showcerts -servername ${KVM_HOSTNAME} -connect ${KVM_HOSTNAME}:443 2>/dev/null | \
+        openssl x509 -inform pem -outform pem > "$1"
+}
+
+# Usage: import_certificates <jnlp file> <keystore alias prefix> <kvm host pem file>
+import_certificates () {
+    python /usr/local/bin/import_jnlp_cert.py "$1" "$2_jnlp_certs" "$3"
+}
+
+# Usage: write_vnc_passwords <directory>
+# Writes `<directory>/vnc_passwords` for `x11vnc -passwdfile read:...` (re-read on every connection) from the console
+# password in `<directory>/vnc_password` and the passwords of additional viewers (`kvm-viewer`)
+write_vnc_passwords () {
+    {
+        cat "$1/vnc_password"
+        cat "$1/viewers/"*.full 2>/dev/null
+        # Passwords after this line only grant view-only access
+        echo "__BEGIN_VIEWONLY__"
+        cat "$1/viewers/"*.viewonly 2>/dev/null
+    } > "$1/vnc_passwords.tmp" && \
+    chmod 600 "$1/vnc_passwords.tmp" && \
+    mv "$1/vnc_passwords.tmp" "$1/vnc_passwords"
+}
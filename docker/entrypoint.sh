@@ -1,56 +1,72 @@
 #!/bin/bash
 
-read -r -s PASSWD
-echo "${PASSWD}" | /usr/local/bin/get_java_viewer -o /tmp/launch.jnlp "$@"
-return_code="$?"
-if [[ "${return_code}" -ne 0 ]]; then
-    exit "${return_code}"
+source /usr/local/bin/docker-entrypoint-functions
+
+# In shared mode, the container only hosts the X server stacks of console sessions which are added and removed later
+# with `kvm-session` (`SHARED_SESSIONS` is the maximum number of sessions)
+if [[ -n "${SHARED_SESSIONS}" ]]; then
+    mkdir -p /tmp/sessions
+    # `kvm-session add` waits for the Java installation, so the container must not keep running without it
+    timed install_java install_java || exit
+    exec /usr/bin/supervisord -c /etc/supervisor/supervisord_shared.conf
 fi
 
-# Replace variables in `/etc/supervisord.conf`
-for v in XRES VNC_PASSWD; do
-    eval sed -i "s/{$v}/\$$v/" /etc/supervisor/conf.d/supervisord.conf
-done
-
-# Install needed Java version
-: ${JAVA_VERSION:=7u181}
-# Check if a Oracle Java version is requested
-if [[ "${JAVA_VERSION%-oracle}" != "${JAVA_VERSION}" ]]; then
-    JAVA_VERSION="${JAVA_VERSION%-oracle}"
-    JAVA_MAJOR_VERSION="${JAVA_VERSION%%u*}"
-    JAVA_PATCH_LEVEL="${JAVA_VERSION#*u}"
-    mkdir -p /opt/oracle && \
-    tar -C/opt/oracle/ -xvf "/opt/java_packages/${JAVA_VERSION}/jre-${JAVA_VERSION}-linux-x64.tar.gz" && \
-    ln -s "/opt/oracle/jre1.${JAVA_MAJOR_VERSION}.0_${JAVA_PATCH_LEVEL}/bin/javaws" /usr/local/bin/javaws && \
-    # Set the lowest possible security level
-    # But first, call `import` to init the config directory structure (command will fail without X, but this is OK)
-    javaws -import /tmp/launch.jnlp 2>/dev/null
-    echo "deployment.security.level=MEDIUM" >> "/root/.java/deployment/deployment.properties" || return
-    export PATH="/opt/oracle/jre1.${JAVA_MAJOR_VERSION}.0_${JAVA_PATCH_LEVEL}/bin:${PATH}"
-    export JAVA_SECURITY_DIR="/root/.java/deployment/security"
+# Steps which do not depend on each other run concurrently:
+#
+#   login and jnlp download ----------------------+
+#   kvm host certificate download ---------------+--> certificate import --> noVNC and javaws start
+#   Java installation ---------------------------+
+#   X server, window manager and VNC server start ------------------------/
+#
+# Every step appends its duration to `${TIMING_FILE}`.
+entrypoint_start_time="$(date +%s.%N)"
+
+# Detached containers get the password once through a named pipe on a tmpfs mount (`SECRET_FIFO`) instead of stdin
+if [[ -n "${SECRET_FIFO}" ]]; then
+    mkfifo -m 600 "${SECRET_FIFO}"
+    read -r -s PASSWD < "${SECRET_FIFO}"
+    rm -f "${SECRET_FIFO}"
 else
-    JAVA_VERSION="${JAVA_VERSION%-openjdk}"
-    JAVA_MAJOR_VERSION="${JAVA_VERSION%%u*}"
-    pushd "/opt/java_packages/${JAVA_VERSION}" >/dev/null 2>&1 && \
-    dpkg -i *.deb && \
-    popd >/dev/null 2>&1 && \
-    pushd "/opt/icedtea" >/dev/null 2>&1 && \
-    dpkg -i *.deb && \
-    popd >/dev/null 2>&1
-    itweb-settings set deployment.security.level ALLOW_UNSIGNED
-    itweb-settings set deployment.security.jsse.hostmismatch.warning false
-    if [[ "${JAVA_MAJOR_VERSION}" -eq 7 ]]; then
-        itweb-settings set deployment.manifest.attributes.check false
-    else
-        itweb-settings set deployment.manifest.attributes.check NONE
-    fi
-    #itweb-settings set deployment.security.notinca.warning false
-    itweb-settings set deployment.security.expired.warning false
-    export JAVA_SECURITY_DIR="/root/.config/icedtea-web/security"
+    read -r -s PASSWD
 fi
-mkdir -p "${JAVA_SECURITY_DIR}"
-echo | openssl s_client -showcerts -servername ${KVM_HOSTNAME} -connect ${KVM_HOSTNAME}:443 2>/dev/null | openssl x509 -inform pem -outform pem > /root/cert.pem
-keytool -importcert -noprompt -file /root/cert.pem -keystore "${JAVA_SECURITY_DIR}/trusted.certs" -storepass changeit
-python /usr/local/bin/import_jnlp_cert.py
+echo "${PASSWD}" | timed login /usr/local/bin/get_java_viewer -o /tmp/launch.jnlp "$@" &
+login_pid="$!"
+timed fetch_kvm_host_certificate fetch_kvm_host_certificate /tmp/session_kvm_host.pem &
+certificate_pid="$!"
+
+# Replace variables in a copy of `/etc/supervisor/conf.d/supervisord.conf` in `/tmp` (which is included by
+# `/etc/supervisor/supervisord_dedicated.conf`, so the root filesystem can be read-only); the X server is started with
+# the maximum resolution if its display is resized to the viewer window (`RESIZE_DISPLAY`) and can only shrink below that
+# size
+MAX_XRES="${MAX_XRES:-${XRES}}"
+sed -e "s/{XRES}/${XRES}/" -e "s/{MAX_XRES}/${MAX_XRES}/" /etc/supervisor/conf.d/supervisord.conf > /tmp/supervisord.conf
+( umask 077 && echo "${VNC_PASSWD}" > /tmp/vnc_password ) && write_vnc_passwords /tmp
+# `novnc` and `javaws` are not started automatically, the container is not ready until they run
+/usr/bin/supervisord -c /etc/supervisor/supervisord_dedicated.conf &
+supervisord_pid="$!"
+trap 'kill "${supervisord_pid}"; exit' INT TERM
+
+# Usage: exit_on_failure <return code>
+# Stops the container if a setup step failed, so it is not reported as ready
+exit_on_failure () {
+    if [[ "$1" -ne 0 ]]; then
+        kill "${supervisord_pid}"
+        exit "$1"
+    fi
+}
+
+timed install_java install_java
+exit_on_failure "$?"
+
+wait "${login_pid}"
+exit_on_failure "$?"
+wait "${certificate_pid}"
+exit_on_failure "$?"
+timed import_certificates import_certificates /tmp/launch.jnlp session /tmp/session_kvm_host.pem
+exit_on_failure "$?"
+timed start_viewer supervisorctl -c /etc/supervisor/supervisord_dedicated.conf start novnc javaws
+exit_on_failure "$?"
+awk -v start_time="${entrypoint_start_time}" -v end_time="$(date +%s.%N)" \
+    'BEGIN { printf "total %.3f\n", end_time - start_time }' >> "${TIMING_FILE}"
 
-/usr/bin/supervisord
+wait "${supervisord_pid}"
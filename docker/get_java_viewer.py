@@ -6,11 +6,6 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
-from builtins import *  # noqa: F401,F403  pylint: disable=redefined-builtin,wildcard-import,unused-wildcard-import
-from future import standard_library
-
-standard_library.install_aliases()  # noqa: E402
-
 import argparse
 import codecs
 import getpass
@@ -18,25 +13,29 @@ import logging
 import os
 import re
 import requests
-import urllib.parse
 import sys
 import json
+from io import open  # Python 3 `open` with encoding support (importing `future.builtins` is too slow)
 
 try:
     from typing import Any, Dict, Optional, Text  # noqa: F401  # pylint: disable=unused-import
 except ImportError:
     pass
 
-logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
-if sys.stderr.isatty():
-    logging.addLevelName(logging.INFO, "\033[1;34m%s\033[1;0m" % logging.getLevelName(logging.INFO))
-    logging.addLevelName(logging.ERROR, "\033[1;31m%s\033[1;0m" % logging.getLevelName(logging.ERROR))
+try:
+    from bmc_session import download_java_viewer, login, DownloadFailedError, LoginFailedError
+except ImportError:
+    # Run from a source checkout; the Docker images copy the module of the package next to this script
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "nojava_ipmi_kvm"))
+    from bmc_session import download_java_viewer, login, DownloadFailedError, LoginFailedError
+
+logger = logging.getLogger(__name__)
 
 
 PY2 = sys.version_info.major < 3  # is needed for correct mypy checking
 
 if PY2:
-    str = unicode  # use unicode instead of future `str` since requests cannot handle future `str` well
+    str = unicode  # use unicode strings to handle non-ascii input correctly
     stdin = codecs.getreader("utf-8")(sys.stdin)
 else:
     basestring = str
@@ -73,14 +72,6 @@ class FormatJnlpError(Exception):
     pass
 
 
-class LoginFailedError(Exception):
-    pass
-
-
-class DownloadFailedError(Exception):
-    pass
-
-
 class AttributeDict(dict):
     def __getattr__(self, attr):
         # type: (Text) -> Any
@@ -236,6 +227,14 @@ def read_password():
     return password
 
 
+def setup_logging():
+    # type: () -> None
+    logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+    if sys.stderr.isatty():
+        logging.addLevelName(logging.INFO, "\033[1;34m%s\033[1;0m" % logging.getLevelName(logging.INFO))
+        logging.addLevelName(logging.ERROR, "\033[1;31m%s\033[1;0m" % logging.getLevelName(logging.ERROR))
+
+
 def get_java_viewer(
     hostname,
     skip_login,
@@ -256,64 +255,39 @@ def get_java_viewer(
     # type: (Text, bool, Optional[Text], Text, Text, Text, Text, bool, Text, Text, Optional[Dict[Text, Text]], bool, bool, Optional[Text]) -> None
     if format_jnlp and session_cookie_key is None:
         raise FormatJnlpError("Formatting JNLP file requested but no session cookie key given!")
-    base_url = "https://{}".format(hostname)
-    download_url = urllib.parse.urljoin(base_url, download_endpoint)
     session = requests.Session()
 
-    def do_login(session_cookie_key):
-        # type: (Optional[Text]) -> None
-        assert password is not None
-        login_url = urllib.parse.urljoin(base_url, login_endpoint)
-        data = {user_attribute_name: user, password_attribute_name: password}
-        if extra_form_fields is not None:
-            data.update(extra_form_fields)
-        if use_json:
-            post_data = {"json": data}
-        else:
-            post_data = {"data": data}
-        response = session.post(login_url, verify=ssl_verify, **post_data)
-        if response.status_code == 200 and not any(
-            re.search(r"(session)|(SESSION)", key) for key in session.cookies.keys()
-        ):
-            session_cookie_regex = re.compile(r"'?(\w*(?:session)|(?:SESSION)\w*)'?\s*[:=]\s*'(\w+)'")
-            for line in response.text.split("\n"):
-                match_obj = session_cookie_regex.search(line)
-                if match_obj is not None:
-                    if session_cookie_key is None:
-                        session_cookie_key = match_obj.group(1)
-                    session_cookie_value = match_obj.group(2)
-                    session.cookies.set(session_cookie_key, session_cookie_value)
-                    break
-        if response.status_code != 200 or not session.cookies:
-            raise LoginFailedError("Login to {} was not successful.".format(login_url))
-        session.headers.update({"referer": login_url})  # Some kvms expect the referer header to be present.
-        logging.info("Logged in to {} as {}".format(hostname, user))
-
     # Login to get a session cookie
     if not skip_login:
-        do_login(session_cookie_key)
+        login(
+            session,
+            hostname,
+            user,
+            password,
+            login_endpoint,
+            ssl_verify,
+            user_attribute_name,
+            password_attribute_name,
+            extra_form_fields,
+            use_json,
+            session_cookie_key,
+        )
 
     if session_only:
         print(json.dumps({"cookies": session.cookies.get_dict(), "headers": dict(session.headers)}))
         return
 
     # Download the kvm viewer with the previous created session
-    response = session.get(download_url, verify=ssl_verify)
-    if response.status_code != 200:
-        raise DownloadFailedError("Downloading the ipmi kvm viewer file from {} failed.".format(download_url))
-    logging.info("Successfully downloaded the kvm viewer.")
-    jnlp_filecontent = response.text
-    if format_jnlp:
-        jnlp_filecontent = jnlp_filecontent.format(
-            base_url=base_url, session_key=session.cookies.get(session_cookie_key)
-        )
-        logging.info("Formatted the JNLP file.")
+    jnlp_filecontent = download_java_viewer(
+        session, hostname, download_endpoint, ssl_verify, format_jnlp, session_cookie_key
+    )
     with open(download_location, "w", encoding="utf-8") as f:
         f.write(jnlp_filecontent)
 
 
 def main():
     # type: () -> None
+    setup_logging()
     args = parse_arguments()
     if args.print_version:
         print("{}, version {}".format(os.path.basename(sys.argv[0]), __version__))
@@ -341,7 +315,7 @@ def main():
                 args.session_only,
             )
         except get_java_viewer_exceptions as e:
-            logging.error(str(e))
+            logger.error(str(e))
             for i, exception_class in enumerate(get_java_viewer_exceptions, start=3):
                 if isinstance(e, exception_class):
                     sys.exit(i)
@@ -1,46 +1,292 @@
 #!/usr/bin/env python
 
+import base64
+import fcntl
+import hashlib
 import os
+import re
+import struct
+import subprocess
+import sys
+import time
+import zipfile
+from multiprocessing.pool import ThreadPool
 
 from pyquery import PyQuery as pq
 import requests
 
+MAX_PARALLEL_DOWNLOADS = 8
+# Timeout in seconds of the connection and of each read of a jar download
+DOWNLOAD_TIMEOUT = 60
+KEYSTORE_PASSWORD = "changeit"
+JKS_MAGIC = 0xFEEDFEED
+JKS_VERSION = 2
+JKS_TRUSTED_CERT_TAG = 2
+
 java_security_dir = os.environ["JAVA_SECURITY_DIR"]
+jnlp_filepath = sys.argv[1] if len(sys.argv) > 1 else "/tmp/launch.jnlp"
+alias_prefix = sys.argv[2] if len(sys.argv) > 2 else "jnlp_certs"
+# Additional PEM files (for example the certificate of the kvm host) which are imported in the same keystore write
+extra_pem_filepaths = sys.argv[3:]
+keystore_filepath = os.path.join(java_security_dir, "trusted.certs")
+# Downloaded jar files are only needed to read their signer certificates, they are written next to the jnlp file (in the
+# writable `/tmp` of read-only containers) and deleted afterwards
+download_dir = os.path.dirname(os.path.abspath(jnlp_filepath))
+
+
+class UnsupportedKeystoreError(Exception):
+    pass
+
+
+def report_timing(phase, start_time):
+    duration = time.time() - start_time
+    line = "{} {:.3f}\n".format(phase, duration)
+    sys.stderr.write("Timing: " + line)
+    if "TIMING_FILE" in os.environ:
+        with open(os.environ["TIMING_FILE"], "a") as f:
+            f.write(line)
+
+
+def find_jar_urls(jnlp_filepath):
+    xml = pq(filename=jnlp_filepath)
+    codebase = xml[0].attrib["codebase"]
+    jar_urls = []
+    for jar in xml.find("resources > jar"):
+        pack_enabled = False
+        version_enabled = False
+        props = pq(jar.getparent()).find("property")
+        for prop in props:
+            if prop.get("name") == "jnlp.packEnabled" and prop.get("value") == "true":
+                pack_enabled = True
+            elif prop.get("name") == "jnlp.versionEnabled" and prop.get("value") == "true" and "version" in jar.attrib:
+                version_enabled = True
+
+        if version_enabled:
+            url = codebase + "/" + jar.attrib["href"][:-4] + "__V" + jar.attrib["version"] + ".jar"
+        else:
+            url = codebase + "/" + jar.attrib["href"]
+        if pack_enabled:
+            url = url + ".pack.gz"
+        print("Found jar: " + url)
+        jar_urls.append((url, pack_enabled))
+    return jar_urls
 
-xml = pq(filename="/tmp/launch.jnlp")
-
-codebase = xml[0].attrib["codebase"]
-n = 1
-for jar in xml.find("resources > jar"):
-    pack_enabled = False
-    version_enabled = False
-    props = pq(jar.getparent()).find("property")
-    for prop in props:
-        if prop.get("name") == "jnlp.packEnabled" and prop.get("value") == "true":
-            pack_enabled = True
-        elif prop.get("name") == "jnlp.versionEnabled" and prop.get("value") == "true" and "version" in jar.attrib:
-            version_enabled = True
-
-    if version_enabled:
-        url = codebase + "/" + jar.attrib["href"][:-4] + "__V" + jar.attrib["version"] + ".jar"
-    else:
-        url = codebase + "/" + jar.attrib["href"]
-    if pack_enabled:
-        url = url + ".pack.gz"
-    print("Found jar: " + url)
 
-    contents = requests.get(url, verify=False)
-    add_ext = "" if not pack_enabled else ".pack.gz"
+def get_jar_filepath(n):
+    return os.path.join(download_dir, "{}_{}.jar".format(alias_prefix, n))
 
-    with open("/tmp/jnlp_certs_{}.jar{}".format(n, add_ext), "wb") as f:
-        f.write(contents.content)
+
+def download_jar(session, jar_filepath, url, pack_enabled):
+    contents = session.get(url, verify=False, timeout=DOWNLOAD_TIMEOUT)
     if pack_enabled:
-        os.system("unpack200 /tmp/jnlp_certs_{}.jar.pack.gz /tmp/jnlp_certs_{}.jar".format(n, n))
+        with open(jar_filepath + ".pack.gz", "wb") as f:
+            f.write(contents.content)
+        subprocess.call(["unpack200", jar_filepath + ".pack.gz", jar_filepath])
+        remove_file(jar_filepath + ".pack.gz")
+    else:
+        with open(jar_filepath, "wb") as f:
+            f.write(contents.content)
+
+
+def remove_file(filepath):
+    try:
+        os.remove(filepath)
+    except OSError:
+        pass
+
 
-    os.system("bash -c 'keytool -printcert -jarfile /tmp/jnlp_certs_{}.jar -rfc > /tmp/jnlp_certs_{}.pem'".format(n, n))
-    os.system(
-        "keytool -importcert -noprompt -file /tmp/jnlp_certs_{}.pem -keystore {}/trusted.certs -alias jnlp_certs_{} -storepass changeit".format(
-            n, java_security_dir, n
+def read_signer_certificates(jar_filepath):
+    # Read the signature blocks of the jar file and select the signer certificate (the one certificate which did not
+    # issue another certificate) of each block, like `keytool -printcert -jarfile` followed by `keytool -importcert`
+    # does. `openssl` is used for PKCS#7 parsing since it is much faster to start than a JVM.
+    certificates = []
+    try:
+        with zipfile.ZipFile(jar_filepath) as jar_file:
+            signature_block_names = [
+                name for name in jar_file.namelist() if re.match(r"^META-INF/[^/]+\.(RSA|DSA|EC)$", name, re.I)
+            ]
+            signature_blocks = [jar_file.read(name) for name in signature_block_names]
+    except (IOError, zipfile.BadZipfile):
+        print("Could not read the jar file {}.".format(jar_filepath))
+        return certificates
+    for signature_block in signature_blocks:
+        openssl_process = subprocess.Popen(
+            ["openssl", "pkcs7", "-inform", "DER", "-print_certs"], stdin=subprocess.PIPE, stdout=subprocess.PIPE
         )
-    )
-    n += 1
+        output = openssl_process.communicate(signature_block)[0].decode("utf-8")
+        if openssl_process.returncode != 0:
+            continue
+        chain = []
+        for match_obj in re.finditer(
+            r"subject=(.*?)\n\s*issuer=(.*?)\n-----BEGIN CERTIFICATE-----(.*?)-----END CERTIFICATE-----",
+            output,
+            re.S,
+        ):
+            chain.append((match_obj.group(1).strip(), match_obj.group(2).strip(), match_obj.group(3)))
+        issuers = set(issuer for subject, issuer, _ in chain if subject != issuer)
+        for subject, _, pem_body in chain:
+            if subject not in issuers:
+                certificates.append(base64.b64decode("".join(pem_body.split())))
+                break
+    return certificates
+
+
+def read_pem_certificate(pem_filepath):
+    try:
+        with open(pem_filepath, "r") as f:
+            match_obj = re.search(r"-----BEGIN CERTIFICATE-----(.*?)-----END CERTIFICATE-----", f.read(), re.S)
+    except IOError:
+        match_obj = None
+    if match_obj is None:
+        print("No certificate found in {}.".format(pem_filepath))
+        return None
+    return base64.b64decode("".join(match_obj.group(1).split()))
+
+
+def read_utf(data, offset):
+    (length,) = struct.unpack(">H", data[offset : offset + 2])
+    return data[offset + 2 : offset + 2 + length].decode("utf-8"), offset + 2 + length
+
+
+def write_utf(value):
+    encoded_value = value.encode("utf-8")
+    return struct.pack(">H", len(encoded_value)) + encoded_value
+
+
+def keystore_digest(data):
+    password_bytes = b"".join(struct.pack(">H", ord(c)) for c in KEYSTORE_PASSWORD)
+    return hashlib.sha1(password_bytes + b"Mighty Aphrodite" + data).digest()
+
+
+def read_keystore(keystore_filepath):
+    # Returns a list of `(alias, timestamp, certificate)` tuples of a JKS keystore containing trusted certificates only
+    if not os.path.isfile(keystore_filepath):
+        return []
+    with open(keystore_filepath, "rb") as f:
+        data = f.read()
+    if len(data) < 32 or keystore_digest(data[:-20]) != data[-20:]:
+        raise UnsupportedKeystoreError("{} is not a valid JKS keystore.".format(keystore_filepath))
+    magic, version, count = struct.unpack(">III", data[:12])
+    if magic != JKS_MAGIC or version != JKS_VERSION:
+        raise UnsupportedKeystoreError("{} is not a JKS keystore of version 2.".format(keystore_filepath))
+    entries = []
+    offset = 12
+    for _ in range(count):
+        (tag,) = struct.unpack(">I", data[offset : offset + 4])
+        if tag != JKS_TRUSTED_CERT_TAG:
+            raise UnsupportedKeystoreError("{} contains other entries than certificates.".format(keystore_filepath))
+        alias, offset = read_utf(data, offset + 4)
+        (timestamp,) = struct.unpack(">Q", data[offset : offset + 8])
+        certificate_type, offset = read_utf(data, offset + 8)
+        (certificate_length,) = struct.unpack(">I", data[offset : offset + 4])
+        certificate = data[offset + 4 : offset + 4 + certificate_length]
+        offset += 4 + certificate_length
+        entries.append((alias, timestamp, certificate))
+    return entries
+
+
+def write_keystore(keystore_filepath, entries):
+    data = struct.pack(">III", JKS_MAGIC, JKS_VERSION, len(entries))
+    for alias, timestamp, certificate in entries:
+        data += struct.pack(">I", JKS_TRUSTED_CERT_TAG) + write_utf(alias.lower()) + struct.pack(">Q", timestamp)
+        data += write_utf("X.509") + struct.pack(">I", len(certificate)) + certificate
+    data += keystore_digest(data)
+    temp_keystore_filepath = keystore_filepath + ".tmp"
+    with open(temp_keystore_filepath, "wb") as f:
+        f.write(data)
+    os.rename(temp_keystore_filepath, keystore_filepath)
+
+
+def import_certificates_with_keytool(keystore_filepath, certificates):
+    # Fallback for keystores which cannot be handled by `write_keystore`
+    for alias, certificate in certificates:
+        pem_filepath = os.path.join(download_dir, "{}.pem".format(alias))
+        with open(pem_filepath, "w") as f:
+            f.write("-----BEGIN CERTIFICATE-----\n")
+            encoded_certificate = base64.b64encode(certificate).decode("ascii")
+            for i in range(0, len(encoded_certificate), 64):
+                f.write(encoded_certificate[i : i + 64] + "\n")
+            f.write("-----END CERTIFICATE-----\n")
+        subprocess.call(
+            [
+                "keytool",
+                "-importcert",
+                "-noprompt",
+                "-file",
+                pem_filepath,
+                "-keystore",
+                keystore_filepath,
+                "-alias",
+                alias,
+                "-storepass",
+                KEYSTORE_PASSWORD,
+            ]
+        )
+        remove_file(pem_filepath)
+
+
+def main():
+    start_time = time.time()
+    jar_urls = find_jar_urls(jnlp_filepath)
+    report_timing("jnlp_certs.parse_jnlp", start_time)
+
+    start_time = time.time()
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=MAX_PARALLEL_DOWNLOADS)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    pool = ThreadPool(max(1, min(MAX_PARALLEL_DOWNLOADS, len(jar_urls))))
+    # The paths are known before the download, so partially written files are removed if a download fails
+    jar_filepaths = [get_jar_filepath(n) for n in range(1, len(jar_urls) + 1)]
+    try:
+        pool.map(
+            lambda args: download_jar(session, *args),
+            [(jar_filepath, url, pack_enabled) for jar_filepath, (url, pack_enabled) in zip(jar_filepaths, jar_urls)],
+        )
+        report_timing("jnlp_certs.download", start_time)
+
+        start_time = time.time()
+        jar_certificates = pool.map(read_signer_certificates, jar_filepaths)
+        report_timing("jnlp_certs.extract", start_time)
+    finally:
+        pool.close()
+        for jar_filepath in jar_filepaths:
+            remove_file(jar_filepath)
+            remove_file(jar_filepath + ".pack.gz")
+
+    start_time = time.time()
+    certificates = []
+    for pem_filepath in extra_pem_filepaths:
+        certificate = read_pem_certificate(pem_filepath)
+        if certificate is not None:
+            certificates.append((os.path.splitext(os.path.basename(pem_filepath))[0], certificate))
+    seen_fingerprints = set(hashlib.sha256(certificate).hexdigest() for _, certificate in certificates)
+    for certificate in (certificate for certificates_of_jar in jar_certificates for certificate in certificates_of_jar):
+        fingerprint = hashlib.sha256(certificate).hexdigest()
+        if fingerprint not in seen_fingerprints:
+            seen_fingerprints.add(fingerprint)
+            certificates.append(("{}_{}".format(alias_prefix, fingerprint[:16]), certificate))
+    # Concurrent imports (shared container sessions) must not overwrite each other's keystore changes
+    lock_file = open(keystore_filepath + ".lock", "w")
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    try:
+        entries = read_keystore(keystore_filepath)
+        known_fingerprints = set(hashlib.sha256(certificate).hexdigest() for _, _, certificate in entries)
+        timestamp = int(time.time() * 1000)
+        entries.extend(
+            (alias, timestamp, certificate)
+            for alias, certificate in certificates
+            if hashlib.sha256(certificate).hexdigest() not in known_fingerprints
+        )
+        write_keystore(keystore_filepath, entries)
+    except UnsupportedKeystoreError as e:
+        print("{} Falling back to `keytool`.".format(e))
+        import_certificates_with_keytool(keystore_filepath, certificates)
+    finally:
+        lock_file.close()
+    print("Imported {} certificate(s) into {}.".format(len(certificates), keystore_filepath))
+    report_timing("jnlp_certs.import", start_time)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,15 +9,42 @@ const http = require('http'),
 
 const { execFileSync } = require('child_process');
 
-// Read options and password
+// Messages below `LOG_LEVEL` (`debug`, `info`, `warn` or `error`, default: `info`) are dropped; `console` calls are
+// synchronous for pipes, so per-request messages are only written at the `debug` level
+const LOG_LEVELS = {debug: 0, info: 1, warn: 2, error: 3};
+const LOG_LEVEL = LOG_LEVELS[process.env.LOG_LEVEL] !== undefined ? LOG_LEVELS[process.env.LOG_LEVEL] : LOG_LEVELS.info;
+const DEBUG = LOG_LEVEL <= LOG_LEVELS.debug;
+const log = {
+  debug: DEBUG ? console.log : () => {},
+  info: LOG_LEVEL <= LOG_LEVELS.info ? console.log : () => {},
+  warn: LOG_LEVEL <= LOG_LEVELS.warn ? console.warn : () => {},
+  error: console.error,
+};
+
+// Read options and password; detached containers get them once through a named pipe on a tmpfs mount (`SECRET_FIFO`)
+// instead of stdin
 const fs = require('fs');
-const config = JSON.parse(fs.readFileSync(0, 'utf-8'));
 
-console.log("Config:", config);
+function readConfig() {
+  const secretFifo = process.env.SECRET_FIFO;
+  if (!secretFifo) {
+    return fs.readFileSync(0, 'utf-8');
+  }
+  execFileSync('mkfifo', ['-m', '600', secretFifo]);
+  try {
+    return fs.readFileSync(secretFifo, 'utf-8');
+  } finally {
+    fs.unlinkSync(secretFifo);
+  }
+}
+
+const config = JSON.parse(readConfig());
+
+log.debug("Config:", Object.assign({}, config, {kvm_password: "***"}));
 
 // Check config:
 if (!("kvm_password" in config && "kvm_host" in config)) {
-  console.error("Error: Configuration is invalid.");
+  log.error("Error: Configuration is invalid.");
   process.exit(1);
 }
 
@@ -32,20 +59,56 @@ let session_data = execFileSync("/usr/bin/python2", get_java_viewer_args, {
   stdio: [null, 'pipe', 'inherit'], // disable info logging to session_data string
 }).trim();
 let session = JSON.parse(session_data)
-console.log("Acquired session using get_java_viewer.");
+log.info("Acquired session using get_java_viewer.");
+
+// Additional viewers (added with `kvm-viewer`) have their own values of the authorization cookie. They are listed in
+// `VIEWERS_FILE` (one `<viewer id> <value>` line per viewer) which is reloaded on `SIGUSR2`.
+const VIEWERS_FILE = '/tmp/viewers';
+let viewerAuthorizationValues = new Set();
+
+function loadViewers() {
+  let lines = [];
+  try {
+    lines = fs.readFileSync(VIEWERS_FILE, 'utf-8').split('\n');
+  } catch (e) {
+    if (e.code !== 'ENOENT') {
+      log.error("Cannot read the viewers file:", e.message);
+      return;
+    }
+  }
+  viewerAuthorizationValues = new Set(lines.filter((line) => line.includes(' ')).map((line) => line.split(' ', 2)[1]));
+  log.info(`Loaded ${viewerAuthorizationValues.size} additional viewers.`);
+}
+
+process.on('SIGUSR2', loadViewers);
 
 // Define functions used multiple times
 
+const AUTHORIZATION = "authorization" in config ? config.authorization : null;
+
+// Returns the (not decoded) value of the first cookie `name` in `cookieStr` like `cookie.parse`, or `undefined`
+function getCookieValue(cookieStr, name) {
+  for (const pair of cookieStr.split(';')) {
+    const eqIdx = pair.indexOf('=');
+    if (eqIdx !== -1 && pair.slice(0, eqIdx).trim() === name) {
+      let value = pair.slice(eqIdx + 1).trim();
+      if (value.length > 1 && value[0] === '"' && value[value.length - 1] === '"') {
+        value = value.slice(1, -1);
+      }
+      return value;
+    }
+  }
+  return undefined;
+}
 
-function checkAuthorization(req, socket) {
-  if (!("authorization" in config)) {
+function checkAuthorization(cookieStr, socket) {
+  if (AUTHORIZATION === null) {
     return true;
   }
 
-  let cookies = req.headers['cookie'];
-  if (cookies) {
-    cookies = cookie.parse(cookies, {decode: (x) => x}); // Do not decode cookies using decodeURIComponent
-    if (config.authorization.key in cookies && cookies[config.authorization.key] == config.authorization.value) {
+  if (cookieStr) {
+    const value = getCookieValue(cookieStr, AUTHORIZATION.key);
+    if (value !== undefined && (value == AUTHORIZATION.value || viewerAuthorizationValues.has(value))) {
       return true;
     }
   }
@@ -65,23 +128,42 @@ You are not authorized to use this service.`
   return false;
 }
 
+// The session cookies are the same for all requests, so their serialization (without encoding) is computed once
+const SESSION_COOKIE_NAMES = new Set(Object.keys(session.cookies));
+const SESSION_COOKIE_STRING = Object.entries(session.cookies)
+  .map((entry) => cookie.serialize(entry[0], entry[1], {encode: (x) => x}))
+  .join('; ');
+
 // This function replaces/inserts all cookies from the session into the cookieStr and returns the modified string
 function updateCookieString(cookieStr) {
-  // parse cookiestring without decoding of url components into a dictionary
-  let cookies = cookie.parse(cookieStr, {decode: (x) => x});
-
-  // Overwrite cookies with session cookies
-  cookies = Object.assign(cookies, session.cookies);
-
-  // Convert them back without actually encoding strings.
-  return Object.entries(cookies).map((entry) => cookie.serialize(entry[0], entry[1], {encode: (x) => x})).join('; ');
+  if (!cookieStr) {
+    return SESSION_COOKIE_STRING;
+  }
+  // Keep all cookies of the browser which are not overwritten by session cookies
+  const pairs = cookieStr.split(';').filter((pair) => {
+    const eqIdx = pair.indexOf('=');
+    return eqIdx !== -1 && !SESSION_COOKIE_NAMES.has(pair.slice(0, eqIdx).trim());
+  });
+  if (pairs.length === 0) {
+    return SESSION_COOKIE_STRING;
+  }
+  return pairs.map((pair) => pair.trim()).join('; ') + (SESSION_COOKIE_STRING ? '; ' + SESSION_COOKIE_STRING : '');
 }
 
 const PROXY_TO = config.kvm_host;
 const PROXY_PORT = 8080;
 
+// The referer of proxied requests points to the kvm host instead of the proxy; the origin of the kvm host is computed
+// once and replaces the origin of referer urls
+const PROXY_TO_ORIGIN = new url.URL(PROXY_TO).origin;
+const ORIGIN_REGEX = /^[a-z][a-z0-9+.-]*:\/\/[^/?#]*/i;
 
-console.log(`Starting proxy on ${PROXY_PORT}`);
+function rewriteReferer(referer) {
+  return referer.replace(ORIGIN_REGEX, PROXY_TO_ORIGIN);
+}
+
+
+log.info(`Starting proxy on ${PROXY_PORT}`);
 var app = connect(); // connect is a stack of handler functions
 var proxy = new httpProxy.createProxyServer({
   target: PROXY_TO,
@@ -95,10 +177,12 @@ if ("rewrites" in config) {
   config.rewrites.forEach((rewrite) => {
     let matchRegex = RegExp(rewrite.search);
     let pathRegex = RegExp(rewrite.path_match);
-    console.log("Inserting replacer: (path:", pathRegex, ") match:", matchRegex, "replace:", rewrite.replace);
+    log.info("Inserting replacer: (path:", pathRegex, ") match:", matchRegex, "replace:", rewrite.replace);
 
     app.use(transformerProxy((data, req, res) => {
-      console.log("Rewrote request to", req.url);
+      if (DEBUG) {
+        log.debug("Rewrote request to", req.url);
+      }
       return Buffer.from(data.toString('utf8').replace(matchRegex, rewrite.replace), 'utf8');
     }, {match: pathRegex}));
   })
@@ -106,49 +190,35 @@ if ("rewrites" in config) {
 
 // Proxy normal requests
 app.use(function (req, res) {
-  // if authorization is failed, request is sent a 401
-  if (!checkAuthorization(req, res)) {
-    return;
-  }
-
-  // Find Cookie Header in raw Headers or create a new one
+  // Find the Cookie and Referer headers in one pass over the raw headers (which are forwarded with their case)
+  const rawHeaders = req.rawHeaders;
   let cookieIdx = -1;
-  for (let i = 0; i < req.rawHeaders.length; i += 2) {
-    if (req.rawHeaders[i].toLowerCase() == 'cookie') {
+  let refererIdx = -1;
+  for (let i = 0; i < rawHeaders.length; i += 2) {
+    const name = rawHeaders[i];
+    if (cookieIdx === -1 && name.length === 6 && name.toLowerCase() === 'cookie') {
       cookieIdx = i + 1;
-      break;
+    } else if (refererIdx === -1 && name.length === 7 && name.toLowerCase() === 'referer') {
+      refererIdx = i + 1;
     }
   }
 
-  // if cookie header was not found, create one
-  if (cookieIdx === -1) {
-    cookieIdx = req.rawHeaders.length + 1;
-    req.rawHeaders.push('Cookie');
-    req.rawHeaders.push('');
+  // if authorization is failed, request is sent a 401
+  if (!checkAuthorization(cookieIdx !== -1 ? rawHeaders[cookieIdx] : undefined, res)) {
+    return;
   }
 
-  // Add session to request
-  req.rawHeaders[cookieIdx] = updateCookieString(req.rawHeaders[cookieIdx]);
-
-  let refererIdx = -1;
-  for (let i = 0; i < req.rawHeaders.length; i += 2) {
-    if (req.rawHeaders[i].toLowerCase() == 'referer') {
-      refererIdx = i + 1;
-      break;
-    }
+  // Add session to request; if cookie header was not found, create one
+  if (cookieIdx !== -1) {
+    rawHeaders[cookieIdx] = updateCookieString(rawHeaders[cookieIdx]);
+  } else {
+    rawHeaders.push('Cookie', SESSION_COOKIE_STRING);
   }
 
-  if (refererIdx != -1) {
-    let currUrl = new url.URL(req.rawHeaders[refererIdx]);
-    let newUrl = new url.URL(PROXY_TO);
-    currUrl.protocol = newUrl.protocol;
-    currUrl.hostname = newUrl.hostname;
-    currUrl.port = newUrl.port;
-    currUrl.auth = newUrl.auth;
-    req.rawHeaders[refererIdx] = currUrl.href;
+  if (refererIdx !== -1) {
+    rawHeaders[refererIdx] = rewriteReferer(rawHeaders[refererIdx]);
   }
 
-
   // pass the request
   proxy.web(req, res);
 });
@@ -162,7 +232,7 @@ var proxyServer = http.createServer(app);
 //
 proxyServer.on('upgrade', function (req, socket, head) {
   // if authorization is failed, request is sent a 401
-  if (checkAuthorization(req, socket)) {
+  if (checkAuthorization(req.headers['cookie'], socket)) {
     proxy.ws(req, socket, head);
   }
 });
@@ -173,25 +243,19 @@ proxy.on('proxyReqWs', (proxyReq, req, socket, options, head) => {
 
   let referer = proxyReq.getHeader("Referer");
   if (referer) {
-    let currUrl = new url.URL(referer);
-    let newUrl = new url.URL(PROXY_TO);
-    currUrl.protocol = newUrl.protocol;
-    currUrl.hostname = newUrl.hostname;
-    currUrl.port = newUrl.port;
-    currUrl.auth = newUrl.auth;
-    proxyReq.setHeader("Referer", currUrl.href);
+    proxyReq.setHeader("Referer", rewriteReferer(referer));
   }
 });
 
 // Basic error logging
 proxy.on('error', function (e,req){
   if(e){
-    console.error(e.message);
-    console.log(req.headers.host,'-->',PROXY_TO);
-    console.log('-----');
+    log.error(e.message);
+    log.error(req.headers.host,'-->',PROXY_TO);
+    log.error('-----');
   }
 });
 
 proxyServer.listen(PROXY_PORT);
 
-console.log("Proxy is listening");
+log.info("Proxy is listening");
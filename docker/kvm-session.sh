@@ -0,0 +1,175 @@
+#!/bin/bash
+
+# Manages console sessions of a shared container (started with `SHARED_SESSIONS=<max session count>`)
+#
+# Usage: kvm-session add <get_java_viewer args>  (login password on stdin, `XRES`, `VNC_PASSWD` and `KVM_HOSTNAME` as
+#                                                 environment variables, optionally `RESIZE_DISPLAY`,
+#                                                 `MIN_XRES` and `MAX_XRES`; prints the session number)
+#        kvm-session remove <session number>     (prints the number of remaining sessions)
+#        kvm-session count                       (prints the number of sessions)
+#
+# Session `n` uses the X display `:n`, the VNC port `5900 + n` and the noVNC web port `8080 + n`.
+
+source /usr/local/bin/docker-entrypoint-functions
+
+SESSIONS_DIR="/tmp/sessions"
+SUPERVISORCTL=( supervisorctl -c /etc/supervisor/supervisord_shared.conf )
+
+count_sessions () {
+    find "${SESSIONS_DIR}" -mindepth 1 -maxdepth 1 -type d | wc -l
+}
+
+# Frees a session slot again: removes the supervisord configuration (and its programs if it was already loaded with
+# `update`) and the session directory
+discard_session () {
+    local session loaded
+
+    session="$1"
+    loaded="$2"
+    rm -f "${SESSIONS_DIR}/${session}.conf" "${SESSIONS_DIR}/${session}.conf.tmp"
+    if [[ -n "${loaded}" ]]; then
+        "${SUPERVISORCTL[@]}" update >&2
+    fi
+    rm -rf "${SESSIONS_DIR:?}/${session}"
+}
+
+add_session () {
+    local session javaws_command certificate_pid certificate_return_code return_code
+
+    # Wait for the Java installation of the container entrypoint
+    while [[ ! -f /tmp/java.env ]]; do
+        sleep 0.2
+    done
+    source /tmp/java.env
+
+    # `mkdir` is atomic, so concurrent calls cannot claim the same session number
+    for (( session=0; session < SHARED_SESSIONS; ++session )); do
+        mkdir "${SESSIONS_DIR}/${session}" 2>/dev/null && break
+    done
+    if (( session >= SHARED_SESSIONS )); then
+        >&2 echo "All ${SHARED_SESSIONS} sessions of this container are in use."
+        return 10
+    fi
+
+    TIMING_FILE="${SESSIONS_DIR}/${session}/timings"
+    read -r -s PASSWD
+    timed fetch_kvm_host_certificate fetch_kvm_host_certificate \
+        "${SESSIONS_DIR}/${session}/session_${session}_kvm_host.pem" &
+    certificate_pid="$!"
+    echo "${PASSWD}" | \
+        timed login /usr/local/bin/get_java_viewer -o "${SESSIONS_DIR}/${session}/launch.jnlp" "$@" >&2
+    return_code="$?"
+    wait "${certificate_pid}"
+    certificate_return_code="$?"
+    if [[ "${return_code}" -eq 0 ]]; then
+        return_code="${certificate_return_code}"
+    fi
+    if [[ "${return_code}" -ne 0 ]]; then
+        discard_session "${session}"
+        return "${return_code}"
+    fi
+    timed import_certificates import_certificates "${SESSIONS_DIR}/${session}/launch.jnlp" "session_${session}" \
+        "${SESSIONS_DIR}/${session}/session_${session}_kvm_host.pem" >&2
+    return_code="$?"
+    if [[ "${return_code}" -ne 0 ]]; then
+        discard_session "${session}"
+        return "${return_code}"
+    fi
+
+    ( umask 077 && echo "${VNC_PASSWD}" > "${SESSIONS_DIR}/${session}/vnc_password" ) && \
+        write_vnc_passwords "${SESSIONS_DIR}/${session}"
+    return_code="$?"
+    if [[ "${return_code}" -ne 0 ]]; then
+        discard_session "${session}"
+        return "${return_code}"
+    fi
+
+    # Reuse the `javaws` command line of the single session configuration
+    javaws_command="$(awk '/^\[program:javaws\]/ { f=1 } f && /^command=/ { sub(/^command=/, ""); print; exit }' \
+                          /etc/supervisor/conf.d/supervisord.conf)"
+    javaws_command="${javaws_command//\/tmp\/launch.jnlp/${SESSIONS_DIR}/${session}/launch.jnlp}"
+
+    # The configuration is written next to the include pattern and renamed when complete, so that an `update` of a
+    # concurrent call never loads a partial configuration
+    cat > "${SESSIONS_DIR}/${session}.conf.tmp" <<-EOCONF
+	[group:session_${session}]
+	programs=X11_${session},fluxbox_${session},x11vnc_${session},novnc_${session},javaws_${session}
+
+	[program:X11_${session}]
+	command=/usr/bin/Xvfb :${session} -screen 0 ${MAX_XRES:-${XRES}}x24 -fbdir ${SESSIONS_DIR}/${session}
+	autorestart=true
+	priority=1
+
+	[program:fluxbox_${session}]
+	command=/usr/bin/fluxbox
+	environment=DISPLAY=":${session}"
+	autorestart=true
+	priority=2
+
+	[program:x11vnc_${session}]
+	command=/usr/bin/x11vnc -display :${session} -rfbport $(( 5900 + session )) -passwdfile read:${SESSIONS_DIR}/${session}/vnc_passwords -shared -forever -repeat -xrandr
+	autorestart=true
+	priority=3
+
+	[program:novnc_${session}]
+	command=novnc-server /opt/noVNC-1.1.0 $(( 8080 + session )) $(( 5900 + session )) ${SESSIONS_DIR}/${session}/Xvfb_screen0 ${SESSIONS_DIR}/${session}/vnc_passwords
+	environment=DISPLAY=":${session}",RESIZE_DISPLAY="${RESIZE_DISPLAY}",MIN_XRES="${MIN_XRES}",MAX_XRES="${MAX_XRES}"
+	autorestart=true
+	priority=4
+
+	[program:javaws_${session}]
+	command=${javaws_command}
+	environment=DISPLAY=":${session}"
+	autorestart=true
+	priority=5
+	EOCONF
+    return_code="$?"
+    if [[ "${return_code}" -eq 0 ]]; then
+        mv "${SESSIONS_DIR}/${session}.conf.tmp" "${SESSIONS_DIR}/${session}.conf"
+        return_code="$?"
+    fi
+    if [[ "${return_code}" -ne 0 ]]; then
+        discard_session "${session}"
+        return "${return_code}"
+    fi
+    timed start_viewer "${SUPERVISORCTL[@]}" update >&2
+    return_code="$?"
+    if [[ "${return_code}" -ne 0 ]]; then
+        discard_session "${session}" loaded
+        return "${return_code}"
+    fi
+    echo "${session}"
+}
+
+remove_session () {
+    local session
+
+    session="$1"
+    [[ "${session}" =~ ^[0-9]+$ ]] || return 1
+    discard_session "${session}" loaded
+    count_sessions
+}
+
+main () {
+    local command
+
+    command="$1"
+    shift
+    case "${command}" in
+        add)
+            add_session "$@"
+            ;;
+        remove)
+            remove_session "$@"
+            ;;
+        count)
+            count_sessions
+            ;;
+        *)
+            >&2 echo "Unknown command \"${command}\"."
+            return 1
+            ;;
+    esac
+}
+
+main "$@"
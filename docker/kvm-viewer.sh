@@ -0,0 +1,107 @@
+#!/bin/bash
+
+# Manages additional viewers of a running kvm console, so several people can watch the same console session
+#
+# Usage: kvm-viewer add [--view-only] <viewer id> [<session number>]  (viewer password or authorization value on stdin)
+#        kvm-viewer remove <viewer id> [<session number>]
+#
+# Java consoles: every viewer gets its own VNC password for the shared x11vnc server (of the given session in shared
+# containers); view-only viewers cannot send keyboard or mouse events.
+# HTML5 consoles: every viewer gets its own value for the authorization cookie of the proxy (view-only viewers are not
+# supported since the proxy cannot filter input events of the HTML5 viewer).
+
+HTML5_VIEWERS_FILE="/tmp/viewers"
+
+get_java_console_directory () {
+    if [[ -n "$1" ]]; then
+        [[ "$1" =~ ^[0-9]+$ ]] || return 1
+        echo "/tmp/sessions/$1"
+    else
+        echo "/tmp"
+    fi
+}
+
+add_viewer () {
+    local view_only viewer_id secret directory access
+
+    view_only=0
+    if [[ "$1" == "--view-only" ]]; then
+        view_only=1
+        shift
+    fi
+    viewer_id="$1"
+    [[ "${viewer_id}" =~ ^[0-9a-zA-Z]+$ ]] || return 1
+    read -r -s secret
+    if [[ -d /usr/local/kvm-html5 ]]; then
+        if (( view_only )); then
+            >&2 echo "View-only viewers are not supported for HTML5 consoles."
+            return 2
+        fi
+        ( umask 077 && echo "${viewer_id} ${secret}" >> "${HTML5_VIEWERS_FILE}" ) || return
+        # The proxy (pid 1) reloads the viewers file on `SIGUSR2`
+        kill -USR2 1
+    else
+        directory="$(get_java_console_directory "$2")" || return
+        [[ -f "${directory}/vnc_password" ]] || return 1
+        if (( view_only )); then
+            access="viewonly"
+        else
+            access="full"
+        fi
+        mkdir -p "${directory}/viewers" && \
+        ( umask 077 && echo "${secret}" > "${directory}/viewers/${viewer_id}.${access}" ) && \
+        with_lock "${directory}" write_vnc_passwords "${directory}"
+    fi
+}
+
+remove_viewer () {
+    local viewer_id directory
+
+    viewer_id="$1"
+    [[ "${viewer_id}" =~ ^[0-9a-zA-Z]+$ ]] || return 1
+    if [[ -d /usr/local/kvm-html5 ]]; then
+        [[ -f "${HTML5_VIEWERS_FILE}" ]] || return 0
+        sed -i "/^${viewer_id} /d" "${HTML5_VIEWERS_FILE}" && \
+        kill -USR2 1
+    else
+        directory="$(get_java_console_directory "$2")" || return
+        rm -f "${directory}/viewers/${viewer_id}".* && \
+        with_lock "${directory}" write_vnc_passwords "${directory}"
+    fi
+}
+
+# Usage: with_lock <directory> <command> [<args>...]
+# Serializes concurrent rewrites of the password file of a console
+with_lock () {
+    local directory
+
+    directory="$1"
+    shift
+    (
+        flock 9 && "$@"
+    ) 9> "${directory}/viewers.lock"
+}
+
+main () {
+    local command
+
+    if [[ ! -d /usr/local/kvm-html5 ]]; then
+        source /usr/local/bin/docker-entrypoint-functions
+    fi
+    command="$1"
+    shift
+    case "${command}" in
+        add)
+            add_viewer "$@"
+            ;;
+        remove)
+            remove_viewer "$@"
+            ;;
+        *)
+            >&2 echo "Unknown command \"${command}\"."
+            return 1
+            ;;
+    esac
+}
+
+main "$@"
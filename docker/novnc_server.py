@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+# noVNC web server (websockify) with an additional `/snapshot.png` endpoint which serves a downscaled image of the Xvfb
+# framebuffer (for example for console thumbnails of a dashboard) without a VNC connection.
+#
+# Usage: novnc-server <web root> <listen port> <vnc port> <framebuffer file> <vnc password file>
+#
+# The framebuffer file is written by `Xvfb -fbdir` (XWD format). Snapshots need one of the VNC passwords of the console
+# as `password` query parameter (like the noVNC url) and accept an optional `width` parameter. Every request is handled
+# in its own process, so snapshots are cached in files: a new snapshot is grabbed at most every `SNAPSHOT_MAX_AGE`
+# seconds per width and concurrent requests wait for the same grab.
+#
+# If `RESIZE_DISPLAY` is set, `vnc.html` reports the size of the browser window to `/resize` when it is loaded and
+# resized, and the X server (`DISPLAY`) is resized with RandR to this size (limited to `MIN_XRES` and `MAX_XRES`), so
+# the framebuffer matches the visible pixels instead of being scaled. The X server must be started with `MAX_XRES` since
+# Xvfb cannot grow its screen.
+
+import fcntl
+import hmac
+import logging
+import os
+import re
+import struct
+import subprocess
+import sys
+import time
+import zlib
+
+import numpy
+from websockify.websocketproxy import ProxyRequestHandler, WebSocketProxy
+
+try:
+    from urllib.parse import parse_qs, urlsplit
+except ImportError:
+    from urlparse import parse_qs, urlsplit
+
+SNAPSHOT_MAX_AGE = 2.0
+DEFAULT_SNAPSHOT_WIDTH = 320
+MIN_SNAPSHOT_WIDTH = 32
+MAX_SNAPSHOT_WIDTH = 1920
+# Requested widths are rounded to a multiple of this value to limit the number of cached snapshots
+SNAPSHOT_WIDTH_STEP = 32
+XWD_HEADER = struct.Struct(">25I")
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+VIEW_ONLY_SEPARATOR = "__BEGIN_VIEWONLY__"
+RESIZE_SCRIPT = b"""(function () {
+    var params = new URLSearchParams(window.location.search);
+    var password = params.get("password");
+    var timer = null;
+    if (!password || params.get("view_only") === "true") {
+        return;
+    }
+    function requestResize() {
+        var request = new XMLHttpRequest();
+        timer = null;
+        request.open(
+            "POST",
+            "resize?password=" + encodeURIComponent(password) + "&width=" + window.innerWidth + "&height=" +
+                window.innerHeight
+        );
+        request.send();
+    }
+    window.addEventListener("resize", function () {
+        // Only the final size of interactive resizes is applied
+        if (timer !== null) {
+            clearTimeout(timer);
+        }
+        timer = setTimeout(requestResize, 250);
+    });
+    requestResize();
+})();
+"""
+
+web_root, listen_port, vnc_port, framebuffer_filepath, password_filepath = sys.argv[1:6]
+display_size_filepath = os.path.join(os.path.dirname(framebuffer_filepath), "display_size")
+resize_display = bool(os.environ.get("RESIZE_DISPLAY"))
+
+
+def parse_resolution(resolution):
+    match = re.match(r"^([1-9][0-9]*)x([1-9][0-9]*)$", resolution or "")
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+
+def read_display_size():
+    # Returns the size set by the last resize or `None` if the display was not resized
+    try:
+        with open(display_size_filepath, "r") as f:
+            return parse_resolution(f.read().strip())
+    except (IOError, OSError):
+        return None
+
+
+def resize_display_to(width, height):
+    min_width, min_height = parse_resolution(os.environ.get("MIN_XRES")) or (1, 1)
+    max_width, max_height = parse_resolution(os.environ.get("MAX_XRES")) or parse_resolution(os.environ["XRES"])
+    width = min(max_width, max(min_width, width))
+    height = min(max_height, max(min_height, height))
+    with open(display_size_filepath + ".lock", "w") as lock_file:
+        # Concurrent resizes of several viewers are applied in order, the last one wins
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if read_display_size() == (width, height):
+            return
+        subprocess.check_call(["xrandr", "--fb", "{:d}x{:d}".format(width, height)])
+        with open(display_size_filepath + ".tmp", "w") as f:
+            f.write("{:d}x{:d}\n".format(width, height))
+        os.rename(display_size_filepath + ".tmp", display_size_filepath)
+
+
+def read_framebuffer(filepath):
+    # Returns the framebuffer as RGB array
+    with open(filepath, "rb") as f:
+        data = f.read()
+    (
+        header_size,
+        _,
+        _,
+        _,
+        width,
+        height,
+        _,
+        byte_order,
+        _,
+        _,
+        _,
+        bits_per_pixel,
+        bytes_per_line,
+        _,
+        red_mask,
+        green_mask,
+        blue_mask,
+        _,
+        _,
+        colormap_entry_count,
+    ) = XWD_HEADER.unpack_from(data)[:20]
+    if bits_per_pixel != 32:
+        raise ValueError("Unsupported framebuffer format ({} bits per pixel).".format(bits_per_pixel))
+    pixels = numpy.frombuffer(
+        data,
+        dtype="<u4" if byte_order == 0 else ">u4",
+        count=height * bytes_per_line // 4,
+        offset=header_size + colormap_entry_count * 12,
+    ).reshape(height, bytes_per_line // 4)[:, :width]
+    # A resized Xvfb keeps its screen buffer and only uses its upper left part
+    display_size = read_display_size()
+    if display_size is not None:
+        width, height = min(width, display_size[0]), min(height, display_size[1])
+        pixels = pixels[:height, :width]
+    rgb = numpy.empty((height, width, 3), dtype=numpy.uint8)
+    for channel, mask in enumerate((red_mask, green_mask, blue_mask)):
+        shift = (mask & -mask).bit_length() - 1
+        rgb[:, :, channel] = (pixels & mask) >> shift
+    return rgb
+
+
+def downscale(rgb, max_width):
+    # Averages blocks of `factor` x `factor` pixels
+    height, width, _ = rgb.shape
+    factor = max(1, -(-width // max_width))
+    if factor == 1:
+        return rgb
+    height, width = height // factor * factor, width // factor * factor
+    blocks = rgb[:height, :width].reshape(height // factor, factor, width // factor, factor, 3)
+    return blocks.mean(axis=(1, 3)).astype(numpy.uint8)
+
+
+def encode_png(rgb):
+    def chunk(chunk_type, chunk_data):
+        return (
+            struct.pack(">I", len(chunk_data))
+            + chunk_type
+            + chunk_data
+            + struct.pack(">I", zlib.crc32(chunk_type + chunk_data) & 0xFFFFFFFF)
+        )
+
+    height, width, _ = rgb.shape
+    # Every row starts with its filter type (0: no filter)
+    rows = numpy.zeros((height, width * 3 + 1), dtype=numpy.uint8)
+    rows[:, 1:] = rgb.reshape(height, width * 3)
+    # `tobytes` is not available in numpy < 1.9 (Debian jessie)
+    raw_data = rows.tobytes() if hasattr(rows, "tobytes") else rows.tostring()
+    return (
+        PNG_SIGNATURE
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw_data, 6))
+        + chunk(b"IEND", b"")
+    )
+
+
+def read_cached_snapshot(filepath):
+    try:
+        if time.time() - os.stat(filepath).st_mtime < SNAPSHOT_MAX_AGE:
+            with open(filepath, "rb") as f:
+                return f.read()
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def get_snapshot(width):
+    snapshot_filepath = os.path.join(os.path.dirname(framebuffer_filepath), "snapshot-{}.png".format(width))
+    snapshot = read_cached_snapshot(snapshot_filepath)
+    if snapshot is not None:
+        return snapshot
+    with open(snapshot_filepath + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        # Another request could have grabbed the framebuffer while this one waited for the lock
+        snapshot = read_cached_snapshot(snapshot_filepath)
+        if snapshot is not None:
+            return snapshot
+        snapshot = encode_png(downscale(read_framebuffer(framebuffer_filepath), width))
+        with open(snapshot_filepath + ".tmp", "wb") as f:
+            f.write(snapshot)
+        os.rename(snapshot_filepath + ".tmp", snapshot_filepath)
+    return snapshot
+
+
+def is_valid_password(password, full_access_only=False):
+    try:
+        with open(password_filepath, "r") as f:
+            lines = [line.strip() for line in f if line.strip()]
+    except (IOError, OSError):
+        return False
+    if VIEW_ONLY_SEPARATOR in lines:
+        full_access_passwords = lines[: lines.index(VIEW_ONLY_SEPARATOR)]
+        view_only_passwords = lines[lines.index(VIEW_ONLY_SEPARATOR) + 1 :]
+    else:
+        full_access_passwords, view_only_passwords = lines, []
+    valid_passwords = full_access_passwords if full_access_only else full_access_passwords + view_only_passwords
+    # Evaluate all passwords to not leak which one matched by timing
+    return password is not None and sum(hmac.compare_digest(password, p) for p in valid_passwords) > 0
+
+
+class SnapshotRequestHandler(ProxyRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if resize_display and url.path == "/vnc.html":
+            self.send_vnc_html()
+        elif resize_display and url.path == "/resize.js":
+            self.send_content(RESIZE_SCRIPT, "application/javascript")
+        elif url.path == "/snapshot.png":
+            self.send_snapshot(parse_qs(url.query))
+        else:
+            ProxyRequestHandler.do_GET(self)
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if resize_display and url.path == "/resize":
+            self.resize_display(parse_qs(url.query))
+        else:
+            self.send_error(405, "Method not allowed")
+
+    def send_content(self, content, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_vnc_html(self):
+        # noVNC page with the script which reports the window size
+        with open(os.path.join(web_root, "vnc.html"), "rb") as f:
+            content = f.read().replace(b"</head>", b'<script src="resize.js"></script>\n</head>', 1)
+        self.send_content(content, "text/html")
+
+    def resize_display(self, query):
+        # View-only viewers cannot change the display of other viewers
+        if not is_valid_password(query.get("password", [None])[0], full_access_only=True):
+            self.send_error(403, "Forbidden")
+            return
+        try:
+            width, height = int(query["width"][0]), int(query["height"][0])
+        except (KeyError, ValueError):
+            self.send_error(400, "Invalid size")
+            return
+        try:
+            resize_display_to(width, height)
+        except (IOError, OSError, subprocess.CalledProcessError) as e:
+            self.log_message("Cannot resize the display: %s", e)
+            self.send_error(503, "Resize failed")
+            return
+        self.send_response(204)
+        self.end_headers()
+
+    def send_snapshot(self, query):
+        if not is_valid_password(query.get("password", [None])[0]):
+            self.send_error(403, "Forbidden")
+            return
+        try:
+            width = int(query.get("width", [DEFAULT_SNAPSHOT_WIDTH])[0])
+        except ValueError:
+            self.send_error(400, "Invalid width")
+            return
+        width = min(MAX_SNAPSHOT_WIDTH, max(MIN_SNAPSHOT_WIDTH, width // SNAPSHOT_WIDTH_STEP * SNAPSHOT_WIDTH_STEP))
+        try:
+            snapshot = get_snapshot(width)
+        except (IOError, OSError, ValueError, struct.error) as e:
+            self.log_message("Cannot grab a snapshot: %s", e)
+            self.send_error(503, "Snapshot not available")
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(snapshot)))
+        self.send_header("Cache-Control", "private, max-age={:d}".format(int(SNAPSHOT_MAX_AGE)))
+        self.end_headers()
+        self.wfile.write(snapshot)
+
+
+def main():
+    logger = logging.getLogger(WebSocketProxy.log_prefix)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    stderr_handler = logging.StreamHandler()
+    stderr_handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(stderr_handler)
+
+    server = WebSocketProxy(
+        RequestHandlerClass=SnapshotRequestHandler,
+        listen_port=int(listen_port),
+        target_host="localhost",
+        target_port=int(vnc_port),
+        web=web_root,
+    )
+    server.start_server()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
-from .kvm import start_kvm_container
+import sys
+
 from ._version import __version__, __version_info__  # noqa: F401  # pylint: disable=unused-import
 
 __author__ = "Ingo Meyer"
@@ -6,5 +7,39 @@ __email__ = "i.meyer@fz-juelich.de"
 __copyright__ = "Copyright © 2018 Forschungszentrum Jülich GmbH. All rights reserved."
 __license__ = "MIT"
 
+# The public objects are imported on first access, so importing submodules (like the command line interface) does not
+# load `requests` and `asyncio` unnecessarily. Python < 3.7 does not support module level `__getattr__`.
+_lazy_attributes = {
+    "start_kvm_container": ".kvm",
+    "aclose_all_kvm_viewers": ".kvm",
+    "LaunchTrace": ".trace",
+    "TraceSpan": ".trace",
+    "add_viewer": ".viewers",
+    "remove_viewer": ".viewers",
+    "SharedViewer": ".viewers",
+}
+
+if sys.version_info >= (3, 7):
+
+    def __getattr__(name):
+        if name in _lazy_attributes:
+            import importlib
+
+            return getattr(importlib.import_module(_lazy_attributes[name], __name__), name)
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+else:
+    from .kvm import aclose_all_kvm_viewers, start_kvm_container  # noqa: F401
+    from .trace import LaunchTrace, TraceSpan  # noqa: F401
+    from .viewers import add_viewer, remove_viewer, SharedViewer  # noqa: F401
+
 
-__all__ = ["start_kvm_container"]
+__all__ = [
+    "LaunchTrace",
+    "SharedViewer",
+    "TraceSpan",
+    "aclose_all_kvm_viewers",
+    "add_viewer",
+    "remove_viewer",
+    "start_kvm_container",
+]
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+# Login to the web interface of a BMC and download of its kvm viewer. This module is used by the host check of the
+# package and by the `get_java_viewer` script of the Docker images (which copy it next to the script at build time),
+# so it must stay compatible with Python 2 and must not import other modules of the package.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+import re
+
+try:
+    from urllib.parse import urljoin
+except ImportError:
+    from urlparse import urljoin  # type: ignore
+
+try:
+    from typing import Dict, Optional, Text  # noqa: F401  # pylint: disable=unused-import
+
+    import requests  # noqa: F401  # pylint: disable=unused-import
+except ImportError:
+    pass
+
+logger = logging.getLogger(__name__)
+
+
+class LoginFailedError(Exception):
+    pass
+
+
+class DownloadFailedError(Exception):
+    pass
+
+
+def login(
+    session,
+    hostname,
+    user,
+    password,
+    login_endpoint,
+    ssl_verify,
+    user_attribute_name,
+    password_attribute_name,
+    extra_form_fields=None,
+    use_json=False,
+    session_cookie_key=None,
+    timeout=None,
+):
+    # type: (requests.Session, Text, Optional[Text], Text, Text, bool, Text, Text, Optional[Dict[Text, Text]], bool, Optional[Text], Optional[float]) -> None
+    assert password is not None
+    base_url = "https://{}".format(hostname)
+    login_url = urljoin(base_url, login_endpoint)
+    data = {user_attribute_name: user, password_attribute_name: password}
+    if extra_form_fields is not None:
+        data.update(extra_form_fields)
+    if use_json:
+        post_data = {"json": data}
+    else:
+        post_data = {"data": data}
+    response = session.post(login_url, verify=ssl_verify, timeout=timeout, **post_data)
+    if response.status_code == 200 and not any(
+        re.search(r"(session)|(SESSION)", key) for key in session.cookies.keys()
+    ):
+        session_cookie_regex = re.compile(r"'?(\w*(?:session)|(?:SESSION)\w*)'?\s*[:=]\s*'(\w+)'")
+        for line in response.text.split("\n"):
+            match_obj = session_cookie_regex.search(line)
+            if match_obj is not None:
+                if session_cookie_key is None:
+                    session_cookie_key = match_obj.group(1)
+                session_cookie_value = match_obj.group(2)
+                session.cookies.set(session_cookie_key, session_cookie_value)
+                break
+    if response.status_code != 200 or not session.cookies:
+        raise LoginFailedError("Login to {} was not successful.".format(login_url))
+    session.headers.update({"referer": login_url})  # Some kvms expect the referer header to be present.
+    logger.info("Logged in to {} as {}".format(hostname, user))
+
+
+def download_java_viewer(
+    session, hostname, download_endpoint, ssl_verify, format_jnlp=False, session_cookie_key=None, timeout=None
+):
+    # type: (requests.Session, Text, Text, bool, bool, Optional[Text], Optional[float]) -> Text
+    base_url = "https://{}".format(hostname)
+    download_url = urljoin(base_url, download_endpoint)
+    response = session.get(download_url, verify=ssl_verify, timeout=timeout)
+    if response.status_code != 200:
+        raise DownloadFailedError("Downloading the ipmi kvm viewer file from {} failed.".format(download_url))
+    logger.info("Successfully downloaded the kvm viewer.")
+    jnlp_filecontent = response.text
+    if format_jnlp:
+        jnlp_filecontent = jnlp_filecontent.format(
+            base_url=base_url, session_key=session.cookies.get(session_cookie_key)
+        )
+        logger.info("Formatted the JNLP file.")
+    return jnlp_filecontent
+
+
+__all__ = ["DownloadFailedError", "LoginFailedError", "download_java_viewer", "login"]
@@ -1,15 +1,18 @@
+import json
 import os
 import signal
 
 try:
-    from typing import Text, Tuple  # noqa: F401  # pylint: disable=unused-import
+    from typing import Any, Callable, Dict, Optional, Text, Tuple  # noqa: F401  # pylint: disable=unused-import
 except ImportError:
     pass
 
 import sys
 
+from . import browser_ipc
+
 try:
-    from PyQt5 import QtCore, QtWidgets, QtWebEngineWidgets
+    from PyQt5 import QtCore, QtNetwork, QtWidgets, QtWebEngineWidgets
 
     qt_installed = True
 except ImportError:
@@ -18,25 +21,165 @@ except ImportError:
 if qt_installed:
 
     class VncBrowserWidget(QtWebEngineWidgets.QWebEngineView):
-        def __init__(self, url):
-            # type: (Text) -> None
+        def __init__(self, url, profile=None):
+            # type: (Text, Optional[QtWebEngineWidgets.QWebEngineProfile]) -> None
             super().__init__()
             self._url = url
+            self._profile = profile
             self._init_ui()
 
         def _init_ui(self):
             # type: () -> None
+            if self._profile is not None:
+                self.setPage(QtWebEngineWidgets.QWebEnginePage(self._profile, self))
             self.load(QtCore.QUrl(self._url))
 
-    def run_vnc_browser(url, hostname, window_size):
-        # type: (Text, Text, Tuple[int, int]) -> bool
-        app = QtWidgets.QApplication(sys.argv)
-        # Ensure that the rest of the application can terminate (-> Docker container)
-        app.aboutToQuit.connect(lambda: os.kill(os.getpid(), signal.SIGTERM))
-        vnc_browser_window = VncBrowserWidget(url)
-        vnc_browser_window.setWindowTitle("nojava-ipmi-kvm [{}]".format(hostname))
-        vnc_browser_window.setFixedSize(*window_size)
-        vnc_browser_window.show()
+    class VncBrowserWindow(QtWidgets.QTabWidget):
+        # One tab per kvm console. All tabs share one web engine profile (and its renderer processes), so additional
+        # consoles are much cheaper than additional browser processes.
+        def __init__(self, profile):
+            # type: (QtWebEngineWidgets.QWebEngineProfile) -> None
+            super().__init__()
+            self._profile = profile
+            self._hostnames = {}  # type: Dict[VncBrowserWidget, Text]
+            self._window_sizes = {}  # type: Dict[VncBrowserWidget, Tuple[int, int]]
+            self._resizable = {}  # type: Dict[VncBrowserWidget, bool]
+            self._close_callbacks = {}  # type: Dict[VncBrowserWidget, Optional[Callable[[], Any]]]
+            self._init_ui()
+
+        def _init_ui(self):
+            # type: () -> None
+            self.setTabsClosable(True)
+            self.setDocumentMode(True)
+            self.tabCloseRequested.connect(lambda index: self.close_console(self.widget(index)))
+            self.currentChanged.connect(lambda index: self._update_window())
+
+        def _update_window(self):
+            # type: () -> None
+            vnc_browser_widget = self.currentWidget()
+            if vnc_browser_widget is None:
+                return
+            self.setWindowTitle("nojava-ipmi-kvm [{}]".format(self._hostnames[vnc_browser_widget]))
+            width, height = self._window_sizes[vnc_browser_widget]
+            height += self.tabBar().sizeHint().height()
+            if self._resizable[vnc_browser_widget]:
+                # The X server is resized to the window, so no scaling is needed
+                self.setMinimumSize(0, 0)
+                self.setMaximumSize(QtWidgets.QWIDGETSIZE_MAX, QtWidgets.QWIDGETSIZE_MAX)
+                if not self.isVisible():
+                    self.resize(width, height)
+            else:
+                self.setFixedSize(width, height)
+
+        def add_console(self, url, hostname, window_size, close_callback=None, resizable=False):
+            # type: (Text, Text, Tuple[int, int], Optional[Callable[[], Any]], bool) -> VncBrowserWidget
+            # `close_callback` is called when the tab is closed by the user
+            vnc_browser_widget = VncBrowserWidget(url, self._profile)
+            self._hostnames[vnc_browser_widget] = hostname
+            self._window_sizes[vnc_browser_widget] = window_size
+            self._resizable[vnc_browser_widget] = resizable
+            self._close_callbacks[vnc_browser_widget] = close_callback
+            self.addTab(vnc_browser_widget, hostname)
+            self.setCurrentWidget(vnc_browser_widget)
+            self._update_window()
+            self.show()
+            self.raise_()
+            self.activateWindow()
+            return vnc_browser_widget
+
+        def remove_console(self, vnc_browser_widget):
+            # type: (VncBrowserWidget) -> None
+            # Removes the tab without calling its close callback; the browser quits with its last tab
+            if vnc_browser_widget not in self._hostnames:
+                return
+            self.removeTab(self.indexOf(vnc_browser_widget))
+            del self._hostnames[vnc_browser_widget]
+            del self._window_sizes[vnc_browser_widget]
+            del self._resizable[vnc_browser_widget]
+            del self._close_callbacks[vnc_browser_widget]
+            vnc_browser_widget.deleteLater()
+            if self.count() == 0:
+                self.close()
+
+        def close_console(self, vnc_browser_widget):
+            # type: (VncBrowserWidget) -> None
+            close_callback = self._close_callbacks.get(vnc_browser_widget)
+            self.remove_console(vnc_browser_widget)
+            if close_callback is not None:
+                close_callback()
+
+        def closeEvent(self, event):
+            # Closing the window closes all tabs (and stops their Docker containers)
+            for vnc_browser_widget in list(self._hostnames):
+                self.close_console(vnc_browser_widget)
+            super().closeEvent(event)
+
+    class VncBrowserServer(QtCore.QObject):
+        # Opens tabs for the kvm consoles of other `nojava-ipmi-kvm` processes (see the `browser_ipc` module)
+        def __init__(self, vnc_browser_window):
+            # type: (VncBrowserWindow) -> None
+            super().__init__(vnc_browser_window)
+            self._vnc_browser_window = vnc_browser_window
+            self._server = QtNetwork.QLocalServer(self)
+            self._server.setSocketOptions(QtNetwork.QLocalServer.UserAccessOption)
+            self._server.newConnection.connect(self._accept_connections)
+
+        def listen(self):
+            # type: () -> bool
+            socket_filepath = browser_ipc.get_browser_socket_filepath()
+            # Remove the stale socket file of a killed browser; the caller ensures that no other browser is running
+            QtNetwork.QLocalServer.removeServer(socket_filepath)
+            return bool(self._server.listen(socket_filepath))
+
+        def _accept_connections(self):
+            # type: () -> None
+            while self._server.hasPendingConnections():
+                connection = self._server.nextPendingConnection()
+                connection.readyRead.connect(lambda connection=connection: self._read_request(connection))
+
+        def _read_request(self, connection):
+            # type: (QtNetwork.QLocalSocket) -> None
+            if not connection.canReadLine():
+                return
+            # Every connection opens exactly one tab
+            connection.readyRead.disconnect()
+            try:
+                request = json.loads(bytes(connection.readLine()).decode("utf-8"))
+                url, hostname, window_size = request["url"], request["hostname"], tuple(request["window_size"])
+                resizable = bool(request.get("resizable", False))
+            except (ValueError, KeyError, TypeError):
+                connection.disconnectFromServer()
+                return
+            vnc_browser_widget = self._vnc_browser_window.add_console(
+                url, hostname, window_size, connection.disconnectFromServer, resizable
+            )
+            connection.disconnected.connect(lambda: self._close_connection(connection, vnc_browser_widget))
+
+        def _close_connection(self, connection, vnc_browser_widget):
+            # type: (QtNetwork.QLocalSocket, VncBrowserWidget) -> None
+            # Either the tab was closed or the owning process exited (and stopped its Docker container)
+            self._vnc_browser_window.remove_console(vnc_browser_widget)
+            connection.deleteLater()
+
+    def run_vnc_browser(url, hostname, window_size, close_callback=None, resizable=False):
+        # type: (Text, Text, Tuple[int, int], Optional[Callable[[], Any]], bool) -> bool
+        # Opens the url in a new tab of the running browser process or starts the browser in this process (until all
+        # tabs are closed). `close_callback` is called when the tab of this url is closed before the browser quits.
+        with browser_ipc.browser_lock():
+            client_socket = browser_ipc.connect_to_browser()
+            if client_socket is None:
+                app = QtWidgets.QApplication(sys.argv)
+                # Ensure that the rest of the application can terminate (-> Docker container)
+                app.aboutToQuit.connect(lambda: os.kill(os.getpid(), signal.SIGTERM))
+                # Off-the-record profile, the urls contain passwords
+                profile = QtWebEngineWidgets.QWebEngineProfile(app)
+                vnc_browser_window = VncBrowserWindow(profile)
+                vnc_browser_server = VncBrowserServer(vnc_browser_window)
+                vnc_browser_server.listen()
+        if client_socket is not None:
+            browser_ipc.show_in_browser(client_socket, url, hostname, window_size, resizable)
+            return True
+        vnc_browser_window.add_console(url, hostname, window_size, close_callback, resizable)
         # Let the Python interpreter run every 500 ms to handle signals like SIGTERM
         timer = QtCore.QTimer()
         timer.start(500)
@@ -0,0 +1,69 @@
+import contextlib
+import fcntl
+import json
+import os
+import socket
+
+try:
+    from typing import Iterator, Optional, Text, Tuple  # noqa: F401  # pylint: disable=unused-import
+except ImportError:
+    pass
+
+from .utils import get_cache_directory
+
+# All kvm consoles opened with `--use-gui` share one browser process (with one tab per console). The first process
+# which opens a console runs the browser and listens on a local socket; later processes send their console url to this
+# socket and keep the connection open. The browser closes the connection when the tab is closed, and it closes the tab
+# when the connection is lost (the process which owns the Docker container exited). This module does not import PyQt5,
+# so opening a tab in a running browser is fast.
+
+BROWSER_SOCKET_FILENAME = "browser.sock"
+BROWSER_LOCK_FILENAME = "browser.lock"
+
+
+def get_browser_socket_filepath():
+    # type: () -> Text
+    return os.path.join(get_cache_directory(), BROWSER_SOCKET_FILENAME)
+
+
+@contextlib.contextmanager
+def browser_lock():
+    # type: () -> Iterator[None]
+    # Serializes looking for a running browser and starting a new one, so concurrent launches use the same browser
+    os.makedirs(get_cache_directory(), mode=0o700, exist_ok=True)
+    with open(os.path.join(get_cache_directory(), BROWSER_LOCK_FILENAME), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def connect_to_browser():
+    # type: () -> Optional[socket.socket]
+    # Returns `None` if no browser is running
+    client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client_socket.connect(get_browser_socket_filepath())
+    except OSError:
+        # Also raised for stale socket files of browsers which were killed
+        client_socket.close()
+        return None
+    return client_socket
+
+
+def show_in_browser(client_socket, url, hostname, window_size, resizable=False):
+    # type: (socket.socket, Text, Text, Tuple[int, int], bool) -> None
+    # Opens a new tab and blocks until it is closed
+    with client_socket:
+        request = {"url": url, "hostname": hostname, "window_size": list(window_size), "resizable": resizable}
+        client_socket.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        while client_socket.recv(4096):
+            pass
+
+
+def show_in_running_browser(url, hostname, window_size, resizable=False):
+    # type: (Text, Text, Tuple[int, int], bool) -> bool
+    # Returns `False` if no browser is running
+    client_socket = connect_to_browser()
+    if client_socket is None:
+        return False
+    show_in_browser(client_socket, url, hostname, window_size, resizable)
+    return True
@@ -0,0 +1,276 @@
+import asyncio
+import concurrent.futures
+import json
+import re
+import time
+import urllib.parse
+import warnings
+
+import requests
+import urllib3
+
+try:
+    from typing import (  # noqa: F401  # pylint: disable=unused-import
+        Any,
+        Callable,
+        Dict,
+        Iterable,
+        List,
+        Optional,
+        Text,
+        TextIO,
+    )
+except ImportError:
+    pass
+
+from .config import HostConfig, HTML5HostConfig, JavaHostConfig
+from .bmc_session import download_java_viewer, login, DownloadFailedError, LoginFailedError
+from .kvm import check_webserver, WebserverCheckTimeoutError, WebserverNotReachableError
+
+DEFAULT_CONCURRENCY = 64
+DEFAULT_TIMEOUT = 30.0
+# Steps of a host check, in order
+CHECK_STEPS = ("reachable", "login", "viewer")
+
+
+class HostCheckResult:
+    def __init__(self, hostname, full_hostname):
+        # type: (Text, Text) -> None
+        self._hostname = hostname
+        self._full_hostname = full_hostname
+        self._steps = {}  # type: Dict[Text, bool]
+        self._durations = {}  # type: Dict[Text, float]
+        self._error = None  # type: Optional[Text]
+
+    @property
+    def hostname(self):
+        # type: () -> Text
+        return self._hostname
+
+    @property
+    def full_hostname(self):
+        # type: () -> Text
+        return self._full_hostname
+
+    @property
+    def ok(self):
+        # type: () -> bool
+        return self._error is None and all(self._steps.values())
+
+    @property
+    def error(self):
+        # type: () -> Optional[Text]
+        return self._error
+
+    def step(self, name):
+        # type: (Text) -> Optional[bool]
+        # `None` if the step was not run (skipped or an earlier step failed)
+        return self._steps.get(name)
+
+    def duration(self, name):
+        # type: (Text) -> Optional[float]
+        return self._durations.get(name)
+
+    def set_step(self, name, passed, duration):
+        # type: (Text, bool, float) -> None
+        self._steps[name] = passed
+        self._durations[name] = duration
+
+    def set_error(self, error):
+        # type: (Text) -> None
+        self._error = error
+
+    def as_dict(self):
+        # type: () -> Dict[Text, Any]
+        return {
+            "hostname": self._hostname,
+            "full_hostname": self._full_hostname,
+            "ok": self.ok,
+            "error": self._error,
+            "steps": {
+                name: {"passed": self._steps[name], "duration": round(self._durations[name], 3)}
+                for name in CHECK_STEPS
+                if name in self._steps
+            },
+        }
+
+
+def check_login_and_viewer(host_config, login_password, result, timeout):
+    # type: (HostConfig, Optional[Text], HostCheckResult, float) -> None
+    # Blocking part of a host check (run in an executor thread), uses the same code as the container to log in and to
+    # download the kvm viewer, but only keeps the session in memory
+    session = requests.Session()
+    try:
+        if not host_config.skip_login:
+            start_time = time.monotonic()
+            try:
+                login(
+                    session,
+                    host_config.full_hostname,
+                    host_config.login_user,
+                    login_password,
+                    host_config.login_endpoint,
+                    not host_config.allow_insecure_ssl,
+                    host_config.user_login_attribute_name,
+                    host_config.password_login_attribute_name,
+                    parse_extra_login_form_fields(host_config.extra_login_form_fields),
+                    host_config.send_post_data_as_json,
+                    host_config.session_cookie_key,
+                    timeout=timeout,
+                )
+            except (LoginFailedError, requests.RequestException) as e:
+                result.set_step("login", False, time.monotonic() - start_time)
+                result.set_error(str(e))
+                return
+            result.set_step("login", True, time.monotonic() - start_time)
+
+        start_time = time.monotonic()
+        try:
+            if isinstance(host_config, JavaHostConfig):
+                viewer_content = download_java_viewer(
+                    session,
+                    host_config.full_hostname,
+                    host_config.download_endpoint,
+                    not host_config.allow_insecure_ssl,
+                    timeout=timeout,
+                )
+                if "<jnlp" not in viewer_content:
+                    raise DownloadFailedError(
+                        "The download endpoint of {} did not return a JNLP file.".format(host_config.full_hostname)
+                    )
+            elif isinstance(host_config, HTML5HostConfig):
+                download_java_viewer(
+                    session,
+                    host_config.full_hostname,
+                    host_config.html5_endpoint,
+                    not host_config.allow_insecure_ssl,
+                    timeout=timeout,
+                )
+        except (DownloadFailedError, requests.RequestException) as e:
+            result.set_step("viewer", False, time.monotonic() - start_time)
+            result.set_error(str(e))
+            return
+        result.set_step("viewer", True, time.monotonic() - start_time)
+    finally:
+        session.close()
+
+
+def ignore_insecure_request_warnings(full_hostname):
+    # type: (Text) -> None
+    # The user opted out of certificate checks for this host, so a warning for every request is only noise. The warnings
+    # filters are global, so the filter only matches the warnings of this host and other hosts still get them.
+    hostname = urllib.parse.urlsplit("https://{}".format(full_hostname)).hostname or full_hostname
+    warnings.filterwarnings(
+        "ignore",
+        message="Unverified HTTPS request is being made to host '{}'".format(re.escape(hostname)),
+        category=urllib3.exceptions.InsecureRequestWarning,
+    )
+
+
+def parse_extra_login_form_fields(extra_login_form_fields):
+    # type: (Optional[Text]) -> Optional[Dict[Text, Text]]
+    # Same format as the `-e` option of `get_java_viewer`
+    if not extra_login_form_fields:
+        return None
+    return dict(entry.split(":", 1) for entry in extra_login_form_fields.split(","))
+
+
+async def check_host(host_config, login_password, timeout, executor):
+    # type: (HostConfig, Optional[Text], float, concurrent.futures.Executor) -> HostCheckResult
+    result = HostCheckResult(host_config.short_hostname, host_config.full_hostname)
+    deadline = time.monotonic() + timeout
+    if host_config.allow_insecure_ssl:
+        # Changed here instead of in the executor threads, which run concurrently
+        ignore_insecure_request_warnings(host_config.full_hostname)
+
+    def remaining_time():
+        # type: () -> float
+        return max(0.001, deadline - time.monotonic())
+
+    start_time = time.monotonic()
+    try:
+        await asyncio.wait_for(
+            check_webserver(
+                lambda *args, **kwargs: None,
+                "http://{}/".format(host_config.full_hostname),
+                timeout=remaining_time(),
+            ),
+            remaining_time(),
+        )
+    except WebserverNotReachableError as e:
+        result.set_step("reachable", False, time.monotonic() - start_time)
+        result.set_error(str(e))
+        return result
+    except (asyncio.TimeoutError, WebserverCheckTimeoutError):
+        result.set_step("reachable", False, time.monotonic() - start_time)
+        result.set_error("Timeout after {:.1f} s.".format(timeout))
+        return result
+    result.set_step("reachable", True, time.monotonic() - start_time)
+
+    loop = asyncio.get_event_loop()
+    try:
+        await asyncio.wait_for(
+            loop.run_in_executor(
+                executor, check_login_and_viewer, host_config, login_password, result, remaining_time()
+            ),
+            remaining_time(),
+        )
+    except asyncio.TimeoutError:
+        result.set_error("Timeout after {:.1f} s.".format(timeout))
+    return result
+
+
+async def check_hosts(
+    host_configs, login_password, concurrency=DEFAULT_CONCURRENCY, timeout=DEFAULT_TIMEOUT, result_callback=None
+):
+    # type: (Iterable[HostConfig], Optional[Text], int, float, Optional[Callable[[HostCheckResult], None]]) -> List[HostCheckResult]
+    # Checks all hosts with at most `concurrency` hosts in progress at the same time. Every host check (reachability,
+    # login and viewer download) is aborted after `timeout` seconds.
+    semaphore = asyncio.Semaphore(concurrency)
+    # The default executor has too few threads for many concurrent blocking requests
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+
+    async def check_host_bounded(host_config):
+        # type: (HostConfig) -> HostCheckResult
+        async with semaphore:
+            result = await check_host(host_config, login_password, timeout, executor)
+        if result_callback is not None:
+            result_callback(result)
+        return result
+
+    try:
+        return await asyncio.gather(*(check_host_bounded(host_config) for host_config in host_configs))
+    finally:
+        # Threads which still wait for a timed out request are not joined
+        executor.shutdown(wait=False)
+
+
+def format_step(result, name):
+    # type: (HostCheckResult, Text) -> Text
+    passed = result.step(name)
+    if passed is None:
+        return "-"
+    return "{} {:7.0f} ms".format("ok  " if passed else "FAIL", result.duration(name) * 1000)
+
+
+def write_report_table(results, output_file):
+    # type: (List[HostCheckResult], TextIO) -> None
+    hostname_width = max([len("host")] + [len(result.hostname) for result in results])
+    row_format = "{{:<{}}}  {{:<15}}  {{:<15}}  {{:<15}}  {{}}".format(hostname_width)
+    output_file.write(row_format.format("host", *CHECK_STEPS, "error").rstrip() + "\n")
+    for result in results:
+        row = row_format.format(
+            result.hostname, *(format_step(result, name) for name in CHECK_STEPS), result.error or ""
+        )
+        output_file.write(row.rstrip() + "\n")
+    failed_count = sum(1 for result in results if not result.ok)
+    output_file.write("\n{} hosts checked, {} failed\n".format(len(results), failed_count))
+
+
+def write_report_json(results, output_file):
+    # type: (List[HostCheckResult], TextIO) -> None
+    json.dump([result.as_dict() for result in results], output_file, indent=2)
+    output_file.write("\n")
+
+
+__all__ = ["HostCheckResult", "check_host", "check_hosts"]
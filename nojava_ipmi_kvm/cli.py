@@ -1,29 +1,21 @@
 #!/usr/bin/env python3
 
 import argparse
-import getpass
 import logging
 import os
 import signal
 import sys
-import asyncio
-from yacl import setup_colored_stderr_logging
 
 try:
-    from typing import Any, Namespace, Text  # noqa: F401  # pylint: disable=unused-import
+    from typing import Any, Callable, Namespace, Optional, Text  # noqa: F401  # pylint: disable=unused-import
 except ImportError:
     pass
-from .config import config, DEFAULT_CONFIG_FILEPATH, InvalidHostnameError
-from .kvm import (
-    start_kvm_container,
-    WebserverNotReachableError,
-    DockerNotInstalledError,
-    DockerNotCallableError,
-    DockerTerminatedError,
-)
-from . import browser
+from .config import config, DEFAULT_CONFIG_FILEPATH, InvalidHostnameError, JavaHostConfig
 from ._version import __version__, __version_info__  # noqa: F401  # pylint: disable=unused-import
 
+# Heavy modules (`asyncio`, `requests`, `yacl`, PyQt5) are imported in the functions which need them to keep `--version`,
+# `--help` and other quick invocations fast. `benchmarks/import_time.py` checks the import time budget.
+
 logger = logging.getLogger(__name__)
 
 
@@ -63,6 +55,97 @@ def get_argumentparser():
         dest="print_default_config",
         help="print the default config to stdout and exit",
     )
+    parser.add_argument(
+        "--list-hosts",
+        action="store_true",
+        dest="list_hosts",
+        help="print the names of all configured hosts and exit (used by the shell completion)",
+    )
+    parser.add_argument(
+        "--trace-json",
+        action="store_true",
+        dest="trace_json",
+        help="print the durations of the launch phases as a JSON line to stderr",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        dest="check",
+        help="only check if the given host is reachable, accepts the login and serves the kvm viewer (no container is "
+        "started); exits with code 1 if the check fails",
+    )
+    parser.add_argument(
+        "--check-all",
+        action="store_true",
+        dest="check_all",
+        help="like `--check`, but check all configured hosts concurrently",
+    )
+    parser.add_argument(
+        "--check-concurrency",
+        action="store",
+        dest="check_concurrency",
+        type=int,
+        default=64,
+        help="maximum number of hosts which are checked at the same time (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--check-timeout",
+        action="store",
+        dest="check_timeout",
+        type=float,
+        default=30.0,
+        help="timeout in seconds for the check of a single host (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        dest="prefetch",
+        help="pull the Docker images of all configured hosts (or only of the given host) and pin their digests for "
+        "later launches; exits with code 1 if a pull fails",
+    )
+    parser.add_argument(
+        "-d",
+        "--detach",
+        action="store_true",
+        dest="detach",
+        help="keep the kvm console running after this program exits and print its url; later calls with the same "
+        "hostname reuse the running console",
+    )
+    parser.add_argument(
+        "--list-consoles",
+        action="store_true",
+        dest="list_consoles",
+        help="print all running kvm consoles and exit",
+    )
+    parser.add_argument(
+        "--stop",
+        action="store_true",
+        dest="stop",
+        help="stop the detached kvm console of the given host and exit",
+    )
+    parser.add_argument(
+        "--share",
+        action="store_true",
+        dest="share",
+        help="print an additional url for the detached kvm console of the given host, so another person can watch the "
+        "same console session",
+    )
+    parser.add_argument(
+        "--view-only",
+        action="store_true",
+        dest="view_only",
+        help="with `--share`: the additional viewer cannot send keyboard or mouse events (Java consoles only)",
+    )
+    parser.add_argument(
+        "--gc",
+        action="store_true",
+        dest="gc",
+        help="stop all orphaned kvm consoles (containers whose launching process is gone and which are not detached) "
+        "and exit; this is also done in the background on every launch",
+    )
+    parser.add_argument(
+        "--json", action="store_true", dest="json", help="print the check report as JSON instead of a table"
+    )
     parser.add_argument(
         "-V", "--version", action="store_true", dest="print_version", help="print the version number and exit"
     )
@@ -73,7 +156,15 @@ def parse_arguments():
     # type: () -> Namespace
     parser = get_argumentparser()
     args = parser.parse_args()
-    if not args.print_version and not args.print_default_config:
+    if (
+        not args.print_version
+        and not args.print_default_config
+        and not args.list_hosts
+        and not args.check_all
+        and not args.prefetch
+        and not args.list_consoles
+        and not args.gc
+    ):
         if args.hostname is None:
             parser.print_help()
             sys.exit(0)
@@ -83,6 +174,8 @@ def parse_arguments():
 
 def read_password():
     # type: () -> Text
+    import getpass
+
     if sys.stdin.isatty():
         password = getpass.getpass()
     else:
@@ -100,6 +193,8 @@ def setup_signal_handling():
 
 def setup_stderr_logging(debug=False):
     # type: (bool) -> None
+    from yacl import setup_colored_stderr_logging
+
     if debug:
         logging.basicConfig(level=logging.DEBUG)
     else:
@@ -107,6 +202,176 @@ def setup_stderr_logging(debug=False):
     setup_colored_stderr_logging(format_string="[%(levelname)s] %(message)s")
 
 
+def print_launch_trace(launch_trace, hostname):
+    # type: (Any, Text) -> None
+    sys.stderr.write(launch_trace.to_json(hostname=hostname) + "\n")
+    sys.stderr.flush()
+
+
+def run_host_checks(args):
+    # type: (Namespace) -> bool
+    import asyncio
+    from .check import check_hosts, write_report_json, write_report_table
+
+    setup_stderr_logging(args.debug)
+    if not args.debug:
+        # Only the report is of interest
+        logging.getLogger().setLevel(logging.WARNING)
+    config.read_config(args.config_filepath)
+    hostnames = list(config.get_servers()) if args.check_all else [args.hostname]
+    host_configs = [config[hostname] for hostname in hostnames]
+    password = None
+    # All hosts share the same login password (like the `login_user`, it is expected to be a common admin account)
+    if any(not host_config.skip_login for host_config in host_configs):
+        password = read_password()
+    results = asyncio.get_event_loop().run_until_complete(
+        check_hosts(host_configs, password, concurrency=args.check_concurrency, timeout=args.check_timeout)
+    )
+    if args.json:
+        write_report_json(results, sys.stdout)
+    else:
+        write_report_table(results, sys.stdout)
+    return all(result.ok for result in results)
+
+
+def prefetch_images(args):
+    # type: (Namespace) -> bool
+    import asyncio
+    from .images import get_required_docker_images, prefetch_images
+
+    setup_stderr_logging(args.debug)
+    config.read_config(args.config_filepath)
+    hostnames = [args.hostname] if args.hostname is not None else list(config.get_servers())
+    docker_images = get_required_docker_images(config[hostname] for hostname in hostnames)
+
+    def print_progress(docker_image, completed_layer_count, layer_count):
+        # type: (Text, int, int) -> None
+        logger.info("%s: %d/%d layers", docker_image, completed_layer_count, layer_count)
+
+    errors = asyncio.get_event_loop().run_until_complete(
+        prefetch_images(docker_images, progress_callback=print_progress)
+    )
+    return all(error is None for error in errors.values())
+
+
+def list_consoles():
+    # type: () -> bool
+    import subprocess
+    from .consoles import HOST_LABEL, list_console_containers, list_detached_consoles, remove_detached_console
+
+    try:
+        containers = list_console_containers()
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.error("Cannot list the running Docker containers: %s", e)
+        return False
+    rows = []
+    detached_container_names = set()
+    for console in list_detached_consoles():
+        if console.container_name not in containers:
+            remove_detached_console(console.hostname)
+            continue
+        detached_container_names.add(console.container_name)
+        rows.append((console.hostname, "detached", console.container_name, console.url))
+    for container_name, labels in sorted(containers.items()):
+        # Shared Java containers have no host label, their sessions are only listed if they are detached
+        if HOST_LABEL in labels and container_name not in detached_container_names:
+            rows.append((labels[HOST_LABEL], "attached", container_name, "-"))
+    hostname_width = max([len("host")] + [len(row[0]) for row in rows])
+    container_name_width = max([len("container")] + [len(row[2]) for row in rows])
+    row_format = "{{:<{}}}  {{:<8}}  {{:<{}}}  {{}}\n".format(hostname_width, container_name_width)
+    sys.stdout.write(row_format.format("host", "state", "container", "url"))
+    for row in sorted(rows):
+        sys.stdout.write(row_format.format(*row))
+    return True
+
+
+def share_console(args):
+    # type: (Namespace) -> bool
+    import asyncio
+    import urllib.parse
+    from .consoles import find_detached_console
+    from .viewers import add_html5_viewer, add_java_viewer, ViewerCommandError, ViewerNotSupportedError
+
+    loop = asyncio.get_event_loop()
+    console = loop.run_until_complete(find_detached_console(args.hostname))
+    if console is None:
+        logger.error("There is no detached kvm console of '%s' (start one with `--detach`).", args.hostname)
+        return False
+    try:
+        if console.vnc_password is not None:
+            shared_viewer = loop.run_until_complete(
+                add_java_viewer(
+                    console.container_name,
+                    urllib.parse.urlsplit(console.url).hostname,
+                    console.web_port,
+                    console.session,
+                    args.view_only,
+                )
+            )
+        else:
+            shared_viewer = loop.run_until_complete(
+                add_html5_viewer(console.container_name, console.url, view_only=args.view_only)
+            )
+    except (ViewerCommandError, ViewerNotSupportedError) as e:
+        logger.error(str(e))
+        return False
+    print("Use this url: %s to view kvm%s." % (shared_viewer.url, " (view-only)" if shared_viewer.view_only else ""))
+    return True
+
+
+def collect_orphaned_containers():
+    # type: () -> bool
+    import subprocess
+    from .consoles import collect_orphaned_containers
+
+    try:
+        container_names = collect_orphaned_containers()
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.error("Cannot list the running Docker containers: %s", e)
+        return False
+    if not container_names:
+        logger.info("No orphaned Docker containers found.")
+    return True
+
+
+def stop_console(args):
+    # type: (Namespace) -> bool
+    import asyncio
+    from .consoles import find_detached_console, stop_detached_console
+
+    console = asyncio.get_event_loop().run_until_complete(find_detached_console(args.hostname))
+    if console is None:
+        logger.error("There is no detached kvm console of '%s'.", args.hostname)
+        return False
+    stop_detached_console(console)
+    logger.info("Stopped the kvm console of '%s'.", args.hostname)
+    return True
+
+
+def show_kvm_console(args, url, host_config, close_callback=None):
+    # type: (Namespace, Text, Any, Optional[Callable[[], Any]]) -> bool
+    # Opens the url in the PyQt5 browser if requested and available and returns `False` otherwise. Blocks until the
+    # browser tab is closed; `close_callback` is called when the tab is closed while the browser keeps running (with the
+    # tabs of other processes).
+    if not args.use_gui:
+        return False
+    from . import browser_ipc
+
+    window_size = tuple(int(c) for c in config.x_resolution.split("x"))
+    # The X server of Java consoles follows the size of the browser window
+    resizable = config.resize_display and isinstance(host_config, JavaHostConfig)
+    # A browser started by another process opens the url in a new tab; this does not import PyQt5
+    if browser_ipc.show_in_running_browser(url, host_config.full_hostname, window_size, resizable):
+        return True
+    # PyQt5 and QtWebEngine take long to import
+    from . import browser
+
+    if browser.qt_installed:
+        browser.run_vnc_browser(url, host_config.full_hostname, window_size, close_callback, resizable)
+        return True
+    return False
+
+
 def main():
     # type: () -> None
     args = parse_arguments()
@@ -115,7 +380,73 @@ def main():
     elif args.print_default_config:
         config.write_default_config(sys.stdout)
         sys.exit(0)
+    elif args.list_hosts:
+        from .inventory import IncludeNotFoundError
+
+        try:
+            # Reading the config also refreshes the host name cache of the shell completion
+            config.read_config(args.config_filepath)
+        except IncludeNotFoundError as e:
+            setup_stderr_logging(args.debug)
+            logger.error(str(e))
+            sys.exit(3)
+        sys.stdout.writelines("{}\n".format(hostname) for hostname in config.get_servers())
+    elif args.list_consoles or args.stop or args.share or args.gc:
+        from .inventory import IncludeNotFoundError
+
+        setup_stderr_logging(args.debug)
+        try:
+            # The Docker commands need the `run_docker_with_sudo` setting
+            config.read_config(args.config_filepath)
+            if args.list_consoles:
+                success = list_consoles()
+            elif args.stop:
+                success = stop_console(args)
+            elif args.share:
+                success = share_console(args)
+            else:
+                success = collect_orphaned_containers()
+            if not success:
+                sys.exit(1)
+        except IncludeNotFoundError as e:
+            logger.error(str(e))
+            sys.exit(3)
+    elif args.prefetch:
+        from .inventory import IncludeNotFoundError
+
+        try:
+            if not prefetch_images(args):
+                sys.exit(1)
+        except (InvalidHostnameError, IncludeNotFoundError) as e:
+            logger.error(str(e))
+            sys.exit(3)
+        except KeyboardInterrupt:
+            sys.exit(1)
+    elif args.check or args.check_all:
+        from .inventory import IncludeNotFoundError
+
+        try:
+            if not run_host_checks(args):
+                sys.exit(1)
+        except (InvalidHostnameError, IncludeNotFoundError) as e:
+            logger.error(str(e))
+            sys.exit(3)
+        except KeyboardInterrupt:
+            sys.exit(1)
     else:
+        import asyncio
+        from .kvm import (
+            start_kvm_container,
+            WebserverNotReachableError,
+            DockerNotInstalledError,
+            DockerNotCallableError,
+            DockerTerminatedError,
+            LaunchTimeoutError,
+        )
+        from .consoles import DetachedConsole, find_detached_console, save_detached_console
+        from .inventory import IncludeNotFoundError
+        from .trace import LaunchTrace
+
         setup_signal_handling()
         setup_stderr_logging()
         start_kvm_container_exceptions = (
@@ -124,21 +455,38 @@ def main():
             DockerNotInstalledError,
             DockerNotCallableError,
             DockerTerminatedError,
+            LaunchTimeoutError,
+            IncludeNotFoundError,
         )
         try:
             config.read_config(args.config_filepath)
             host_config = config[args.hostname]
+            detached_console = asyncio.get_event_loop().run_until_complete(find_detached_console(args.hostname))
+            if detached_console is not None:
+                # Reattach to the running console; it keeps running when the browser is closed
+                logger.info("Reusing the running kvm console of '%s'.", args.hostname)
+                if not show_kvm_console(args, detached_console.url, host_config):
+                    print("Use this url: %s to view kvm." % detached_console.url)
+                sys.exit(0)
             password = None
             if not host_config.skip_login:
                 password = read_password()
-            kvm_viewer = asyncio.get_event_loop().run_until_complete(
-                start_kvm_container(host_config, password, debug=args.debug)
-            )
-            if args.use_gui and browser.qt_installed:
-                browser.run_vnc_browser(
-                    kvm_viewer.url, host_config.full_hostname, tuple(int(c) for c in config.x_resolution.split("x"))
+            launch_trace = LaunchTrace() if args.trace_json else None
+            try:
+                kvm_viewer = asyncio.get_event_loop().run_until_complete(
+                    start_kvm_container(host_config, password, debug=args.debug, launch_trace=launch_trace)
                 )
-            else:
+            finally:
+                if launch_trace is not None:
+                    print_launch_trace(launch_trace, args.hostname)
+            if args.detach:
+                save_detached_console(DetachedConsole.from_kvm_viewer(args.hostname, kvm_viewer))
+                kvm_viewer.detach()
+                if not show_kvm_console(args, kvm_viewer.url, host_config):
+                    print("Use this url: %s to view kvm." % kvm_viewer.url)
+                print("Run `%s --stop %s` to shutdown the container." % (os.path.basename(sys.argv[0]), args.hostname))
+                sys.exit(0)
+            if not show_kvm_console(args, kvm_viewer.url, host_config, kvm_viewer.kill_process):
                 print("Use this url: %s to view kvm." % kvm_viewer.url)
                 print("Press ENTER or CTRL-C to shutdown container and exit")
                 sys.stdin.readline()
@@ -1,9 +1,18 @@
+import copy
 import os
-import yaml
 import json
 
 try:
-    from typing import Any, Dict, List, Optional, Text, TextIO, Union  # noqa: F401  # pylint: disable=unused-import
+    from typing import (  # noqa: F401  # pylint: disable=unused-import
+        Any,
+        Dict,
+        Iterator,
+        List,
+        Optional,
+        Text,
+        TextIO,
+        Union,
+    )
 except ImportError:
     pass
 
@@ -108,13 +117,17 @@ class JavaHostConfig(HostConfig):
         download_endpoint="cgi/url_redirect.cgi?url_name=ikvm&url_type=jwsk",
         java_version="7u181",
         format_jnlp=False,
+        min_resolution="640x480",
+        max_resolution="1920x1200",
         **kwargs,
     ):
-        # type: (Text, Text, Text, Text, bool, **Any) -> None
+        # type: (Text, Text, Text, Text, bool, Text, Text, **Any) -> None
         super().__init__(short_hostname, full_hostname, **kwargs)
         self._download_endpoint = download_endpoint
         self._java_version = java_version
         self._format_jnlp = format_jnlp
+        self._min_resolution = min_resolution
+        self._max_resolution = max_resolution
 
     @property
     def download_endpoint(self):
@@ -131,6 +144,17 @@ class JavaHostConfig(HostConfig):
         # type: () -> bool
         return self._format_jnlp
 
+    @property
+    def min_resolution(self):
+        # type: () -> Text
+        # Limits of the X server resolution if the display is resized to the viewer window (`resize_display`)
+        return self._min_resolution
+
+    @property
+    def max_resolution(self):
+        # type: () -> Text
+        return self._max_resolution
+
 
 class HTML5HostConfig(HostConfig):
     def __init__(
@@ -183,63 +207,98 @@ class Config(object):
 
     def write(self, config_filepath_or_file):
         # type: (Union[Text, TextIO]) -> None
+        import yaml
+
+        config_dict = self._get_default_config_dict()
+        if self._config_filepath is not None:
+            from .inventory import read_config_files
+
+            # Templates and hosts are not kept in memory, so the config files are read again
+            update(config_dict, read_config_files(self._get_absolute_config_filepath())[0])
 
         if isinstance(config_filepath_or_file, Text):
             with open(config_filepath_or_file, "w", encoding="utf-8") as config_file:
-                yaml.dump(self._config_dict, config_file, default_flow_style=False)
+                yaml.dump(config_dict, config_file, default_flow_style=False)
         else:
             config_file = config_filepath_or_file
-            yaml.dump(self._config_dict, config_file, default_flow_style=False)
+            yaml.dump(config_dict, config_file, default_flow_style=False)
 
-    def read_config(self, config_filepath=None):
-        # type: (Optional[Text]) -> None
-        # Set defaults
-        self._config_dict = {
+    @staticmethod
+    def _get_default_config_dict():
+        # type: () -> Dict[Text, Any]
+        return {
             "general": {
                 "java_docker_image": "docker.io/sciapp/nojava-ipmi-kvm:v{version}-{java_provider}-{java_major_version}",
                 "html5_docker_image": "docker.io/sciapp/nojava-ipmi-kvm:v{version}-html5",
                 "run_docker_with_sudo": False,
                 "x_resolution": "1024x768",
+                "resize_display": False,
+                "share_java_containers": False,
+                "max_shared_sessions": 10,
+                "read_only_containers": False,
+                # Size limit of every writable tmpfs mount of a read-only container (`docker run --tmpfs` syntax)
+                "container_tmpfs_size": "256m",
+                # Time in seconds successful preflight checks are remembered (`0` disables caching)
+                "preflight_cache_ttls": {"docker": 60, "docker_image": 300, "webserver": 30},
+                # Timeouts in seconds (`None` disables a timeout)
+                "launch_timeout": 600,
+                "phase_timeouts": {
+                    "check_webserver": 10,
+                    "check_docker": 60,
+                    "container_start": 300,
+                    "session_add": 120,
+                    "port_discovery": 300,
+                    "readiness_wait": 120,
+                },
             },
             "templates": {},
             "hosts": {},
         }
 
+    def _get_absolute_config_filepath(self):
+        # type: () -> Text
+        return os.path.abspath(os.path.expanduser(self._config_filepath))
+
+    def read_config(self, config_filepath=None):
+        # type: (Optional[Text]) -> None
+        # Set defaults
+        self._config_dict = self._get_default_config_dict()
+        self._host_inventory = None  # type: Any
+
         # load values
         if config_filepath is not None:
             self._config_filepath = config_filepath
         if self._config_filepath is not None:
-            with open(os.path.abspath(os.path.expanduser(self._config_filepath)), "r") as f:
-                self._config_dict = update(self._config_dict, yaml.safe_load(f)) # recursive upadte
+            # Imported here to keep the import of this module cheap (for example for `--version`)
+            from .inventory import load_host_inventory
+
+            # Host entries are resolved against their templates once and looked up lazily (from an on-disk index if
+            # the config files did not change)
+            general, self._host_inventory = load_host_inventory(self._get_absolute_config_filepath())
+            update(self._config_dict["general"], copy.deepcopy(general))
 
     def __getitem__(self, item):
         # type: (Text) -> HostConfig
-        try:
-            host_config = {}
-
-            raw_host = self._config_dict["hosts"][item]
-            if "based_on" in raw_host and raw_host["based_on"] in self._config_dict["templates"]:
-                for k, v in self._config_dict["templates"][raw_host["based_on"]].items():
-                    host_config[k] = v
-
-            host_config["short_hostname"] = item
-
-            host_config.update(raw_host)
-            del host_config["based_on"]
-
-            if "html5_endpoint" in host_config:
-                return HTML5HostConfig(**host_config)
-            else:
-                return JavaHostConfig(**host_config)
-        except KeyError:
+        raw_host_config = self._host_inventory.get(item) if self._host_inventory is not None else None
+        if raw_host_config is None:
             raise InvalidHostnameError(
                 "{} is not present in the configuration. Please insert a host entry in '{}'.".format(
                     item, self._config_filepath
                 )
             )
+        host_config = dict(raw_host_config)
+        host_config["short_hostname"] = item
+
+        if "html5_endpoint" in host_config:
+            return HTML5HostConfig(**host_config)
+        else:
+            return JavaHostConfig(**host_config)
 
     def get_servers(self):
-        return self._config_dict['hosts'].keys()
+        # type: () -> Iterator[Text]
+        if self._host_inventory is None:
+            return iter(())
+        return self._host_inventory.hostnames()
 
     @property
     def java_docker_image(self):
@@ -261,5 +320,45 @@ class Config(object):
         # type: () -> Text
         return self._config_dict["general"]["x_resolution"]
 
+    @property
+    def resize_display(self):
+        # type: () -> bool
+        return self._config_dict["general"]["resize_display"]
+
+    @property
+    def share_java_containers(self):
+        # type: () -> bool
+        return self._config_dict["general"]["share_java_containers"]
+
+    @property
+    def max_shared_sessions(self):
+        # type: () -> int
+        return self._config_dict["general"]["max_shared_sessions"]
+
+    @property
+    def read_only_containers(self):
+        # type: () -> bool
+        return self._config_dict["general"]["read_only_containers"]
+
+    @property
+    def container_tmpfs_size(self):
+        # type: () -> Text
+        return self._config_dict["general"]["container_tmpfs_size"]
+
+    @property
+    def preflight_cache_ttls(self):
+        # type: () -> Dict[Text, Optional[float]]
+        return self._config_dict["general"]["preflight_cache_ttls"]
+
+    @property
+    def launch_timeout(self):
+        # type: () -> Optional[float]
+        return self._config_dict["general"]["launch_timeout"]
+
+    @property
+    def phase_timeouts(self):
+        # type: () -> Dict[Text, Optional[float]]
+        return self._config_dict["general"]["phase_timeouts"]
+
 
 config = Config(None)
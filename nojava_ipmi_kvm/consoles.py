@@ -0,0 +1,398 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import subprocess
+import tempfile
+import time
+import urllib.parse
+
+try:
+    from typing import Any, Dict, List, Optional, Text  # noqa: F401  # pylint: disable=unused-import
+except ImportError:
+    pass
+
+from .utils import get_cache_directory
+
+logger = logging.getLogger(__name__)
+
+# Labels of all containers started by this package
+VERSION_LABEL = "nojava-ipmi-kvm.version"
+HOST_LABEL = "nojava-ipmi-kvm.host"
+SHARED_LABEL = "nojava-ipmi-kvm.shared"
+# Labels of dedicated containers which identify the launching process
+OWNER_MACHINE_LABEL = "nojava-ipmi-kvm.owner-machine"
+OWNER_UID_LABEL = "nojava-ipmi-kvm.owner-uid"
+OWNER_PID_LABEL = "nojava-ipmi-kvm.owner-pid"
+START_TIME_LABEL = "nojava-ipmi-kvm.start-time"
+CONTAINER_LABELS = (
+    VERSION_LABEL,
+    HOST_LABEL,
+    SHARED_LABEL,
+    OWNER_MACHINE_LABEL,
+    OWNER_UID_LABEL,
+    OWNER_PID_LABEL,
+    START_TIME_LABEL,
+)
+REATTACH_CHECK_TIMEOUT = 2.0
+# Minimum time between two garbage collections which are triggered by launches
+COLLECTION_INTERVAL = 60.0
+# Tolerance for comparing the start time of a process with the start time label of a container
+PROCESS_START_TIME_TOLERANCE = 2.0
+
+
+class DetachedConsole:
+    # Metadata of a kvm console which keeps running after the launching process exited. The metadata is stored in a
+    # file per host which is only readable by the user since the url contains the VNC password.
+    def __init__(self, hostname, url, container_name, web_port, session=None, vnc_password=None, start_time=None):
+        # type: (Text, Text, Text, int, Optional[int], Optional[Text], Optional[float]) -> None
+        self._hostname = hostname
+        self._url = url
+        self._container_name = container_name
+        self._web_port = web_port
+        self._session = session
+        self._vnc_password = vnc_password
+        self._start_time = start_time if start_time is not None else time.time()
+
+    @classmethod
+    def from_dict(cls, console_dict):
+        # type: (Dict[Text, Any]) -> DetachedConsole
+        return cls(
+            console_dict["hostname"],
+            console_dict["url"],
+            console_dict["container_name"],
+            console_dict["web_port"],
+            console_dict.get("session"),
+            console_dict.get("vnc_password"),
+            console_dict.get("start_time"),
+        )
+
+    @classmethod
+    def from_kvm_viewer(cls, hostname, kvm_viewer):
+        # type: (Text, Any) -> DetachedConsole
+        return cls(
+            hostname,
+            kvm_viewer.url,
+            kvm_viewer.container_name,
+            kvm_viewer.web_port,
+            kvm_viewer.session,
+            getattr(kvm_viewer, "vnc_password", None),
+        )
+
+    @property
+    def hostname(self):
+        # type: () -> Text
+        return self._hostname
+
+    @property
+    def url(self):
+        # type: () -> Text
+        return self._url
+
+    @property
+    def container_name(self):
+        # type: () -> Text
+        return self._container_name
+
+    @property
+    def web_port(self):
+        # type: () -> int
+        return self._web_port
+
+    @property
+    def session(self):
+        # type: () -> Optional[int]
+        # Session number in a shared Java container, `None` for dedicated containers
+        return self._session
+
+    @property
+    def vnc_password(self):
+        # type: () -> Optional[Text]
+        return self._vnc_password
+
+    @property
+    def snapshot_url(self):
+        # type: () -> Optional[Text]
+        from .kvm import get_java_snapshot_url
+
+        if self._vnc_password is None:
+            return None
+        return get_java_snapshot_url(urllib.parse.urlsplit(self._url).hostname, self._web_port, self._vnc_password)
+
+    @property
+    def start_time(self):
+        # type: () -> float
+        return self._start_time
+
+    def as_dict(self):
+        # type: () -> Dict[Text, Any]
+        return {
+            "hostname": self._hostname,
+            "url": self._url,
+            "container_name": self._container_name,
+            "web_port": self._web_port,
+            "session": self._session,
+            "vnc_password": self._vnc_password,
+            "start_time": self._start_time,
+        }
+
+
+def get_detached_consoles_directory():
+    # type: () -> Text
+    return os.path.join(get_cache_directory(), "detached")
+
+
+def get_detached_console_filepath(hostname):
+    # type: (Text) -> Text
+    return os.path.join(get_detached_consoles_directory(), "{}.json".format(hostname.replace("/", "%")))
+
+
+def save_detached_console(console):
+    # type: (DetachedConsole) -> None
+    directory = get_detached_consoles_directory()
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    # `mkstemp` creates the file with mode 0600
+    file_descriptor, temp_filepath = tempfile.mkstemp(dir=directory, prefix=".detached-")
+    try:
+        with os.fdopen(file_descriptor, "w", encoding="utf-8") as f:
+            json.dump(console.as_dict(), f)
+        os.replace(temp_filepath, get_detached_console_filepath(console.hostname))
+    except BaseException:
+        os.remove(temp_filepath)
+        raise
+
+
+def load_detached_console(hostname):
+    # type: (Text) -> Optional[DetachedConsole]
+    try:
+        with open(get_detached_console_filepath(hostname), "r", encoding="utf-8") as f:
+            return DetachedConsole.from_dict(json.load(f))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.debug("Could not read the detached console of '%s': %s", hostname, e)
+        return None
+
+
+def remove_detached_console(hostname):
+    # type: (Text) -> None
+    try:
+        os.remove(get_detached_console_filepath(hostname))
+    except FileNotFoundError:
+        pass
+
+
+def list_detached_consoles():
+    # type: () -> List[DetachedConsole]
+    consoles = []  # type: List[DetachedConsole]
+    directory = get_detached_consoles_directory()
+    if not os.path.isdir(directory):
+        return consoles
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith(".json"):
+            console = load_detached_console(filename[: -len(".json")].replace("%", "/"))
+            if console is not None:
+                consoles.append(console)
+    return consoles
+
+
+def get_container_labels(short_hostname=None, java_version=None):
+    # type: (Optional[Text], Optional[Text]) -> List[Text]
+    # `docker run` arguments; dedicated containers are labeled with their host and the launching process (for the
+    # garbage collection of orphaned containers), shared containers with their Java version
+    from ._version import __version__
+
+    labels = {VERSION_LABEL: __version__}
+    if java_version is not None:
+        labels[SHARED_LABEL] = java_version
+    else:
+        labels.update(
+            {
+                OWNER_MACHINE_LABEL: socket.gethostname(),
+                OWNER_UID_LABEL: str(os.getuid()),
+                OWNER_PID_LABEL: str(os.getpid()),
+                START_TIME_LABEL: str(int(time.time())),
+            }
+        )
+        if short_hostname is not None:
+            labels[HOST_LABEL] = short_hostname
+    docker_args = []  # type: List[Text]
+    for key, value in sorted(labels.items()):
+        docker_args.extend(("--label", "{}={}".format(key, value)))
+    return docker_args
+
+
+def list_console_containers():
+    # type: () -> Dict[Text, Dict[Text, Text]]
+    # Returns the names of all running containers started by this package and their labels (only labels of this package
+    # which are set)
+    from .kvm import add_sudo_if_configured
+
+    output = subprocess.check_output(
+        add_sudo_if_configured(
+            [
+                "docker",
+                "ps",
+                "--filter",
+                "label={}".format(VERSION_LABEL),
+                "--format",
+                "\t".join(["{{.Names}}"] + ['{{{{.Label "{}"}}}}'.format(label) for label in CONTAINER_LABELS]),
+            ]
+        ),
+        stderr=subprocess.DEVNULL,
+    )
+    containers = {}  # type: Dict[Text, Dict[Text, Text]]
+    for line in output.decode("utf-8").splitlines():
+        fields = line.split("\t")
+        if fields[0]:
+            containers[fields[0]] = {label: value for label, value in zip(CONTAINER_LABELS, fields[1:]) if value}
+    return containers
+
+
+def get_process_start_time(pid):
+    # type: (int) -> Optional[float]
+    # Start time of a process as Unix time, only available on Linux
+    try:
+        with open("/proc/{}/stat".format(pid), "r") as f:
+            # The process name in parentheses can contain spaces, the start time is the 22nd field
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/stat", "r") as f:
+            boot_time = next(int(line.split()[1]) for line in f if line.startswith("btime "))
+    except (OSError, ValueError, IndexError, StopIteration):
+        return None
+    return boot_time + start_ticks / os.sysconf("SC_CLK_TCK")
+
+
+def is_owner_alive(pid, start_time):
+    # type: (int, float) -> bool
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists but belongs to another user
+        pass
+    # A process which was started after the container reuses the process id of the gone owner
+    process_start_time = get_process_start_time(pid)
+    return process_start_time is None or process_start_time <= start_time + PROCESS_START_TIME_TOLERANCE
+
+
+def find_orphaned_containers():
+    # type: () -> List[Text]
+    # Orphaned containers are dedicated containers of this user and machine whose launching process is gone (for
+    # example killed with SIGKILL or by a closed terminal) and which are not detached on purpose. Containers of other
+    # machines (remote Docker daemons) and other users are left alone, as their owners cannot be checked.
+    containers = list_console_containers()
+    # Read after listing the containers, so a console which is detached in the meantime is not collected
+    detached_container_names = set(console.container_name for console in list_detached_consoles())
+    machine = socket.gethostname()
+    uid = str(os.getuid())
+    orphaned_container_names = []  # type: List[Text]
+    for container_name, labels in sorted(containers.items()):
+        if (
+            container_name in detached_container_names
+            or labels.get(OWNER_MACHINE_LABEL) != machine
+            or labels.get(OWNER_UID_LABEL) != uid
+        ):
+            continue
+        try:
+            owner_pid = int(labels[OWNER_PID_LABEL])
+            start_time = float(labels[START_TIME_LABEL])
+        except (KeyError, ValueError):
+            continue
+        if not is_owner_alive(owner_pid, start_time):
+            orphaned_container_names.append(container_name)
+    return orphaned_container_names
+
+
+def collect_orphaned_containers():
+    # type: () -> List[Text]
+    # Kills all orphaned containers with a single `docker kill` call and returns their names
+    from .kvm import add_sudo_if_configured
+
+    orphaned_container_names = find_orphaned_containers()
+    if orphaned_container_names:
+        logger.info("Stopping orphaned Docker containers: %s", ", ".join(orphaned_container_names))
+        # Fails if a container terminated in the meantime, the others are killed anyway
+        subprocess.call(
+            add_sudo_if_configured(["docker", "kill"] + orphaned_container_names),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+    return orphaned_container_names
+
+
+_last_collection_time = None  # type: Optional[float]
+
+
+def collect_orphaned_containers_in_background():
+    # type: () -> None
+    # Called on every launch; runs the garbage collection in the default executor (at most once per
+    # `COLLECTION_INTERVAL`) without delaying the launch
+    global _last_collection_time
+    now = time.monotonic()
+    if _last_collection_time is not None and now - _last_collection_time < COLLECTION_INTERVAL:
+        return
+    _last_collection_time = now
+
+    def log_collection_error(future):
+        # type: (asyncio.Future) -> None
+        if not future.cancelled() and future.exception() is not None:
+            logger.debug("Could not collect orphaned Docker containers: %s", future.exception())
+
+    asyncio.get_event_loop().run_in_executor(None, collect_orphaned_containers).add_done_callback(log_collection_error)
+
+
+async def find_detached_console(hostname):
+    # type: (Text) -> Optional[DetachedConsole]
+    # Returns the detached console of the host if its container is still running and its web server responds. Stale
+    # metadata is removed.
+    from .http_client import get_connection_pool, HttpRequestError
+
+    console = load_detached_console(hostname)
+    if console is None:
+        return None
+    loop = asyncio.get_event_loop()
+    try:
+        containers = await loop.run_in_executor(None, list_console_containers)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    if console.container_name in containers:
+        try:
+            response = await get_connection_pool().head(
+                "http://{}/".format(urllib.parse.urlsplit(console.url).netloc), timeout=REATTACH_CHECK_TIMEOUT
+            )
+            if response.ok:
+                return console
+        except HttpRequestError:
+            pass
+    logger.debug("The detached console of '%s' is not running any more.", hostname)
+    remove_detached_console(hostname)
+    return None
+
+
+def stop_detached_console(console):
+    # type: (DetachedConsole) -> None
+    from .kvm import add_sudo_if_configured, detach_shared_java_session
+
+    if console.session is not None:
+        detach_shared_java_session(console.container_name, console.session, subprocess.DEVNULL)
+    else:
+        subprocess.call(
+            add_sudo_if_configured(["docker", "kill", console.container_name]),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+    remove_detached_console(console.hostname)
+
+
+__all__ = [
+    "DetachedConsole",
+    "collect_orphaned_containers",
+    "find_detached_console",
+    "list_console_containers",
+    "list_detached_consoles",
+    "save_detached_console",
+    "stop_detached_console",
+]
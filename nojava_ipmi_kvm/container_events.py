@@ -0,0 +1,101 @@
+import logging
+import os
+import subprocess
+import threading
+import time
+
+try:
+    from typing import Dict, Optional, Set, Text  # noqa: F401  # pylint: disable=unused-import
+except ImportError:
+    pass
+
+from .consoles import OWNER_PID_LABEL
+
+logger = logging.getLogger(__name__)
+
+# Dedicated containers run detached, so no client process per container reports their termination. Instead, one
+# `docker events` process per launching process reports the `die` events of all its containers (selected by the owner
+# pid label). The subscription starts before the first watched container and replays events since then
+# (`--since`), so a container which dies before the subscription is established is not missed.
+
+# Time the `--since` timestamp is moved back, covers clock differences of coarse timestamps
+EVENTS_SINCE_MARGIN = 1.0
+# Minimum time between two restarts of a `docker events` process which terminated unexpectedly
+EVENTS_RESTART_INTERVAL = 1.0
+
+
+class ContainerMonitor:
+    def __init__(self):
+        # type: () -> None
+        self._lock = threading.Lock()
+        self._watched_container_names = set()  # type: Set[Text]
+        self._exit_codes = {}  # type: Dict[Text, int]
+        self._process = None  # type: Optional[subprocess.Popen]
+        self._since = None  # type: Optional[float]
+
+    def watch(self, container_name):
+        # type: (Text) -> None
+        # Must be called before the container is started
+        with self._lock:
+            self._watched_container_names.add(container_name)
+            self._exit_codes.pop(container_name, None)
+            if self._process is None:
+                self._since = time.time() - EVENTS_SINCE_MARGIN
+                self._start_process()
+
+    def unwatch(self, container_name):
+        # type: (Text) -> None
+        with self._lock:
+            self._watched_container_names.discard(container_name)
+            self._exit_codes.pop(container_name, None)
+            if not self._watched_container_names and self._process is not None:
+                process, self._process = self._process, None
+                process.terminate()
+
+    def exit_code(self, container_name):
+        # type: (Text) -> Optional[int]
+        # Returns `None` while the container is running (or not started yet)
+        with self._lock:
+            return self._exit_codes.get(container_name)
+
+    def _start_process(self):
+        # type: () -> None
+        from .kvm import add_sudo_if_configured
+
+        self._process = subprocess.Popen(
+            add_sudo_if_configured(
+                ["docker", "events", "--since", "{:.3f}".format(self._since)]
+                + ["--filter", "type=container", "--filter", "event=die"]
+                + ["--filter", "label={}={}".format(OWNER_PID_LABEL, os.getpid())]
+                + ["--format", "{{.Actor.Attributes.name}} {{.Actor.Attributes.exitCode}}"]
+            ),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        threading.Thread(target=self._read_events, args=(self._process,), daemon=True).start()
+
+    def _read_events(self, process):
+        # type: (subprocess.Popen) -> None
+        start_time = time.monotonic()
+        for line in process.stdout:
+            try:
+                container_name, exit_code_text = line.decode("utf-8").split()
+                exit_code = int(exit_code_text)
+            except ValueError:
+                continue
+            with self._lock:
+                if container_name in self._watched_container_names:
+                    self._exit_codes[container_name] = exit_code
+        process.stdout.close()
+        process.wait()
+        # Restart a process which was not terminated by `unwatch` (for example after a restart of the Docker daemon);
+        # the replayed events since the first start are harmless
+        time.sleep(max(0.0, EVENTS_RESTART_INTERVAL - (time.monotonic() - start_time)))
+        with self._lock:
+            if self._process is process:
+                logger.debug("`docker events` terminated with return code %d, restarting it.", process.returncode)
+                self._start_process()
+
+
+container_monitor = ContainerMonitor()
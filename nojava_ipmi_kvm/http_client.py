@@ -0,0 +1,286 @@
+import asyncio
+import ssl
+import urllib.parse
+import weakref
+
+try:
+    from typing import Dict, List, Optional, Text, Tuple  # noqa: F401  # pylint: disable=unused-import
+except ImportError:
+    pass
+
+from ._version import __version__
+
+DEFAULT_MAX_CONNECTIONS = 32
+DEFAULT_MAX_IDLE_CONNECTIONS_PER_TARGET = 2
+DEFAULT_IDLE_TIMEOUT = 30.0
+# Requests to the same target (host and port) are limited by a token bucket: bursts of up to `burst` requests are sent
+# immediately, afterwards at most `rate` requests per second
+DEFAULT_REQUEST_RATE = 10.0
+DEFAULT_REQUEST_BURST = 10
+MAX_HEADER_COUNT = 100
+
+
+class HttpRequestError(Exception):
+    pass
+
+
+class HttpTimeoutError(HttpRequestError):
+    pass
+
+
+class HttpResponse:
+    def __init__(self, status_code, reason, headers):
+        # type: (int, Text, Dict[Text, Text]) -> None
+        self._status_code = status_code
+        self._reason = reason
+        self._headers = headers
+
+    @property
+    def status_code(self):
+        # type: () -> int
+        return self._status_code
+
+    @property
+    def reason(self):
+        # type: () -> Text
+        return self._reason
+
+    @property
+    def headers(self):
+        # type: () -> Dict[Text, Text]
+        # Header names are lower case
+        return self._headers
+
+    @property
+    def ok(self):
+        # type: () -> bool
+        return self._status_code < 400
+
+
+class _Connection:
+    def __init__(self, reader, writer, loop):
+        # type: (asyncio.StreamReader, asyncio.StreamWriter, asyncio.AbstractEventLoop) -> None
+        self.reader = reader
+        self.writer = writer
+        self.last_used = loop.time()
+
+    def close(self):
+        # type: () -> None
+        self.writer.close()
+
+
+class HttpConnectionPool:
+    # Minimal HTTP/1.1 client for the reachability and readiness probes of kvm launches (`HEAD` requests only). Keeps
+    # idle connections for reuse, limits the number of open connections and spaces out requests to the same target, so
+    # many concurrent launches do not flood a BMC or a starting container with probes. Requests to urls which must be
+    # sent through a proxy (`HTTP_PROXY`, `HTTPS_PROXY`, `ALL_PROXY` and `NO_PROXY` like `requests`) are sent with
+    # `requests` in an executor instead. Must only be used from the event loop it was created in (see
+    # `get_connection_pool`).
+    def __init__(
+        self,
+        max_connections=DEFAULT_MAX_CONNECTIONS,
+        max_idle_connections_per_target=DEFAULT_MAX_IDLE_CONNECTIONS_PER_TARGET,
+        idle_timeout=DEFAULT_IDLE_TIMEOUT,
+        request_rate=DEFAULT_REQUEST_RATE,
+        request_burst=DEFAULT_REQUEST_BURST,
+    ):
+        # type: (int, int, float, float, int) -> None
+        self._loop = asyncio.get_event_loop()
+        self._connection_slots = asyncio.Semaphore(max_connections)
+        self._max_idle_connections_per_target = max_idle_connections_per_target
+        self._idle_timeout = idle_timeout
+        self._request_rate = request_rate
+        self._request_burst = request_burst
+        self._idle_connections = {}  # type: Dict[Tuple[Text, Text, int], List[_Connection]]
+        # Target -> (available tokens, time of the last update); full buckets are removed from time to time
+        self._request_tokens = {}  # type: Dict[Tuple[Text, int], Tuple[float, float]]
+        self._next_request_token_eviction = self._loop.time()
+        self._ssl_context = None  # type: Optional[ssl.SSLContext]
+
+    async def head(self, url, headers=None, timeout=None):
+        # type: (Text, Optional[Dict[Text, Text]], Optional[float]) -> HttpResponse
+        # `timeout` limits the whole request including the wait for a free connection and the rate limit
+        try:
+            return await asyncio.wait_for(self._head(url, headers, timeout), timeout)
+        except asyncio.TimeoutError:
+            raise HttpTimeoutError("The request to '{}' timed out after {} s.".format(url, timeout))
+
+    async def _head(self, url, headers, timeout):
+        # type: (Text, Optional[Dict[Text, Text]], Optional[float]) -> HttpResponse
+        parsed_url = urllib.parse.urlsplit(url)
+        if parsed_url.scheme not in ("http", "https") or not parsed_url.hostname:
+            raise HttpRequestError("Unsupported url '{}'.".format(url))
+        port = parsed_url.port or (443 if parsed_url.scheme == "https" else 80)
+        target = (parsed_url.scheme, parsed_url.hostname, port)
+        path = parsed_url.path or "/"
+        if parsed_url.query:
+            path += "?" + parsed_url.query
+        request_headers = {
+            "Host": parsed_url.netloc,
+            "User-Agent": "nojava-ipmi-kvm/{}".format(__version__),
+            "Accept": "*/*",
+        }
+        request_headers.update(headers or {})
+        request = "HEAD {} HTTP/1.1\r\n{}\r\n".format(
+            path, "".join("{}: {}\r\n".format(key, value) for key, value in request_headers.items())
+        ).encode("latin-1")
+
+        await self._wait_for_request_slot(target[1:])
+        if get_proxy_url(parsed_url) is not None:
+            return await self._loop.run_in_executor(None, head_with_requests, url, headers, timeout)
+        async with self._connection_slots:
+            connection = self._pop_idle_connection(target)
+            if connection is not None:
+                try:
+                    return await self._send_request(target, connection, request)
+                except HttpRequestError:
+                    # The server may have closed the idle connection in the meantime
+                    pass
+            return await self._send_request(target, await self._open_connection(target), request)
+
+    async def _wait_for_request_slot(self, host_and_port):
+        # type: (Tuple[Text, int]) -> None
+        # The token is taken before sleeping (the token count can get negative), so waiting requests are spaced out
+        now = self._loop.time()
+        if now >= self._next_request_token_eviction:
+            self._evict_full_request_token_buckets(now)
+        tokens, last_update = self._request_tokens.get(host_and_port, (float(self._request_burst), now))
+        tokens = min(float(self._request_burst), tokens + (now - last_update) * self._request_rate) - 1
+        self._request_tokens[host_and_port] = (tokens, now)
+        if tokens < 0:
+            await asyncio.sleep(-tokens / self._request_rate)
+
+    def _evict_full_request_token_buckets(self, now):
+        # type: (float) -> None
+        # A full bucket behaves like a missing one, so only targets with recent requests are kept. An empty bucket is
+        # full again after `burst / rate` seconds, which is the interval of the eviction.
+        self._request_tokens = {
+            host_and_port: (tokens, last_update)
+            for host_and_port, (tokens, last_update) in self._request_tokens.items()
+            if tokens + (now - last_update) * self._request_rate < self._request_burst
+        }
+        self._next_request_token_eviction = now + self._request_burst / self._request_rate
+
+    def _pop_idle_connection(self, target):
+        # type: (Tuple[Text, Text, int]) -> Optional[_Connection]
+        idle_connections = self._idle_connections.get(target, [])
+        while idle_connections:
+            connection = idle_connections.pop()
+            if self._loop.time() - connection.last_used < self._idle_timeout and not connection.reader.at_eof():
+                return connection
+            connection.close()
+        return None
+
+    async def _open_connection(self, target):
+        # type: (Tuple[Text, Text, int]) -> _Connection
+        scheme, host, port = target
+        if scheme == "https" and self._ssl_context is None:
+            self._ssl_context = ssl.create_default_context()
+        try:
+            reader, writer = await asyncio.open_connection(
+                host, port, ssl=self._ssl_context if scheme == "https" else None
+            )
+        except (OSError, ssl.SSLError) as e:
+            raise HttpRequestError("Cannot connect to {}:{}: {}".format(host, port, e))
+        return _Connection(reader, writer, self._loop)
+
+    async def _send_request(self, target, connection, request):
+        # type: (Tuple[Text, Text, int], _Connection, bytes) -> HttpResponse
+        keep_alive = False
+        try:
+            connection.writer.write(request)
+            await connection.writer.drain()
+            response, keep_alive = await self._read_response(connection.reader)
+            return response
+        except (OSError, ssl.SSLError, asyncio.IncompleteReadError, ValueError) as e:
+            raise HttpRequestError("The request to {}:{} failed: {}".format(target[1], target[2], e))
+        finally:
+            # Also reached on cancellation, the connection state is unknown in this case
+            if keep_alive:
+                connection.last_used = self._loop.time()
+                idle_connections = self._idle_connections.setdefault(target, [])
+                if len(idle_connections) < self._max_idle_connections_per_target:
+                    idle_connections.append(connection)
+                else:
+                    connection.close()
+            else:
+                connection.close()
+
+    @staticmethod
+    async def _read_response(reader):
+        # type: (asyncio.StreamReader) -> Tuple[HttpResponse, bool]
+        while True:
+            status_line = (await reader.readline()).decode("latin-1").rstrip("\r\n")
+            if not status_line:
+                raise ValueError("The connection was closed without a response.")
+            http_version, status_code_text, reason = (status_line.split(" ", 2) + [""])[:3]
+            if not http_version.startswith("HTTP/"):
+                raise ValueError("Invalid status line '{}'.".format(status_line))
+            status_code = int(status_code_text)
+            headers = {}  # type: Dict[Text, Text]
+            for _ in range(MAX_HEADER_COUNT + 1):
+                header_line = (await reader.readline()).decode("latin-1").rstrip("\r\n")
+                if not header_line:
+                    break
+                key, value = header_line.split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+            else:
+                raise ValueError("Too many response headers.")
+            # Skip informational responses like `100 Continue`
+            if status_code >= 200:
+                break
+        connection_header = headers.get("connection", "").lower()
+        keep_alive = (
+            connection_header == "keep-alive" if http_version == "HTTP/1.0" else connection_header != "close"
+        ) and not reader.at_eof()
+        # Responses to `HEAD` requests have no body
+        return HttpResponse(status_code, reason, headers), keep_alive
+
+    def close(self):
+        # type: () -> None
+        for idle_connections in self._idle_connections.values():
+            for connection in idle_connections:
+                connection.close()
+        self._idle_connections.clear()
+
+
+def get_proxy_url(parsed_url):
+    # type: (urllib.parse.SplitResult) -> Optional[Text]
+    # Proxy settings of the environment (and of the system on macOS and Windows), like `requests`
+    import urllib.request
+
+    if urllib.request.proxy_bypass(parsed_url.netloc):
+        return None
+    proxies = urllib.request.getproxies()
+    return proxies.get(parsed_url.scheme) or proxies.get("all")
+
+
+def head_with_requests(url, headers, timeout):
+    # type: (Text, Optional[Dict[Text, Text]], Optional[float]) -> HttpResponse
+    # Blocking, called in an executor
+    import requests
+
+    try:
+        response = requests.head(url, headers=headers, timeout=timeout)
+    except requests.RequestException as e:
+        raise HttpRequestError("The request to '{}' failed: {}".format(url, e))
+    return HttpResponse(
+        response.status_code, response.reason, {key.lower(): value for key, value in response.headers.items()}
+    )
+
+
+_connection_pools = weakref.WeakKeyDictionary()  # type: weakref.WeakKeyDictionary
+
+
+def get_connection_pool():
+    # type: () -> HttpConnectionPool
+    # One pool per event loop since connections and semaphores are bound to the loop they were created in
+    loop = asyncio.get_event_loop()
+    connection_pool = _connection_pools.get(loop)
+    if connection_pool is None:
+        connection_pool = HttpConnectionPool()
+        _connection_pools[loop] = connection_pool
+    return connection_pool
+
+
+__all__ = ["HttpConnectionPool", "HttpRequestError", "HttpResponse", "HttpTimeoutError", "get_connection_pool"]
@@ -0,0 +1,218 @@
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+
+try:
+    from typing import (  # noqa: F401  # pylint: disable=unused-import
+        Callable,
+        Dict,
+        Iterable,
+        List,
+        Optional,
+        Set,
+        Text,
+        Tuple,
+    )
+except ImportError:
+    pass
+
+from .config import config, HostConfig, HTML5HostConfig, JavaHostConfig
+from .utils import get_cache_directory
+from ._version import __version__
+
+logger = logging.getLogger(__name__)
+
+IMAGE_PINS_FORMAT_VERSION = 1
+DEFAULT_PULL_CONCURRENCY = 4
+
+
+class ImagePullError(Exception):
+    pass
+
+
+def get_docker_image(host_config):
+    # type: (HostConfig) -> Text
+    if isinstance(host_config, JavaHostConfig):
+        java_provider = "oraclejre" if host_config.java_version.endswith("-oracle") else "openjdk"
+        java_major_version = host_config.java_version.split("u")[0]
+        return config.java_docker_image.format(
+            version=__version__, java_provider=java_provider, java_major_version=java_major_version
+        )
+    elif isinstance(host_config, HTML5HostConfig):
+        return config.html5_docker_image.format(version=__version__)
+    raise ValueError("Invalid host config class")
+
+
+def get_required_docker_images(host_configs):
+    # type: (Iterable[HostConfig]) -> List[Text]
+    # Distinct images in order of their first use
+    docker_images = []  # type: List[Text]
+    seen_docker_images = set()  # type: Set[Text]
+    for host_config in host_configs:
+        docker_image = get_docker_image(host_config)
+        if docker_image not in seen_docker_images:
+            seen_docker_images.add(docker_image)
+            docker_images.append(docker_image)
+    return docker_images
+
+
+def get_image_pins_filepath():
+    # type: () -> Text
+    return os.path.join(get_cache_directory(), "image-pins.json")
+
+
+def read_image_pins():
+    # type: () -> Dict[Text, Text]
+    # Maps image names (with tag) to the digest references (`<repository>@sha256:...`) recorded by the last prefetch
+    try:
+        with open(get_image_pins_filepath(), "r", encoding="utf-8") as f:
+            pins_dict = json.load(f)
+        if pins_dict.get("format_version") != IMAGE_PINS_FORMAT_VERSION:
+            return {}
+        return {docker_image: pin["reference"] for docker_image, pin in pins_dict["pins"].items()}
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.debug("Could not read the image pins: %s", e)
+        return {}
+
+
+def write_image_pins(new_pins):
+    # type: (Dict[Text, Text]) -> None
+    # Merges `new_pins` into the pins file
+    pins_filepath = get_image_pins_filepath()
+    pins = {}  # type: Dict[Text, Dict[Text, object]]
+    try:
+        with open(pins_filepath, "r", encoding="utf-8") as f:
+            pins_dict = json.load(f)
+        if pins_dict.get("format_version") == IMAGE_PINS_FORMAT_VERSION:
+            pins = pins_dict["pins"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    for docker_image, reference in new_pins.items():
+        pins[docker_image] = {"reference": reference, "pinned_at": round(time.time())}
+    os.makedirs(os.path.dirname(pins_filepath), exist_ok=True)
+    file_descriptor, temp_filepath = tempfile.mkstemp(dir=os.path.dirname(pins_filepath), prefix=".image-pins-")
+    try:
+        with os.fdopen(file_descriptor, "w", encoding="utf-8") as f:
+            json.dump({"format_version": IMAGE_PINS_FORMAT_VERSION, "pins": pins}, f, indent=2, sort_keys=True)
+        os.replace(temp_filepath, pins_filepath)
+    except BaseException:
+        os.remove(temp_filepath)
+        raise
+
+
+def resolve_pinned_image(docker_image):
+    # type: (Text) -> Text
+    # Launches use the pinned digest, so the image is neither resolved nor pulled again if its tag moved
+    return read_image_pins().get(docker_image, docker_image)
+
+
+async def run_docker_command(args, output_callback=None):
+    # type: (List[Text], Optional[Callable[[Text], None]]) -> Tuple[int, Text]
+    # Runs a `docker` command as asyncio subprocess and returns its exit code and output (stdout and stderr). The
+    # process is killed if the coroutine is cancelled.
+    from .kvm import add_sudo_if_configured
+
+    process = await asyncio.create_subprocess_exec(
+        *add_sudo_if_configured(["docker"] + args), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT
+    )
+    output_lines = []  # type: List[Text]
+    try:
+        while True:
+            line = await process.stdout.readline()
+            if not line:
+                break
+            output_lines.append(line.decode("utf-8", errors="replace").rstrip())
+            if output_callback is not None:
+                output_callback(output_lines[-1])
+        return_code = await process.wait()
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+        raise
+    return return_code, "\n".join(output_lines)
+
+
+async def pull_image(docker_image, progress_callback=None):
+    # type: (Text, Optional[Callable[[Text, int, int], None]]) -> Text
+    # Pulls an image and returns its digest reference. `progress_callback` is called with the image name, the number
+    # of completed layers and the number of all layers whenever a layer is finished.
+    layers = set()  # type: Set[Text]
+    completed_layers = set()  # type: Set[Text]
+
+    def handle_output_line(line):
+        # type: (Text) -> None
+        # Lines have the format `<layer id>: <status>` (for example `Pulling fs layer` or `Pull complete`)
+        layer_id, _, status = line.partition(": ")
+        if not status or " " in layer_id:
+            return
+        if status.startswith(("Pulling fs layer", "Waiting", "Already exists", "Pull complete")):
+            layers.add(layer_id)
+        if status.startswith(("Already exists", "Pull complete")) and layer_id not in completed_layers:
+            completed_layers.add(layer_id)
+            if progress_callback is not None:
+                progress_callback(docker_image, len(completed_layers), len(layers))
+
+    return_code, output = await run_docker_command(["pull", docker_image], handle_output_line)
+    if return_code != 0:
+        output_lines = output.splitlines()
+        raise ImagePullError(
+            "Pulling '{}' failed: {}".format(docker_image, output_lines[-1] if output_lines else return_code)
+        )
+    return_code, output = await run_docker_command(
+        ["image", "inspect", "--format", "{{range .RepoDigests}}{{println .}}{{end}}", docker_image]
+    )
+    repository = docker_image.rsplit(":", 1)[0] if ":" in docker_image.rsplit("/", 1)[-1] else docker_image
+    repo_digests = [line.strip() for line in output.splitlines() if line.strip()] if return_code == 0 else []
+    # Prefer the digest of the pulled repository if the image is known under several names
+    for repo_digest in repo_digests:
+        if repo_digest.split("@")[0] == repository:
+            return repo_digest
+    if not repo_digests:
+        raise ImagePullError("The image '{}' has no registry digest.".format(docker_image))
+    return repo_digests[0]
+
+
+async def prefetch_images(docker_images, concurrency=DEFAULT_PULL_CONCURRENCY, progress_callback=None):
+    # type: (List[Text], int, Optional[Callable[[Text, int, int], None]]) -> Dict[Text, Optional[Exception]]
+    # Pulls all images with at most `concurrency` pulls at the same time and pins the digests of all successfully pulled
+    # images. Returns the error of every image (`None` on success).
+    semaphore = asyncio.Semaphore(concurrency)
+    pins = {}  # type: Dict[Text, Text]
+    errors = {}  # type: Dict[Text, Optional[Exception]]
+
+    async def prefetch_image(docker_image):
+        # type: (Text) -> None
+        async with semaphore:
+            start_time = time.monotonic()
+            logger.info("Pulling %s...", docker_image)
+            try:
+                pins[docker_image] = await pull_image(docker_image, progress_callback)
+            except (ImagePullError, OSError) as e:
+                logger.error(str(e))
+                errors[docker_image] = e
+                return
+            errors[docker_image] = None
+            logger.info(
+                "Pulled %s in %.1f s, pinned to %s.", docker_image, time.monotonic() - start_time, pins[docker_image]
+            )
+
+    try:
+        await asyncio.gather(*(prefetch_image(docker_image) for docker_image in docker_images))
+    finally:
+        if pins:
+            write_image_pins(pins)
+    return errors
+
+
+__all__ = [
+    "ImagePullError",
+    "get_docker_image",
+    "get_required_docker_images",
+    "prefetch_images",
+    "resolve_pinned_image",
+]
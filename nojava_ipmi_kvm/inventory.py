@@ -0,0 +1,271 @@
+import collections
+import glob
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import urllib.parse
+
+try:
+    import sqlite3
+
+    sqlite_available = True
+except ImportError:
+    sqlite_available = False
+
+try:
+    from typing import Any, Dict, Iterator, List, Optional, Text, Tuple  # noqa: F401  # pylint: disable=unused-import
+except ImportError:
+    pass
+
+from .utils import get_cache_directory, update
+
+logger = logging.getLogger(__name__)
+
+INDEX_FORMAT_VERSION = 1
+
+
+class IncludeNotFoundError(Exception):
+    pass
+
+
+def get_source_stamp(path):
+    # type: (Text) -> Tuple[Text, int, int]
+    stat_result = os.stat(path)
+    return (path, stat_result.st_mtime_ns, stat_result.st_size)
+
+
+def read_config_files(config_filepath):
+    # type: (Text) -> Tuple[Dict[Text, Any], List[Tuple[Text, int, int]]]
+    # Reads a config file and all files referenced by its `include` key (recursively). Included files are merged in
+    # order and the including file is merged last, so its values take precedence. `include` entries are paths, glob
+    # patterns or directories (all `*.yaml` and `*.yml` files in it) relative to the including file. Returns the merged
+    # config and the modification stamps of all read files and directories.
+    # `yaml` is only needed if the index is outdated
+    import yaml
+
+    # The LibYAML based loader is much faster for large configurations
+    safe_loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    source_stamps = []  # type: List[Tuple[Text, int, int]]
+    visited_filepaths = set()
+
+    def read_file(filepath):
+        # type: (Text) -> Dict[Text, Any]
+        filepath = os.path.abspath(filepath)
+        if filepath in visited_filepaths:
+            return {}
+        visited_filepaths.add(filepath)
+        # Take the stamp before reading to not miss modifications while reading
+        source_stamps.append(get_source_stamp(filepath))
+        with open(filepath, "r", encoding="utf-8") as f:
+            raw_config = yaml.load(f, Loader=safe_loader) or {}
+        includes = raw_config.pop("include", [])
+        if isinstance(includes, str):
+            includes = [includes]
+        merged_config = {}  # type: Dict[Text, Any]
+        for include in includes:
+            for included_filepath in resolve_include(include, os.path.dirname(filepath)):
+                update(merged_config, read_file(included_filepath))
+        return update(merged_config, raw_config)
+
+    def resolve_include(include, base_directory):
+        # type: (Text, Text) -> List[Text]
+        include_path = os.path.join(base_directory, os.path.expanduser(include))
+        if os.path.isdir(include_path):
+            source_stamps.append(get_source_stamp(include_path))
+            return sorted(
+                os.path.join(include_path, filename)
+                for filename in os.listdir(include_path)
+                if filename.endswith((".yaml", ".yml"))
+            )
+        if glob.has_magic(include_path):
+            add_directory_stamps(os.path.dirname(include_path))
+            return sorted(glob.glob(include_path))
+        if not os.path.isfile(include_path):
+            raise IncludeNotFoundError("The included config file '{}' does not exist.".format(include_path))
+        return [include_path]
+
+    def add_directory_stamps(directory_pattern):
+        # type: (Text) -> None
+        # Track the directories of a glob pattern to notice new matching files (and new matching directories)
+        if glob.has_magic(directory_pattern):
+            add_directory_stamps(os.path.dirname(directory_pattern))
+            directories = sorted(glob.glob(directory_pattern))
+        else:
+            directories = [directory_pattern]
+        for directory in directories:
+            if os.path.isdir(directory):
+                source_stamps.append(get_source_stamp(directory))
+
+    return read_file(config_filepath), source_stamps
+
+
+def resolve_hosts(config_dict):
+    # type: (Dict[Text, Any]) -> Iterator[Tuple[Text, Dict[Text, Any]]]
+    # Merges each host entry into its `based_on` template
+    templates = config_dict.get("templates") or {}
+    for hostname, raw_host in (config_dict.get("hosts") or {}).items():
+        host_config = {}  # type: Dict[Text, Any]
+        if "based_on" in raw_host and raw_host["based_on"] in templates:
+            host_config.update(templates[raw_host["based_on"]])
+        host_config.update(raw_host)
+        host_config.pop("based_on", None)
+        yield str(hostname), host_config
+
+
+class MemoryHostInventory(object):
+    def __init__(self, hosts):
+        # type: (Dict[Text, Dict[Text, Any]]) -> None
+        self._hosts = hosts
+
+    def get(self, hostname):
+        # type: (Text) -> Optional[Dict[Text, Any]]
+        return self._hosts.get(hostname)
+
+    def hostnames(self):
+        # type: () -> Iterator[Text]
+        return iter(self._hosts)
+
+
+class IndexedHostInventory(object):
+    # Looks up resolved host entries in the on-disk index, so only the requested entry is deserialized
+    def __init__(self, connection):
+        # type: (sqlite3.Connection) -> None
+        self._connection = connection
+
+    def get(self, hostname):
+        # type: (Text) -> Optional[Dict[Text, Any]]
+        row = self._connection.execute("SELECT config FROM hosts WHERE name = ?", (hostname,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def hostnames(self):
+        # type: () -> Iterator[Text]
+        for (hostname,) in self._connection.execute("SELECT name FROM hosts ORDER BY rowid"):
+            yield hostname
+
+    def source_paths(self):
+        # type: () -> List[Text]
+        return [path for (path,) in self._connection.execute("SELECT path FROM sources")]
+
+
+def get_index_filepath(config_filepath):
+    # type: (Text) -> Text
+    return os.path.join(
+        get_cache_directory(),
+        "inventory-{}.sqlite".format(hashlib.sha1(config_filepath.encode("utf-8")).hexdigest()[:16]),
+    )
+
+
+def get_hostname_cache_filepath(config_filepath):
+    # type: (Text) -> Text
+    # The completion scripts derive the same path from the absolute config file path without calling Python
+    return os.path.join(get_cache_directory(), "hostnames", config_filepath.replace("/", "%"))
+
+
+def write_hostname_cache(cache_filepath, hostnames, source_paths):
+    # type: (Text, Iterator[Text], List[Text]) -> None
+    # Plain text list of all host names for shell completion. The `#source` header lines name all config files and
+    # included directories; the cache is outdated if one of them is newer than the cache file.
+    temp_filepath = None
+    try:
+        os.makedirs(os.path.dirname(cache_filepath), exist_ok=True)
+        file_descriptor, temp_filepath = tempfile.mkstemp(dir=os.path.dirname(cache_filepath), prefix=".hostnames-")
+        with os.fdopen(file_descriptor, "w", encoding="utf-8") as f:
+            f.writelines("#source {}\n".format(path) for path in source_paths)
+            f.writelines("{}\n".format(hostname) for hostname in hostnames)
+        os.chmod(temp_filepath, 0o644)
+        os.replace(temp_filepath, cache_filepath)
+        temp_filepath = None
+    except OSError as e:
+        logger.debug("Could not write the host name cache '%s': %s", cache_filepath, e)
+    finally:
+        if temp_filepath is not None and os.path.exists(temp_filepath):
+            os.remove(temp_filepath)
+
+
+def open_index(index_filepath):
+    # type: (Text) -> Optional[Tuple[Dict[Text, Any], IndexedHostInventory]]
+    # Returns `None` if the index does not exist or any config file changed since the index was written
+    if not sqlite_available or not os.path.isfile(index_filepath):
+        return None
+    try:
+        connection = sqlite3.connect(
+            "file:{}?mode=ro".format(urllib.parse.quote(index_filepath)), uri=True, check_same_thread=False
+        )
+        metadata = dict(connection.execute("SELECT key, value FROM metadata"))
+        if metadata.get("format_version") != str(INDEX_FORMAT_VERSION):
+            connection.close()
+            return None
+        for path, mtime_ns, size in connection.execute("SELECT path, mtime_ns, size FROM sources"):
+            try:
+                if get_source_stamp(path) != (path, mtime_ns, size):
+                    connection.close()
+                    return None
+            except OSError:
+                connection.close()
+                return None
+        return json.loads(metadata["general"]), IndexedHostInventory(connection)
+    except (sqlite3.Error, KeyError, ValueError):
+        logger.debug("Could not read the config index '%s'.", index_filepath)
+        return None
+
+
+def write_index(index_filepath, general, hosts, source_stamps):
+    # type: (Text, Dict[Text, Any], Dict[Text, Dict[Text, Any]], List[Tuple[Text, int, int]]) -> None
+    # The index is only a cache, so failures are not fatal
+    temp_filepath = None
+    try:
+        os.makedirs(os.path.dirname(index_filepath), exist_ok=True)
+        file_descriptor, temp_filepath = tempfile.mkstemp(
+            dir=os.path.dirname(index_filepath), prefix=".inventory-", suffix=".sqlite"
+        )
+        os.close(file_descriptor)
+        connection = sqlite3.connect(temp_filepath)
+        with connection:
+            connection.execute("CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT)")
+            connection.execute("CREATE TABLE sources (path TEXT, mtime_ns INTEGER, size INTEGER)")
+            connection.execute("CREATE TABLE hosts (name TEXT PRIMARY KEY, config TEXT)")
+            connection.executemany(
+                "INSERT INTO metadata VALUES (?, ?)",
+                (("format_version", str(INDEX_FORMAT_VERSION)), ("general", json.dumps(general))),
+            )
+            connection.executemany("INSERT INTO sources VALUES (?, ?, ?)", source_stamps)
+            connection.executemany(
+                "INSERT INTO hosts VALUES (?, ?)",
+                ((hostname, json.dumps(host_config)) for hostname, host_config in hosts.items()),
+            )
+        connection.close()
+        os.replace(temp_filepath, index_filepath)
+        temp_filepath = None
+    except (OSError, sqlite3.Error, TypeError, ValueError) as e:
+        logger.debug("Could not write the config index '%s': %s", index_filepath, e)
+    finally:
+        if temp_filepath is not None and os.path.exists(temp_filepath):
+            os.remove(temp_filepath)
+
+
+def load_host_inventory(config_filepath):
+    # type: (Text) -> Tuple[Dict[Text, Any], Any]
+    # Returns the `general` config section and a host inventory. The config files are only parsed if the on-disk index
+    # is missing or outdated.
+    index_filepath = get_index_filepath(config_filepath)
+    hostname_cache_filepath = get_hostname_cache_filepath(config_filepath)
+    index = open_index(index_filepath)
+    if index is not None:
+        general, host_inventory = index
+        if not os.path.exists(hostname_cache_filepath):
+            write_hostname_cache(hostname_cache_filepath, host_inventory.hostnames(), host_inventory.source_paths())
+        return general, host_inventory
+    config_dict, source_stamps = read_config_files(config_filepath)
+    general = config_dict.get("general") or {}
+    hosts = collections.OrderedDict(resolve_hosts(config_dict))
+    if sqlite_available:
+        write_index(index_filepath, general, hosts, source_stamps)
+    write_hostname_cache(hostname_cache_filepath, iter(hosts), [path for path, _, _ in source_stamps])
+    return general, MemoryHostInventory(hosts)
+
+
+__all__ = ["IncludeNotFoundError", "load_host_inventory", "read_config_files"]
@@ -2,24 +2,44 @@ import atexit
 import logging
 import os
 import platform
-import requests
 import subprocess
+import threading
+import time
 import uuid
 import re
 
 import asyncio
 
 try:
-    from typing import Any, Callable, List, Optional, Text, Tuple  # noqa: F401  # pylint: disable=unused-import
+    from typing import (  # noqa: F401  # pylint: disable=unused-import
+        Any,
+        Awaitable,
+        Callable,
+        Dict,
+        List,
+        Optional,
+        Set,
+        Text,
+        Tuple,
+    )
 except ImportError:
     pass
 
+from .consoles import collect_orphaned_containers_in_background, get_container_labels
+from .container_events import container_monitor
+from .images import get_docker_image, resolve_pinned_image
+from .http_client import get_connection_pool, HttpRequestError, HttpTimeoutError
+from .metrics import metrics
+from .preflight import get_preflight_cache
+from .trace import LaunchTrace
 from .utils import generate_temp_password
 from .config import config, HostConfig, HTML5HostConfig, JavaHostConfig
-from ._version import __version__
 
 logger = logging.getLogger(__name__)
 
+# Maximum time in seconds to wait for the containers of all live kvm viewers to stop
+CLOSE_ALL_TIMEOUT = 30.0
+
 
 class WebserverNotReachableError(Exception):
     pass
@@ -41,6 +61,60 @@ class DockerTerminatedError(Exception):
     pass
 
 
+class LaunchTimeoutError(Exception):
+    # Raised if a launch exceeds `launch_timeout`; base class of all phase timeout errors
+    pass
+
+
+class WebserverCheckTimeoutError(LaunchTimeoutError):
+    pass
+
+
+class DockerCheckTimeoutError(LaunchTimeoutError):
+    pass
+
+
+class ContainerStartTimeoutError(LaunchTimeoutError):
+    pass
+
+
+class SessionAddTimeoutError(LaunchTimeoutError):
+    pass
+
+
+class PortDiscoveryTimeoutError(LaunchTimeoutError):
+    pass
+
+
+class ReadinessTimeoutError(LaunchTimeoutError):
+    pass
+
+
+PHASE_TIMEOUT_ERRORS = {
+    "check_webserver": WebserverCheckTimeoutError,
+    "check_docker": DockerCheckTimeoutError,
+    "container_start": ContainerStartTimeoutError,
+    "session_add": SessionAddTimeoutError,
+    "port_discovery": PortDiscoveryTimeoutError,
+    "readiness_wait": ReadinessTimeoutError,
+}
+# Upper bound for a single readiness probe, a hanging probe is retried
+READINESS_REQUEST_TIMEOUT = 5.0
+# Dedicated containers run detached and read their password (Java) or config (HTML5) once from a named pipe on a tmpfs
+# mount, which is written with a short-lived `docker exec -i`
+SECRET_DIRECTORY = "/run/nojava-ipmi-kvm"
+SECRET_FIFO = SECRET_DIRECTORY + "/secret"
+# Writable directories of containers with a read-only root filesystem (`read_only_containers`) and their modes; Java
+# viewers and native libraries of kvm viewer jars are executed from `/tmp` and `/root`, the X server compiles its
+# keymaps to `/var/lib/xkb`
+JAVA_TMPFS_MOUNTS = (("/tmp", "1777", True), ("/root", "0700", True), ("/var/lib/xkb", "0755", False))
+HTML5_TMPFS_MOUNTS = (("/tmp", "1777", False), ("/root", "0700", False))
+# Waits at most 30 seconds for the container to create the named pipe (passed as `$0`) and copies stdin into it
+WRITE_SECRET_SCRIPT = (
+    'i=0; while [ ! -p "$0" ]; do [ "$i" -lt 300 ] || exit 1; i=$((i + 1)); sleep 0.1; done; cat > "$0"'
+)
+
+
 def running_macos():
     # type: () -> bool
     return platform.system() == "Darwin"
@@ -55,15 +129,61 @@ def is_command_available(command):
     return False
 
 
+def get_java_console_url(external_vnc_dns, web_port, vnc_password, view_only=False):
+    # type: (Text, int, Text, bool) -> Text
+    url = "http://{ext_dns}:{web_port}/vnc.html?host={ext_dns}&port={web_port}&autoconnect=true&password={password}".format(
+        ext_dns=external_vnc_dns, password=vnc_password, web_port=web_port
+    )
+    if view_only:
+        # Only a hint for noVNC, the access is restricted by the VNC server
+        url += "&view_only=true"
+    return url
+
+
+def get_java_snapshot_url(external_vnc_dns, web_port, vnc_password, width=None):
+    # type: (Text, int, Text, Optional[int]) -> Text
+    # Downscaled PNG image of the console screen; snapshots are cached for two seconds in the container
+    url = "http://{ext_dns}:{web_port}/snapshot.png?password={password}".format(
+        ext_dns=external_vnc_dns, password=vnc_password, web_port=web_port
+    )
+    if width is not None:
+        url += "&width={:d}".format(width)
+    return url
+
+
 class KvmViewer:
-    def __init__(self, url, external_vnc_dns, web_port, kill_process):
+    def __init__(
+        self,
+        url,
+        external_vnc_dns,
+        web_port,
+        kill_process,
+        launch_trace=None,
+        container_name=None,
+        session=None,
+        detach_process=None,
+    ):
         self._url = url
         self._external_vnc_dns = external_vnc_dns
         self._web_port = web_port
         self._kill_process = kill_process
         self._already_killed = False
+        self._lock = threading.Lock()
+        self._launch_trace = launch_trace  # type: Optional[LaunchTrace]
+        self._container_name = container_name  # type: Optional[Text]
+        self._session = session  # type: Optional[int]
+        self._detach_process = detach_process  # type: Optional[Callable[[], None]]
+
+        # Stopped by `close_all_kvm_viewers` on exit unless closed or detached before
+        live_kvm_viewers.add(self)
+
+    async def __aenter__(self):
+        # type: () -> KvmViewer
+        return self
 
-        atexit.register(self.kill_process)
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        # type: (Any, Any, Any) -> None
+        await self.aclose()
 
     @property
     def url(self):
@@ -77,22 +197,128 @@ class KvmViewer:
     def web_port(self):
         return self._web_port
 
+    @property
+    def launch_trace(self):
+        # type: () -> Optional[LaunchTrace]
+        return self._launch_trace
+
+    @property
+    def container_name(self):
+        # type: () -> Optional[Text]
+        return self._container_name
+
+    @property
+    def session(self):
+        # type: () -> Optional[int]
+        # Session number in a shared Java container, `None` for dedicated containers
+        return self._session
+
+    @property
+    def snapshot_url(self):
+        # type: () -> Optional[Text]
+        # Url of a downscaled image of the console screen, `None` if the console type does not support snapshots
+        return None
+
+    def _mark_as_killed(self):
+        # type: () -> bool
+        # Returns `False` if the viewer was already killed or detached (possibly by another thread)
+        with self._lock:
+            if self._already_killed:
+                return False
+            self._already_killed = True
+        live_kvm_viewers.discard(self)
+        return True
+
     def kill_process(self):
-        if self._already_killed:
+        if not self._mark_as_killed():
             return
-        self._already_killed = True
         return self._kill_process()
 
+    async def aclose(self):
+        # type: () -> None
+        # Like `kill_process`, but the Docker commands do not block the event loop
+        if not self._mark_as_killed():
+            return
+        await asyncio.get_event_loop().run_in_executor(None, self._kill_process)
+
+    def detach(self):
+        # type: () -> None
+        # Releases the launching process from the container without stopping it, so the kvm console stays available
+        # after this process exits
+        if not self._mark_as_killed():
+            return
+        if self._detach_process is not None:
+            self._detach_process()
+
+
+live_kvm_viewers = set()  # type: Set[KvmViewer]
+
+
+def close_all_kvm_viewers(timeout=CLOSE_ALL_TIMEOUT):
+    # type: (Optional[float]) -> bool
+    # Stops the containers (or shared container sessions) of all live kvm viewers concurrently and waits at most
+    # `timeout` seconds. Returns `False` if not all containers could be stopped in time.
+    kvm_viewers = list(live_kvm_viewers)
+    if not kvm_viewers:
+        return True
+    failed_kvm_viewers = []  # type: List[KvmViewer]
+
+    def kill_process(kvm_viewer):
+        # type: (KvmViewer) -> None
+        try:
+            kvm_viewer.kill_process()
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning("Could not stop the Docker container %s: %s", kvm_viewer.container_name, e)
+            failed_kvm_viewers.append(kvm_viewer)
+
+    # Daemon threads, so a hanging Docker command cannot block the interpreter exit beyond the timeout
+    threads = [threading.Thread(target=kill_process, args=(kvm_viewer,), daemon=True) for kvm_viewer in kvm_viewers]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    for thread in threads:
+        thread.join(max(0.0, deadline - time.monotonic()) if deadline is not None else None)
+    pending_count = sum(1 for thread in threads if thread.is_alive())
+    if pending_count > 0:
+        logger.warning("%d Docker container(s) did not stop within %s seconds.", pending_count, timeout)
+    return pending_count == 0 and not failed_kvm_viewers
+
+
+async def aclose_all_kvm_viewers(timeout=CLOSE_ALL_TIMEOUT):
+    # type: (Optional[float]) -> bool
+    return await asyncio.get_event_loop().run_in_executor(None, close_all_kvm_viewers, timeout)
+
+
+atexit.register(close_all_kvm_viewers)
+
 
 class JavaKvmViewer(KvmViewer):
-    def __init__(self, url, external_vnc_dns, web_port, kill_process, vnc_password):
-        super().__init__(url, external_vnc_dns, web_port, kill_process)
+    def __init__(
+        self,
+        url,
+        external_vnc_dns,
+        web_port,
+        kill_process,
+        vnc_password,
+        launch_trace=None,
+        container_name=None,
+        session=None,
+        detach_process=None,
+    ):
+        super().__init__(
+            url, external_vnc_dns, web_port, kill_process, launch_trace, container_name, session, detach_process
+        )
         self._vnc_password = vnc_password
 
     @property
     def vnc_password(self):
         return self._vnc_password
 
+    @property
+    def snapshot_url(self):
+        # type: () -> Optional[Text]
+        return get_java_snapshot_url(self._external_vnc_dns, self._web_port, self._vnc_password)
+
 
 class HTML5KvmViewer(KvmViewer):
     def __init__(
@@ -105,8 +331,13 @@ class HTML5KvmViewer(KvmViewer):
         authorization_key,
         authorization_value,
         html5_endpoint,
+        launch_trace=None,
+        container_name=None,
+        detach_process=None,
     ):
-        super().__init__(url, external_vnc_dns, web_port, kill_process)
+        super().__init__(
+            url, external_vnc_dns, web_port, kill_process, launch_trace, container_name, None, detach_process
+        )
         self._subdir = subdir
         self._authorization_key = authorization_key
         self._authorization_value = authorization_value
@@ -129,6 +360,56 @@ class HTML5KvmViewer(KvmViewer):
         return self._html5_endpoint
 
 
+class LaunchDeadline:
+    # Every launch phase is limited by its configured timeout and by the remaining time of the whole launch. `None`
+    # disables a timeout.
+    def __init__(self, launch_timeout, phase_timeouts):
+        # type: (Optional[float], Dict[Text, Optional[float]]) -> None
+        self._launch_timeout = launch_timeout
+        self._deadline = time.monotonic() + launch_timeout if launch_timeout is not None else None
+        self._phase_timeouts = phase_timeouts
+
+    def remaining(self):
+        # type: () -> Optional[float]
+        if self._deadline is None:
+            return None
+        return max(0.0, self._deadline - time.monotonic())
+
+    def get_phase_timeout(self, phase):
+        # type: (Text) -> Tuple[Optional[float], Optional[Exception]]
+        # Returns the timeout of the phase and the exception to raise when it expires
+        phase_timeout = self._phase_timeouts.get(phase)
+        remaining = self.remaining()
+        if remaining is not None and (phase_timeout is None or remaining < phase_timeout):
+            return (
+                remaining,
+                LaunchTimeoutError(
+                    "The launch did not finish within {} s (in phase '{}').".format(self._launch_timeout, phase)
+                ),
+            )
+        if phase_timeout is None:
+            return None, None
+        return (
+            phase_timeout,
+            PHASE_TIMEOUT_ERRORS[phase](
+                "The launch phase '{}' did not finish within {} s.".format(phase, phase_timeout)
+            ),
+        )
+
+
+async def run_phase(launch_trace, deadline, phase, coroutine):
+    # type: (LaunchTrace, LaunchDeadline, Text, Awaitable[Any]) -> Any
+    # Runs a launch phase as a trace span and cancels it when its timeout expires
+    timeout, timeout_error = deadline.get_phase_timeout(phase)
+    with launch_trace.span(phase):
+        try:
+            return await asyncio.wait_for(coroutine, timeout)
+        except asyncio.TimeoutError:
+            if timeout_error is None:
+                raise
+            raise timeout_error from None
+
+
 def log_factory(additional_logging):
     def log(msg, *args, **kwargs):
         logger.info(msg, *args, **kwargs)
@@ -145,35 +426,40 @@ def add_sudo_if_configured(command_list):
     return command_list
 
 
-async def check_webserver(log, url):
-    # type: (Callable, Text) -> None
+async def check_webserver(log, url, timeout=None):
+    # type: (Callable, Text, Optional[float]) -> None
     log("Check if '%s' is reachable...", url)
     try:
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(None, requests.head, url)
-        response.raise_for_status()
-        log("The url '%s' is reachable.", url)
-    except (requests.ConnectionError, requests.HTTPError):
+        response = await get_connection_pool().head(url, timeout=timeout)
+    except HttpTimeoutError:
+        raise WebserverCheckTimeoutError("The url '{}' did not respond within {} s.".format(url, timeout))
+    except HttpRequestError:
         raise WebserverNotReachableError("The url '{}' is not reachable. Is the host down?".format(url))
+    if not response.ok:
+        raise WebserverNotReachableError(
+            "The url '{}' is not reachable (status {}). Is the host down?".format(url, response.status_code)
+        )
+    log("The url '%s' is reachable.", url)
 
 
 async def check_docker(log, subprocess_output):
     # type: (Callable, Optional[int]) -> None
     if not is_command_available("docker"):
         raise DockerNotInstalledError("Could not find the `docker` command. Please install Docker first.")
-    if (
-        subprocess.call(add_sudo_if_configured(["docker", "ps"]), stdout=subprocess_output, stderr=subprocess_output)
-        != 0
-    ):
+    loop = asyncio.get_event_loop()
+
+    def docker_ps():
+        # type: () -> int
+        return subprocess.call(
+            add_sudo_if_configured(["docker", "ps"]), stdout=subprocess_output, stderr=subprocess_output
+        )
+
+    # Called in an executor to keep the event loop responsive (and the phase cancellable) if the Docker daemon hangs
+    if await loop.run_in_executor(None, docker_ps) != 0:
         if running_macos():
             subprocess.check_call(["open", "-g", "-a", "Docker"])
             log("Waiting for the Docker engine to be ready...")
-            while (
-                subprocess.call(
-                    add_sudo_if_configured(["docker", "ps"]), stdout=subprocess_output, stderr=subprocess_output
-                )
-                != 0
-            ):
+            while await loop.run_in_executor(None, docker_ps) != 0:
                 await asyncio.sleep(1)
         else:
             raise DockerNotCallableError(
@@ -182,6 +468,379 @@ async def check_docker(log, subprocess_output):
             )
 
 
+def read_docker_image_id(docker_image, subprocess_output):
+    # type: (Text, Optional[int]) -> Optional[Text]
+    # Returns `None` if the image is not available locally
+    try:
+        output = subprocess.check_output(
+            add_sudo_if_configured(["docker", "image", "inspect", "--format", "{{.Id}}", docker_image]),
+            stderr=subprocess_output,
+        )
+    except subprocess.CalledProcessError:
+        return None
+    return output.decode("utf-8").strip() or None
+
+
+def get_webserver_preflight_key(host_config):
+    # type: (HostConfig) -> Text
+    return "webserver:http://{}/".format(host_config.full_hostname)
+
+
+def get_docker_preflight_key():
+    # type: () -> Text
+    return "docker:{}".format("sudo" if config.run_docker_with_sudo else "user")
+
+
+async def preflight_webserver(log, host_config, timeout):
+    # type: (Callable, HostConfig, Optional[float]) -> None
+    preflight_cache = get_preflight_cache()
+    preflight_key = get_webserver_preflight_key(host_config)
+    if preflight_cache.is_fresh(preflight_key):
+        logger.debug("'%s' was reachable recently, skipping the check.", host_config.full_hostname)
+        return
+    await check_webserver(log, "http://{}/".format(host_config.full_hostname), timeout=timeout)
+    preflight_cache.record(preflight_key, config.preflight_cache_ttls.get("webserver"))
+
+
+async def preflight_docker(log, docker_image, subprocess_output):
+    # type: (Callable, Text, Optional[int]) -> None
+    preflight_cache = get_preflight_cache()
+    docker_preflight_key = get_docker_preflight_key()
+    if preflight_cache.is_fresh(docker_preflight_key):
+        logger.debug("Docker was available recently, skipping the check.")
+    else:
+        await check_docker(log, subprocess_output)
+        preflight_cache.record(docker_preflight_key, config.preflight_cache_ttls.get("docker"))
+    # The image key starts with the Docker key, so both are invalidated together
+    image_preflight_key = "{}:image:{}".format(docker_preflight_key, docker_image)
+    image_found, image_id = preflight_cache.get(image_preflight_key)
+    if not image_found:
+        loop = asyncio.get_event_loop()
+        image_id = await loop.run_in_executor(None, read_docker_image_id, docker_image, subprocess_output)
+        if image_id is None:
+            log("The Docker image '{}' is not available locally and is downloaded first.".format(docker_image))
+            return
+        preflight_cache.record(image_preflight_key, config.preflight_cache_ttls.get("docker_image"), image_id)
+    logger.debug("Using the Docker image %s (%s).", docker_image, image_id)
+
+
+def invalidate_preflight_checks(host_config):
+    # type: (HostConfig) -> None
+    # A failed launch could be caused by any of the cached checks, so all of them are repeated by the next launch
+    preflight_cache = get_preflight_cache()
+    preflight_cache.invalidate(get_webserver_preflight_key(host_config))
+    preflight_cache.invalidate(get_docker_preflight_key())
+
+
+def read_docker_port(container_name, subprocess_output, container_port=None):
+    # type: (Text, Optional[int], Optional[int]) -> int
+    return int(
+        subprocess.check_output(
+            add_sudo_if_configured(
+                ["docker", "port", container_name]
+                + (["{}/tcp".format(container_port)] if container_port is not None else [])
+            ),
+            stderr=subprocess_output,
+        )
+        .strip()
+        .split(b"\n")[0]
+        .split(b":")[1]
+    )
+
+
+def is_container_running(container_name, subprocess_output):
+    # type: (Text, Optional[int]) -> bool
+    try:
+        output = subprocess.check_output(
+            add_sudo_if_configured(["docker", "inspect", "-f", "{{.State.Running}}", container_name]),
+            stderr=subprocess_output,
+        )
+    except subprocess.CalledProcessError:
+        return False
+    return output.strip() == b"true"
+
+
+def read_container_timings(container_name, subprocess_output, timing_filepath="/tmp/timings"):
+    # type: (Text, Optional[int], Text) -> List[Tuple[Text, float]]
+    # The container entrypoint writes a `<phase> <duration in seconds>` line for each of its setup steps
+    try:
+        output = subprocess.check_output(
+            add_sudo_if_configured(["docker", "exec", container_name, "cat", timing_filepath]), stderr=subprocess_output
+        )
+    except subprocess.CalledProcessError:
+        return []
+    timings = []
+    for line in output.decode("utf-8").splitlines():
+        try:
+            phase, duration = line.split()
+            timings.append((phase, float(duration)))
+        except ValueError:
+            pass
+    return timings
+
+
+def get_shared_container_name(host_config):
+    # type: (JavaHostConfig) -> Text
+    return "nojava-ipmi-kvm-shared-{}".format(host_config.java_version)
+
+
+def create_read_only_docker_args(host_config):
+    # type: (HostConfig) -> List[Text]
+    if not config.read_only_containers:
+        return []
+    docker_args = ["--read-only"]
+    for path, mode, executable in JAVA_TMPFS_MOUNTS if isinstance(host_config, JavaHostConfig) else HTML5_TMPFS_MOUNTS:
+        docker_args.extend(
+            (
+                "--tmpfs",
+                "{}:{}mode={},size={}".format(path, "exec," if executable else "", mode, config.container_tmpfs_size),
+            )
+        )
+    return docker_args
+
+
+async def start_shared_java_container(log, container_name, docker_image, host_config, subprocess_output):
+    # type: (Callable, Text, Text, JavaHostConfig, Optional[int]) -> bool
+    # Returns `True` if the container was started by this call
+    loop = asyncio.get_event_loop()
+    if not await loop.run_in_executor(None, is_container_running, container_name, subprocess_output):
+        log("Starting the shared Docker container for Java {}...".format(host_config.java_version))
+        # `docker run` blocks while the image is pulled
+        start_future = loop.run_in_executor(
+            None,
+            lambda: subprocess.call(
+                add_sudo_if_configured(
+                    ["docker", "run", "-d", "-v", "/etc/hosts:/etc/hosts:ro", "--rm", "--name", container_name]
+                    + get_container_labels(java_version=host_config.java_version)
+                    + create_read_only_docker_args(host_config)
+                    + ["-e", "JAVA_VERSION={}".format(host_config.java_version)]
+                    + ["-e", "SHARED_SESSIONS={}".format(config.max_shared_sessions)]
+                    + ["--expose", "8080-{}".format(8080 + config.max_shared_sessions - 1), "-P", docker_image]
+                ),
+                stdout=subprocess_output,
+                stderr=subprocess_output,
+            ),
+        )
+
+        def stop_started_container(future):
+            # type: (asyncio.Future) -> None
+            if future.cancelled() or future.exception() is not None or future.result() != 0:
+                return
+            stop_unused_shared_container(container_name, subprocess_output)
+
+        try:
+            # A container which is started after a cancellation is stopped as soon as the `docker run` call returns
+            # (unless another launch added a session in the meantime)
+            returncode = await asyncio.shield(start_future)
+        except asyncio.CancelledError:
+            start_future.add_done_callback(stop_started_container)
+            raise
+        if returncode == 0:
+            return True
+        # Another launch could have started the same container concurrently
+        if not await loop.run_in_executor(None, is_container_running, container_name, subprocess_output):
+            raise DockerTerminatedError("Docker terminated with return code {}.".format(returncode))
+    else:
+        log("Reusing the shared Docker container for Java {}...".format(host_config.java_version))
+    return False
+
+
+async def start_dedicated_container(
+    log,
+    container_name,
+    docker_image,
+    host_config,
+    docker_port,
+    extra_args,
+    environment_variables,
+    stdin,
+    subprocess_output,
+):
+    # type: (Callable, Text, Text, HostConfig, Optional[int], List, List, Text, Optional[int]) -> None
+    loop = asyncio.get_event_loop()
+    log("Starting the Docker container...")
+    # Watched before the start, so a container which terminates immediately is noticed
+    container_monitor.watch(container_name)
+    # `docker run` blocks while the image is pulled
+    start_future = loop.run_in_executor(
+        None,
+        lambda: subprocess.call(
+            add_sudo_if_configured(
+                ["docker", "run", "-d", "-v", "/etc/hosts:/etc/hosts:ro", "--rm", "--name", container_name]
+                + ["--tmpfs", "{}:mode=0700".format(SECRET_DIRECTORY), "-e", "SECRET_FIFO={}".format(SECRET_FIFO)]
+            )
+            + get_container_labels(short_hostname=host_config.short_hostname)
+            + create_read_only_docker_args(host_config)
+            + environment_variables
+            + (["-P"] if docker_port is None else ["-p", "{}:8080".format(docker_port)])
+            + [docker_image]
+            + extra_args,
+            stdout=subprocess_output,
+            stderr=subprocess_output,
+        ),
+    )
+
+    def kill_container():
+        # type: () -> None
+        subprocess.call(
+            add_sudo_if_configured(["docker", "kill", container_name]),
+            stdout=subprocess_output,
+            stderr=subprocess_output,
+        )
+        container_monitor.unwatch(container_name)
+
+    def kill_started_container(future):
+        # type: (asyncio.Future) -> None
+        if future.cancelled() or future.exception() is not None or future.result() != 0:
+            return
+        kill_container()
+
+    try:
+        # Like `add_shared_java_session`, a container which is started after a cancellation is stopped as soon as the
+        # `docker run` call returns
+        returncode = await asyncio.shield(start_future)
+    except asyncio.CancelledError:
+        start_future.add_done_callback(kill_started_container)
+        raise
+    if returncode != 0:
+        container_monitor.unwatch(container_name)
+        raise DockerTerminatedError("Docker terminated with return code {}.".format(returncode))
+    try:
+        await write_container_secret(container_name, stdin, subprocess_output)
+    except BaseException:
+        # The container would wait for its password forever
+        kill_container()
+        raise
+
+
+async def write_container_secret(container_name, secret, subprocess_output):
+    # type: (Text, Text, Optional[int]) -> None
+    loop = asyncio.get_event_loop()
+    write_secret_process = await loop.run_in_executor(
+        None,
+        lambda: subprocess.run(
+            add_sudo_if_configured(
+                ["docker", "exec", "-i", container_name, "sh", "-c", WRITE_SECRET_SCRIPT, SECRET_FIFO]
+            ),
+            input="{}\n".format(secret).encode("utf-8"),
+            stdout=subprocess_output,
+            stderr=subprocess_output,
+        ),
+    )
+    if write_secret_process.returncode != 0:
+        raise DockerTerminatedError(
+            "Passing the password to the Docker container failed with return code {}.".format(
+                write_secret_process.returncode
+            )
+        )
+
+
+async def add_shared_java_session(
+    container_name, host_config, extra_args, environment_variables, stdin, subprocess_output, container_started=False
+):
+    # type: (Text, JavaHostConfig, List, List, Text, Optional[int], bool) -> int
+    # `container_started` marks a container which was started for this session; it is stopped again if adding the
+    # session fails and no other session was added in the meantime
+    loop = asyncio.get_event_loop()
+    add_session_future = loop.run_in_executor(
+        None,
+        lambda: subprocess.run(
+            add_sudo_if_configured(
+                ["docker", "exec", "-i"] + environment_variables + [container_name, "kvm-session", "add"]
+            )
+            + extra_args,
+            input="{}\n".format(stdin).encode("utf-8"),
+            stdout=subprocess.PIPE,
+            stderr=subprocess_output,
+        ),
+    )
+
+    def detach_added_session(future):
+        # type: (asyncio.Future) -> None
+        if future.cancelled() or future.exception() is not None:
+            return
+        add_session_process = future.result()
+        if add_session_process.returncode == 0:
+            try:
+                session = int(add_session_process.stdout.strip())
+            except ValueError:
+                return
+            detach_shared_java_session(container_name, session, subprocess_output)
+        elif container_started:
+            stop_unused_shared_container(container_name, subprocess_output)
+
+    try:
+        # The `docker exec` call cannot be interrupted, so a session which is added after a cancellation (for example
+        # by a phase timeout) is detached as soon as the call returns
+        add_session_process = await asyncio.shield(add_session_future)
+    except asyncio.CancelledError:
+        add_session_future.add_done_callback(detach_added_session)
+        raise
+    if add_session_process.returncode != 0 and container_started:
+        await loop.run_in_executor(None, stop_unused_shared_container, container_name, subprocess_output)
+    if add_session_process.returncode == 10:
+        raise DockerTerminatedError(
+            "All {} sessions of the shared Docker container {} are in use.".format(
+                config.max_shared_sessions, container_name
+            )
+        )
+    elif add_session_process.returncode != 0:
+        if not host_config.skip_login:
+            raise DockerTerminatedError(
+                "Adding a session failed with return code {}. Maybe you entered a wrong password?".format(
+                    add_session_process.returncode
+                )
+            )
+        else:
+            raise DockerTerminatedError(
+                (
+                    "Adding a session failed with return code {}."
+                    + " Maybe you configured a wrong download endpoint or need a login?"
+                ).format(add_session_process.returncode)
+            )
+    return int(add_session_process.stdout.strip())
+
+
+def detach_shared_java_session(container_name, session, subprocess_output):
+    # type: (Text, int, Optional[int]) -> None
+    try:
+        remaining_sessions = int(
+            subprocess.check_output(
+                add_sudo_if_configured(["docker", "exec", container_name, "kvm-session", "remove", str(session)]),
+                stderr=subprocess_output,
+            ).strip()
+        )
+    except (subprocess.CalledProcessError, ValueError):
+        # The container is not running any more
+        return
+    if remaining_sessions == 0:
+        subprocess.call(
+            add_sudo_if_configured(["docker", "kill", container_name]),
+            stdout=subprocess_output,
+            stderr=subprocess_output,
+        )
+
+
+def stop_unused_shared_container(container_name, subprocess_output):
+    # type: (Text, Optional[int]) -> None
+    try:
+        session_count = int(
+            subprocess.check_output(
+                add_sudo_if_configured(["docker", "exec", container_name, "kvm-session", "count"]),
+                stderr=subprocess_output,
+            ).strip()
+        )
+    except (subprocess.CalledProcessError, ValueError):
+        # The container is not running any more
+        return
+    if session_count == 0:
+        subprocess.call(
+            add_sudo_if_configured(["docker", "kill", container_name]),
+            stdout=subprocess_output,
+            stderr=subprocess_output,
+        )
+
+
 def create_extra_args(host_config):
     # type: (HostConfig) -> List
     extra_args = [
@@ -209,6 +868,31 @@ def create_extra_args(host_config):
     return extra_args
 
 
+def create_resize_display_environment(host_config, selected_resolution):
+    # type: (JavaHostConfig, Text) -> List[Text]
+    # The X server is started with the maximum resolution and resized to the viewer window by the noVNC web server
+    resolutions = []
+    for resolution, default_resolution in (
+        (host_config.min_resolution, "640x480"),
+        (selected_resolution, selected_resolution),
+        (host_config.max_resolution, "1920x1200"),
+    ):
+        if not re.match(r"^[1-9][0-9]{2,3}x[1-9][0-9]{2,3}$", resolution):
+            resolution = default_resolution
+        resolutions.append(tuple(int(c) for c in resolution.split("x")))
+    min_resolution, initial_resolution, max_resolution = resolutions
+    # The maximum must include the initial resolution (the size of the viewer window before the first resize)
+    max_resolution = tuple(max(c) for c in zip(min_resolution, initial_resolution, max_resolution))
+    return [
+        "-e",
+        "RESIZE_DISPLAY=1",
+        "-e",
+        "MIN_XRES={}x{}".format(*min_resolution),
+        "-e",
+        "MAX_XRES={}x{}".format(*max_resolution),
+    ]
+
+
 def create_java_docker_args(host_config, login_password, selected_resolution):
     # type: (JavaHostConfig, Optional[Text], Optional[Text]) -> Tuple[List, List, Text, Text, Text]
     # extra-program-args, env variables, docker image, stdin
@@ -234,15 +918,13 @@ def create_java_docker_args(host_config, login_password, selected_resolution):
         "-e",
         "KVM_HOSTNAME={}".format(host_config.full_hostname),
     ]
-    java_provider = "oraclejre" if host_config.java_version.endswith("-oracle") else "openjdk"
-    java_major_version = host_config.java_version.split("u")[0]
+    if config.resize_display:
+        environment_variables.extend(create_resize_display_environment(host_config, selected_resolution))
 
     return (
         extra_args,
         environment_variables,
-        config.java_docker_image.format(
-            version=__version__, java_provider=java_provider, java_major_version=java_major_version
-        ),
+        resolve_pinned_image(get_docker_image(host_config)),
         login_password if login_password is not None else "",
         vnc_password,
     )
@@ -259,7 +941,7 @@ def create_html5_docker_args(
     return (
         extra_args,
         environment_variables,
-        config.html5_docker_image.format(version=__version__),
+        resolve_pinned_image(get_docker_image(host_config)),
         host_config.get_config_json(login_password, subdir, authorization_key, authorization_value),
     )
 
@@ -275,17 +957,72 @@ async def start_kvm_container(
     authorization_value=None,
     subdir=None,
     debug=False,
+    launch_trace=None,
 ):
-    # type: (HostConfig, Optional[Text], Text, Optional[int], Optional[Callable[..., None]], Optional[Text], Optional[Text], Optional[Text], Optional[Text], bool) -> KvmViewer
+    # type: (HostConfig, Optional[Text], Text, Optional[int], Optional[Callable[..., None]], Optional[Text], Optional[Text], Optional[Text], Optional[Text], bool, Optional[LaunchTrace]) -> KvmViewer
     if not isinstance(host_config, (JavaHostConfig, HTML5HostConfig)):
         raise ValueError("Invalid host config class")
 
+    # The setup steps of the container are only read if the caller passed its own trace (costs an extra `docker exec`)
+    read_container_phases = launch_trace is not None or logger.isEnabledFor(logging.DEBUG)
+    if launch_trace is None:
+        launch_trace = LaunchTrace()
+    collect_orphaned_containers_in_background()
+    try:
+        kvm_viewer = await _start_kvm_container(
+            host_config,
+            login_password,
+            external_vnc_dns,
+            docker_port,
+            additional_logging,
+            selected_resolution,
+            authorization_key,
+            authorization_value,
+            subdir,
+            debug,
+            launch_trace,
+            read_container_phases,
+        )
+    except BaseException as e:
+        launch_trace.finish(e)
+        # `asyncio.CancelledError` is a subclass of `Exception` before Python 3.8, but a cancelled launch did not fail
+        if isinstance(e, Exception) and not isinstance(e, asyncio.CancelledError):
+            invalidate_preflight_checks(host_config)
+            metrics.observe_launch_failure(host_config.full_hostname, e)
+        raise
+    launch_trace.finish()
+    metrics.observe_launch(host_config.full_hostname, launch_trace)
+    return kvm_viewer
+
+
+async def _start_kvm_container(
+    host_config,
+    login_password,
+    external_vnc_dns,
+    docker_port,
+    additional_logging,
+    selected_resolution,
+    authorization_key,
+    authorization_value,
+    subdir,
+    debug,
+    launch_trace,
+    read_container_phases,
+):
+    # type: (HostConfig, Optional[Text], Text, Optional[int], Optional[Callable[..., None]], Optional[Text], Optional[Text], Optional[Text], Optional[Text], bool, LaunchTrace, bool) -> KvmViewer
     log = log_factory(additional_logging)
 
     subprocess_output = None if debug else subprocess.DEVNULL
 
-    await check_webserver(log, "http://{}/".format(host_config.full_hostname))
-    await check_docker(log, subprocess_output)
+    deadline = LaunchDeadline(config.launch_timeout, config.phase_timeouts)
+    loop = asyncio.get_event_loop()
+
+    await run_phase(
+        launch_trace,
+        deadline,
+        "check_webserver",
+        preflight_webserver(log, host_config, deadline.get_phase_timeout("check_webserver")[0]),
+    )
 
     # TODO: pass variables as `extra_args` (?)
     DOCKER_CONTAINER_NAME = "nojava-ipmi-kvmrc-{}".format(uuid.uuid4())
@@ -299,96 +1036,199 @@ async def start_kvm_container(
             host_config, login_password, authorization_key, authorization_value, subdir
         )
 
-    log("Starting the Docker container...")
-    docker_process = subprocess.Popen(
-        add_sudo_if_configured(
-            ["docker", "run", "-i", "-v", "/etc/hosts:/etc/hosts:ro", "--rm", "--name", DOCKER_CONTAINER_NAME]
+    await run_phase(launch_trace, deadline, "check_docker", preflight_docker(log, docker_image, subprocess_output))
+
+    if isinstance(host_config, JavaHostConfig) and config.share_java_containers and docker_port is None:
+        DOCKER_CONTAINER_NAME = get_shared_container_name(host_config)
+        container_started = await run_phase(
+            launch_trace,
+            deadline,
+            "container_start",
+            start_shared_java_container(log, DOCKER_CONTAINER_NAME, docker_image, host_config, subprocess_output),
+        )
+        session = await run_phase(
+            launch_trace,
+            deadline,
+            "session_add",
+            add_shared_java_session(
+                DOCKER_CONTAINER_NAME,
+                host_config,
+                extra_args,
+                environment_variables,
+                stdin,
+                subprocess_output,
+                container_started,
+            ),
         )
-        + environment_variables
-        + (["-P"] if docker_port is None else ["-p", "{}:8080".format(docker_port)])
-        + [docker_image]
-        + extra_args,
-        stdin=subprocess.PIPE,
-        stdout=subprocess_output,
-        stderr=subprocess_output,
-    )
-    if docker_process.stdin is not None:
-        docker_process.stdin.write("{}\n".format(stdin).encode("utf-8"))
-        docker_process.stdin.flush()
-        docker_process.stdin.close()
-    else:
-        # This case cannot happen (`if` is used to satisfy mypy)
-        raise IOError("Something strange happened: Docker stdin not available.")
 
-    def terminate_docker():
-        # type: () -> None
-        nonlocal docker_process
-        if docker_process.poll() is None:
-            subprocess.check_call(
-                add_sudo_if_configured(["docker", "kill", DOCKER_CONTAINER_NAME]),
-                stdout=subprocess_output,
-                stderr=subprocess_output,
-            )
-        log("Docker container was terminated.")
+        timing_filepath = "/tmp/sessions/{}/timings".format(session)
 
-    while True:
-        try:
-            if docker_process.poll() is not None:
-                raise DockerTerminatedError("Docker terminated with return code {}.".format(docker_process.returncode))
-            web_port = int(
-                subprocess.check_output(
-                    add_sudo_if_configured(["docker", "port", DOCKER_CONTAINER_NAME]), stderr=subprocess_output
-                )
-                .strip()
-                .split(b"\n")[0].split(b":")[1]
-            )
-            break
-        except (IndexError, ValueError):
-            terminate_docker()
-            raise DockerPortNotReadableError("Cannot read the VNC web port.")
-        except subprocess.CalledProcessError:
-            await asyncio.sleep(1)
+        def terminate_docker():
+            # type: () -> None
+            detach_shared_java_session(DOCKER_CONTAINER_NAME, session, subprocess_output)
+            log("Docker container session was terminated.")
 
-    log("Waiting for the Docker container to be up and ready...")
-    loop = asyncio.get_event_loop()
+        def detach_docker():
+            # type: () -> None
+            # The session lives in the shared container, nothing is bound to this process
+            pass
 
-    def get():
-        nonlocal external_vnc_dns, web_port, authorization_key, authorization_value
-        cookies = {}
-        if authorization_key is not None and authorization_value is not None:
-            cookies[authorization_key] = authorization_value
-        return requests.head("http://{}:{}".format(external_vnc_dns, web_port), cookies=cookies)
+        async def raise_if_terminated():
+            # type: () -> None
+            if not await loop.run_in_executor(None, is_container_running, DOCKER_CONTAINER_NAME, subprocess_output):
+                raise DockerTerminatedError("The shared Docker container {} terminated.".format(DOCKER_CONTAINER_NAME))
 
-    while True:
-        try:
-            response = await loop.run_in_executor(None, get)
-            response.raise_for_status()
-            break
-        except (requests.ConnectionError, requests.HTTPError):
-            if docker_process.poll() is not None:
+        async def discover_port():
+            # type: () -> int
+            try:
+                return await loop.run_in_executor(
+                    None, read_docker_port, DOCKER_CONTAINER_NAME, subprocess_output, 8080 + session
+                )
+            except (IndexError, ValueError, subprocess.CalledProcessError):
+                raise DockerPortNotReadableError("Cannot read the VNC web port.")
+
+    else:
+        timing_filepath = "/tmp/timings"
+        session = None
+
+        def terminate_docker():
+            # type: () -> None
+            try:
+                if container_monitor.exit_code(DOCKER_CONTAINER_NAME) is None:
+                    returncode = subprocess.call(
+                        add_sudo_if_configured(["docker", "kill", DOCKER_CONTAINER_NAME]),
+                        stdout=subprocess_output,
+                        stderr=subprocess_output,
+                    )
+                    # The container could have terminated just before
+                    if returncode != 0 and is_container_running(DOCKER_CONTAINER_NAME, subprocess_output):
+                        raise subprocess.CalledProcessError(returncode, "docker kill")
+            finally:
+                container_monitor.unwatch(DOCKER_CONTAINER_NAME)
+            log("Docker container was terminated.")
+
+        def detach_docker():
+            # type: () -> None
+            # The container runs detached, only its termination is not watched any more
+            container_monitor.unwatch(DOCKER_CONTAINER_NAME)
+
+        async def raise_if_terminated():
+            # type: () -> None
+            exit_code = container_monitor.exit_code(DOCKER_CONTAINER_NAME)
+            if exit_code is not None:
                 if not host_config.skip_login:
                     raise DockerTerminatedError(
-                        "Docker terminated with return code {}. Maybe you entered a wrong password?".format(
-                            docker_process.returncode
-                        )
+                        "Docker terminated with return code {}. Maybe you entered a wrong password?".format(exit_code)
                     )
                 else:
                     raise DockerTerminatedError(
                         (
                             "Docker terminated with return code {}."
                             + " Maybe you configured a wrong download endpoint or need a login?"
-                        ).format(docker_process.returncode)
+                        ).format(exit_code)
                     )
+
+        async def discover_port():
+            # type: () -> int
+            while True:
+                exit_code = container_monitor.exit_code(DOCKER_CONTAINER_NAME)
+                if exit_code is not None:
+                    raise DockerTerminatedError("Docker terminated with return code {}.".format(exit_code))
+                try:
+                    return await loop.run_in_executor(None, read_docker_port, DOCKER_CONTAINER_NAME, subprocess_output)
+                except (IndexError, ValueError):
+                    raise DockerPortNotReadableError("Cannot read the VNC web port.")
+                except subprocess.CalledProcessError:
+                    await asyncio.sleep(1)
+
+        await run_phase(
+            launch_trace,
+            deadline,
+            "container_start",
+            start_dedicated_container(
+                log,
+                DOCKER_CONTAINER_NAME,
+                docker_image,
+                host_config,
+                docker_port,
+                extra_args,
+                environment_variables,
+                stdin,
+                subprocess_output,
+            ),
+        )
+
+    async def wait_until_ready(web_port):
+        # type: (int) -> None
+        connection_pool = get_connection_pool()
+        url = "http://{}:{}".format(external_vnc_dns, web_port)
+        headers = {}
+        if authorization_key is not None and authorization_value is not None:
+            headers["Cookie"] = "{}={}".format(authorization_key, authorization_value)
+        while True:
+            try:
+                response = await connection_pool.head(url, headers=headers, timeout=READINESS_REQUEST_TIMEOUT)
+                if response.ok:
+                    break
+            except HttpRequestError:
+                pass
+            await raise_if_terminated()
             await asyncio.sleep(1)
 
+    try:
+        web_port = await run_phase(launch_trace, deadline, "port_discovery", discover_port())
+        log("Waiting for the Docker container to be up and ready...")
+        await run_phase(launch_trace, deadline, "readiness_wait", wait_until_ready(web_port))
+    except BaseException:
+        # Also reached if the launch is cancelled (for example by `asyncio.wait_for` or a phase timeout), so a half
+        # started container does not keep running
+        try:
+            terminate_docker()
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning("Could not stop the Docker container %s: %s", DOCKER_CONTAINER_NAME, e)
+        raise
+
     log("Docker container is up and running.")
 
-    if isinstance(host_config, JavaHostConfig):
-        url = "http://{ext_dns}:{web_port}/vnc.html?host={ext_dns}&port={web_port}&autoconnect=true&password={password}".format(
-            ext_dns=external_vnc_dns, password=vnc_password, web_port=web_port
+    metrics.session_started(docker_image, DOCKER_CONTAINER_NAME)
+
+    def kill_process():
+        # type: () -> None
+        try:
+            terminate_docker()
+        finally:
+            metrics.session_ended(docker_image, DOCKER_CONTAINER_NAME)
+
+    def detach_process():
+        # type: () -> None
+        # A detached console is not a session of this process any more
+        try:
+            detach_docker()
+        finally:
+            metrics.session_ended(docker_image, DOCKER_CONTAINER_NAME)
+
+    if isinstance(host_config, JavaHostConfig) and read_container_phases:
+        container_phases = await loop.run_in_executor(
+            None, read_container_timings, DOCKER_CONTAINER_NAME, subprocess_output, timing_filepath
         )
+        launch_trace.add_container_phases(container_phases)
+        for phase, duration in container_phases:
+            logger.debug("Container phase '%s' took %.3f s.", phase, duration)
+
+    if isinstance(host_config, JavaHostConfig):
+        url = get_java_console_url(external_vnc_dns, web_port, vnc_password)
         log("Url to view kvm console: {}".format(url))
-        return JavaKvmViewer(url, external_vnc_dns, web_port, terminate_docker, vnc_password)
+        return JavaKvmViewer(
+            url,
+            external_vnc_dns,
+            web_port,
+            kill_process,
+            vnc_password,
+            launch_trace,
+            DOCKER_CONTAINER_NAME,
+            session,
+            detach_process,
+        )
     elif isinstance(host_config, HTML5HostConfig):
         url = "http://{}:{}/{}".format(external_vnc_dns, web_port, host_config.html5_endpoint)
         log("Url to view kvm console: {}".format(url))
@@ -396,11 +1236,14 @@ async def start_kvm_container(
             url,
             external_vnc_dns,
             web_port,
-            terminate_docker,
+            kill_process,
             subdir,
             authorization_key,
             authorization_value,
             host_config.html5_endpoint,
+            launch_trace,
+            DOCKER_CONTAINER_NAME,
+            detach_process,
         )
     else:
         assert False  # Type is checked at the top of function
@@ -411,6 +1254,15 @@ __all__ = [
     "DockerNotInstalledError",
     "DockerPortNotReadableError",
     "DockerTerminatedError",
+    "LaunchTimeoutError",
+    "WebserverCheckTimeoutError",
+    "DockerCheckTimeoutError",
+    "ContainerStartTimeoutError",
+    "SessionAddTimeoutError",
+    "PortDiscoveryTimeoutError",
+    "ReadinessTimeoutError",
     "WebserverNotReachableError",
+    "aclose_all_kvm_viewers",
+    "close_all_kvm_viewers",
     "start_kvm_container",
 ]
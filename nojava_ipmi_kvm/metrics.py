@@ -0,0 +1,318 @@
+import http.server
+import logging
+import os
+import socketserver
+import subprocess
+import tempfile
+import threading
+import time
+
+try:
+    from typing import Any, Dict, List, Optional, Text, Tuple  # noqa: F401  # pylint: disable=unused-import
+except ImportError:
+    pass
+
+from .trace import LaunchTrace
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LAUNCH_DURATION_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+MEMORY_UNITS = {
+    "B": 1,
+    "kB": 1000,
+    "KB": 1000,
+    "MB": 1000**2,
+    "GB": 1000**3,
+    "TB": 1000**4,
+    "KiB": 1024,
+    "MiB": 1024**2,
+    "GiB": 1024**3,
+    "TiB": 1024**4,
+}
+
+
+class Histogram:
+    def __init__(self, buckets=LAUNCH_DURATION_BUCKETS):
+        # type: (Tuple[float, ...]) -> None
+        self._buckets = buckets
+        self._counts = [0] * len(buckets)
+        self._count = 0
+        self._sum = 0.0
+
+    def observe(self, value):
+        # type: (float) -> None
+        for i, upper_bound in enumerate(self._buckets):
+            if value <= upper_bound:
+                self._counts[i] += 1
+                break
+        self._count += 1
+        self._sum += value
+
+    def samples(self):
+        # type: () -> List[Tuple[Text, Text, float]]
+        # (suffix, `le` label value, value) tuples with cumulative bucket counts
+        samples = []  # type: List[Tuple[Text, Text, float]]
+        cumulative_count = 0
+        for upper_bound, count in zip(self._buckets, self._counts):
+            cumulative_count += count
+            samples.append(("_bucket", format_value(upper_bound), cumulative_count))
+        samples.append(("_bucket", "+Inf", self._count))
+        samples.append(("_count", "", self._count))
+        samples.append(("_sum", "", self._sum))
+        return samples
+
+
+def format_value(value):
+    # type: (float) -> Text
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def escape_label_value(value):
+    # type: (Text) -> Text
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels):
+    # type: (Tuple[Tuple[Text, Text], ...]) -> Text
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, escape_label_value(value)) for key, value in labels) + "}"
+
+
+def parse_memory_usage(memory_usage):
+    # type: (Text) -> float
+    # `docker stats` reports memory as "<usage> / <limit>", for example "12.5MiB / 1.944GiB"
+    usage = memory_usage.split("/")[0].strip()
+    for unit in sorted(MEMORY_UNITS, key=len, reverse=True):
+        if usage.endswith(unit):
+            return float(usage[: -len(unit)]) * MEMORY_UNITS[unit]
+    return float(usage)
+
+
+def sample_container_stats(container_names):
+    # type: (List[Text]) -> Dict[Text, Tuple[float, float]]
+    # Queries the cpu usage (ratio of one cpu) and memory usage (bytes) of all given containers with a single
+    # `docker stats` call. The call lists all running containers since naming containers explicitly fails as soon as
+    # one of them is gone.
+    from .kvm import add_sudo_if_configured
+
+    if not container_names:
+        return {}
+    try:
+        output = subprocess.check_output(
+            add_sudo_if_configured(
+                ["docker", "stats", "--no-stream", "--format", "{{.Name}}\t{{.CPUPerc}}\t{{.MemUsage}}"]
+            ),
+            stderr=subprocess.DEVNULL,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        logger.debug("Could not read the Docker container statistics.")
+        return {}
+    wanted_container_names = set(container_names)
+    stats = {}  # type: Dict[Text, Tuple[float, float]]
+    for line in output.decode("utf-8").splitlines():
+        try:
+            name, cpu_percentage, memory_usage = line.split("\t")
+            if name not in wanted_container_names:
+                continue
+            stats[name] = (float(cpu_percentage.rstrip("%")) / 100, parse_memory_usage(memory_usage))
+        except ValueError:
+            pass
+    return stats
+
+
+class MetricsRegistry:
+    # Collects metrics of kvm console launches and running sessions of this process. Container statistics are sampled
+    # lazily (with one `docker stats` call for all containers) when the metrics are rendered and are reused for
+    # `container_stats_max_age` seconds to keep frequent scrapes cheap.
+    def __init__(self, container_stats_max_age=10.0):
+        # type: (float) -> None
+        self._container_stats_max_age = container_stats_max_age
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._active_sessions = {}  # type: Dict[Text, int]
+        self._containers = {}  # type: Dict[Text, Tuple[Text, int]]
+        self._launch_durations = {}  # type: Dict[Tuple[Text, ...], Histogram]
+        # Keyed by kvm host and phase; the hosts are the configured kvm hosts, so the number of series is bounded
+        self._phase_durations = {}  # type: Dict[Tuple[Text, ...], Histogram]
+        self._launch_failures = {}  # type: Dict[Tuple[Text, Text], int]
+        self._container_stats = {}  # type: Dict[Text, Tuple[float, float]]
+        self._container_stats_time = None  # type: Optional[float]
+
+    def observe_launch(self, hostname, launch_trace):
+        # type: (Text, LaunchTrace) -> None
+        with self._lock:
+            if launch_trace.duration is not None:
+                self._launch_durations.setdefault((hostname,), Histogram()).observe(launch_trace.duration)
+            for span in launch_trace.spans:
+                self._phase_durations.setdefault((hostname, span.name), Histogram()).observe(span.duration)
+            for phase, duration in launch_trace.container_phases:
+                self._phase_durations.setdefault((hostname, "container.{}".format(phase)), Histogram()).observe(
+                    duration
+                )
+
+    def observe_launch_failure(self, hostname, error):
+        # type: (Text, BaseException) -> None
+        key = (hostname, type(error).__name__)
+        with self._lock:
+            self._launch_failures[key] = self._launch_failures.get(key, 0) + 1
+
+    def session_started(self, docker_image, container_name):
+        # type: (Text, Text) -> None
+        with self._lock:
+            self._active_sessions[docker_image] = self._active_sessions.get(docker_image, 0) + 1
+            # Shared Java containers host several sessions
+            self._containers[container_name] = (docker_image, self._containers.get(container_name, ("", 0))[1] + 1)
+
+    def session_ended(self, docker_image, container_name):
+        # type: (Text, Text) -> None
+        with self._lock:
+            self._active_sessions[docker_image] = max(0, self._active_sessions.get(docker_image, 0) - 1)
+            if container_name in self._containers:
+                image, session_count = self._containers[container_name]
+                if session_count > 1:
+                    self._containers[container_name] = (image, session_count - 1)
+                else:
+                    del self._containers[container_name]
+
+    def _get_container_stats(self):
+        # type: () -> Tuple[Dict[Text, Tuple[Text, int]], Dict[Text, Tuple[float, float]]]
+        with self._lock:
+            containers = dict(self._containers)
+        # Only one thread samples, concurrent scrapes reuse its result
+        with self._stats_lock:
+            if (
+                self._container_stats_time is None
+                or time.monotonic() - self._container_stats_time > self._container_stats_max_age
+            ):
+                self._container_stats = sample_container_stats(list(containers))
+                self._container_stats_time = time.monotonic()
+            return containers, self._container_stats
+
+    def render(self):
+        # type: () -> Text
+        containers, container_stats = self._get_container_stats()
+        lines = []  # type: List[Text]
+
+        def add_metric(name, metric_type, help_text, samples):
+            # type: (Text, Text, Text, List[Tuple[Text, Tuple[Tuple[Text, Text], ...], float]]) -> None
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            for suffix, labels, value in samples:
+                lines.append("{}{}{} {}".format(name, suffix, format_labels(labels), format_value(value)))
+
+        def histogram_samples(label_names, histograms):
+            # type: (Tuple[Text, ...], Dict[Tuple[Text, ...], Histogram]) -> List[Tuple[Text, Tuple[Tuple[Text, Text], ...], float]]
+            samples = []  # type: List[Tuple[Text, Tuple[Tuple[Text, Text], ...], float]]
+            for label_values, histogram in sorted(histograms.items()):
+                for suffix, upper_bound, value in histogram.samples():
+                    labels = tuple(zip(label_names, label_values))
+                    if upper_bound:
+                        labels += (("le", upper_bound),)
+                    samples.append((suffix, labels, value))
+            return samples
+
+        with self._lock:
+            add_metric(
+                "nojava_ipmi_kvm_sessions_active",
+                "gauge",
+                "Number of running kvm console sessions.",
+                [("", (("image", image),), count) for image, count in sorted(self._active_sessions.items())],
+            )
+            add_metric(
+                "nojava_ipmi_kvm_launch_duration_seconds",
+                "histogram",
+                "Time until a kvm console was ready to use.",
+                histogram_samples(("host",), self._launch_durations),
+            )
+            add_metric(
+                "nojava_ipmi_kvm_launch_phase_duration_seconds",
+                "histogram",
+                "Duration of the phases of kvm console launches per kvm host.",
+                histogram_samples(("host", "phase"), self._phase_durations),
+            )
+            add_metric(
+                "nojava_ipmi_kvm_launch_failures_total",
+                "counter",
+                "Number of failed kvm console launches.",
+                [
+                    ("", (("host", hostname), ("error", error)), count)
+                    for (hostname, error), count in sorted(self._launch_failures.items())
+                ],
+            )
+        add_metric(
+            "nojava_ipmi_kvm_container_cpu_ratio",
+            "gauge",
+            "Cpu usage of kvm console containers (1.0 is one fully used cpu).",
+            [
+                ("", (("container", name), ("image", containers[name][0])), container_stats[name][0])
+                for name in sorted(containers)
+                if name in container_stats
+            ],
+        )
+        add_metric(
+            "nojava_ipmi_kvm_container_memory_usage_bytes",
+            "gauge",
+            "Memory usage of kvm console containers.",
+            [
+                ("", (("container", name), ("image", containers[name][0])), container_stats[name][1])
+                for name in sorted(containers)
+                if name in container_stats
+            ],
+        )
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, filepath):
+        # type: (Text) -> None
+        # Writes the metrics atomically for the textfile collector of the Prometheus node exporter
+        directory = os.path.dirname(os.path.abspath(filepath))
+        file_descriptor, temp_filepath = tempfile.mkstemp(dir=directory, prefix=".nojava-ipmi-kvm-metrics-")
+        try:
+            with os.fdopen(file_descriptor, "w") as f:
+                f.write(self.render())
+            os.chmod(temp_filepath, 0o644)
+            os.rename(temp_filepath, filepath)
+        except BaseException:
+            os.remove(temp_filepath)
+            raise
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        # type: (Text, *Any) -> None
+        logger.debug(format, *args)
+
+    def do_GET(self):
+        # type: () -> None
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def start_metrics_server(port, address="127.0.0.1"):
+    # type: (int, Text) -> MetricsServer
+    # Serves the metrics on `http://<address>:<port>/metrics` from a background thread
+    server = MetricsServer((address, port), MetricsRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, name="nojava-ipmi-kvm-metrics")
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+metrics = MetricsRegistry()
+
+
+__all__ = ["MetricsRegistry", "metrics", "start_metrics_server"]
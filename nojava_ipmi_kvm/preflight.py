@@ -0,0 +1,132 @@
+import json
+import logging
+import os
+import tempfile
+import time
+
+try:
+    from typing import Any, Dict, Optional, Text, Tuple  # noqa: F401  # pylint: disable=unused-import
+except ImportError:
+    pass
+
+from .utils import get_cache_directory
+
+logger = logging.getLogger(__name__)
+
+PREFLIGHT_CACHE_FORMAT_VERSION = 1
+
+
+class PreflightCache:
+    # Remembers successful launch preflight checks (Docker availability, local Docker images, reachable BMCs) for a short
+    # time, so back-to-back launches can skip them. Entries are kept in memory and in a JSON file, so they are shared by
+    # consecutive command line calls and long running processes. The file is re-read when another process changed it.
+    # Expiry times are wall clock times since they must be valid across processes.
+    def __init__(self, filepath=None):
+        # type: (Optional[Text]) -> None
+        self._filepath = filepath
+        self._entries = {}  # type: Dict[Text, Tuple[float, Any]]
+        self._file_stamp = None  # type: Optional[Tuple[int, int]]
+
+    def get(self, key):
+        # type: (Text) -> Tuple[bool, Any]
+        # Returns if a fresh entry exists and its value
+        self._reload_if_changed()
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.time():
+            return False, None
+        return True, entry[1]
+
+    def is_fresh(self, key):
+        # type: (Text) -> bool
+        return self.get(key)[0]
+
+    def record(self, key, ttl, value=None):
+        # type: (Text, Optional[float], Any) -> None
+        # A `ttl` of `0` or `None` disables caching of this check
+        if not ttl:
+            return
+        self._reload_if_changed()
+        now = time.time()
+        self._entries = {key: entry for key, entry in self._entries.items() if entry[0] > now}
+        self._entries[key] = (now + ttl, value)
+        self._save()
+
+    def invalidate(self, key_prefix):
+        # type: (Text) -> None
+        # Removes all entries whose key starts with `key_prefix`
+        self._reload_if_changed()
+        invalidated_keys = [key for key in self._entries if key.startswith(key_prefix)]
+        if not invalidated_keys:
+            return
+        for key in invalidated_keys:
+            del self._entries[key]
+        self._save()
+
+    def _get_file_stamp(self):
+        # type: () -> Optional[Tuple[int, int]]
+        try:
+            stat_result = os.stat(self._filepath)
+        except OSError:
+            return None
+        return (stat_result.st_mtime_ns, stat_result.st_size)
+
+    def _reload_if_changed(self):
+        # type: () -> None
+        if self._filepath is None:
+            return
+        file_stamp = self._get_file_stamp()
+        if file_stamp == self._file_stamp:
+            return
+        self._file_stamp = file_stamp
+        self._entries = {}
+        if file_stamp is None:
+            return
+        try:
+            with open(self._filepath, "r", encoding="utf-8") as f:
+                cache_dict = json.load(f)
+            if cache_dict.get("format_version") == PREFLIGHT_CACHE_FORMAT_VERSION:
+                self._entries = {key: (expiry, value) for key, (expiry, value) in cache_dict["entries"].items()}
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.debug("Could not read the preflight cache '%s': %s", self._filepath, e)
+
+    def _save(self):
+        # type: () -> None
+        # The cache is only an optimization, so failures are not fatal
+        if self._filepath is None:
+            return
+        temp_filepath = None
+        try:
+            os.makedirs(os.path.dirname(self._filepath), exist_ok=True)
+            file_descriptor, temp_filepath = tempfile.mkstemp(
+                dir=os.path.dirname(self._filepath), prefix=".preflight-", suffix=".json"
+            )
+            with os.fdopen(file_descriptor, "w", encoding="utf-8") as f:
+                json.dump(
+                    {
+                        "format_version": PREFLIGHT_CACHE_FORMAT_VERSION,
+                        "entries": {key: list(entry) for key, entry in self._entries.items()},
+                    },
+                    f,
+                )
+            os.replace(temp_filepath, self._filepath)
+            temp_filepath = None
+            self._file_stamp = self._get_file_stamp()
+        except (OSError, TypeError, ValueError) as e:
+            logger.debug("Could not write the preflight cache '%s': %s", self._filepath, e)
+        finally:
+            if temp_filepath is not None and os.path.exists(temp_filepath):
+                os.remove(temp_filepath)
+
+
+_preflight_cache = None  # type: Optional[PreflightCache]
+
+
+def get_preflight_cache():
+    # type: () -> PreflightCache
+    global _preflight_cache
+    if _preflight_cache is None:
+        _preflight_cache = PreflightCache(os.path.join(get_cache_directory(), "preflight.json"))
+    return _preflight_cache
+
+
+__all__ = ["PreflightCache", "get_preflight_cache"]
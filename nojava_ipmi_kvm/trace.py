@@ -0,0 +1,171 @@
+import contextlib
+import json
+import time
+
+try:
+    from typing import (  # noqa: F401  # pylint: disable=unused-import
+        Any,
+        Callable,
+        Dict,
+        Iterator,
+        List,
+        Optional,
+        Text,
+        Tuple,
+    )
+except ImportError:
+    pass
+
+
+class TraceSpan:
+    def __init__(self, name, start_time, end_time, error=None):
+        # type: (Text, float, float, Optional[Text]) -> None
+        self._name = name
+        self._start_time = start_time
+        self._end_time = end_time
+        self._error = error
+
+    @property
+    def name(self):
+        # type: () -> Text
+        return self._name
+
+    @property
+    def start_time(self):
+        # type: () -> float
+        # Value of `time.monotonic()` when the phase started
+        return self._start_time
+
+    @property
+    def end_time(self):
+        # type: () -> float
+        return self._end_time
+
+    @property
+    def duration(self):
+        # type: () -> float
+        return self._end_time - self._start_time
+
+    @property
+    def error(self):
+        # type: () -> Optional[Text]
+        # Name of the exception class which aborted the phase
+        return self._error
+
+    def __repr__(self):
+        # type: () -> Text
+        return "TraceSpan({!r}, duration={:.3f})".format(self._name, self.duration)
+
+
+class LaunchTrace:
+    # Records the phases of a kvm console launch as spans with monotonic timestamps. `span_callback` is called with every
+    # finished `TraceSpan` (for example to report the progress of a launch).
+    def __init__(self, span_callback=None):
+        # type: (Optional[Callable[[TraceSpan], None]]) -> None
+        self._span_callback = span_callback
+        self._start_time = time.monotonic()
+        self._start_timestamp = time.time()
+        self._end_time = None  # type: Optional[float]
+        self._spans = []  # type: List[TraceSpan]
+        self._container_phases = []  # type: List[Tuple[Text, float]]
+        self._error = None  # type: Optional[Text]
+
+    @contextlib.contextmanager
+    def span(self, name):
+        # type: (Text) -> Iterator[None]
+        start_time = time.monotonic()
+        try:
+            yield
+        except BaseException as e:
+            self.add_span(TraceSpan(name, start_time, time.monotonic(), type(e).__name__))
+            raise
+        self.add_span(TraceSpan(name, start_time, time.monotonic()))
+
+    def add_span(self, span):
+        # type: (TraceSpan) -> None
+        self._spans.append(span)
+        if self._span_callback is not None:
+            self._span_callback(span)
+
+    def add_container_phases(self, container_phases):
+        # type: (List[Tuple[Text, float]]) -> None
+        self._container_phases.extend(container_phases)
+
+    def finish(self, error=None):
+        # type: (Optional[BaseException]) -> None
+        if self._end_time is not None:
+            return
+        self._end_time = time.monotonic()
+        if error is not None:
+            self._error = type(error).__name__
+
+    @property
+    def spans(self):
+        # type: () -> List[TraceSpan]
+        return list(self._spans)
+
+    @property
+    def container_phases(self):
+        # type: () -> List[Tuple[Text, float]]
+        # Durations of the setup steps within the Docker container (as reported by the container entrypoint)
+        return list(self._container_phases)
+
+    @property
+    def start_time(self):
+        # type: () -> float
+        return self._start_time
+
+    @property
+    def start_timestamp(self):
+        # type: () -> float
+        # Wall clock time of the launch start (seconds since the epoch)
+        return self._start_timestamp
+
+    @property
+    def duration(self):
+        # type: () -> Optional[float]
+        if self._end_time is None:
+            return None
+        return self._end_time - self._start_time
+
+    @property
+    def error(self):
+        # type: () -> Optional[Text]
+        return self._error
+
+    def __getitem__(self, name):
+        # type: (Text) -> TraceSpan
+        for span in self._spans:
+            if span.name == name:
+                return span
+        raise KeyError(name)
+
+    def as_dict(self):
+        # type: () -> Dict[Text, Any]
+        # Span start times are relative to the launch start
+        return {
+            "start_timestamp": round(self._start_timestamp, 3),
+            "duration": round(self.duration, 3) if self.duration is not None else None,
+            "error": self._error,
+            "spans": [
+                {
+                    "name": span.name,
+                    "start": round(span.start_time - self._start_time, 3),
+                    "duration": round(span.duration, 3),
+                    "error": span.error,
+                }
+                for span in self._spans
+            ],
+            "container_phases": [
+                {"name": phase, "duration": round(duration, 3)} for phase, duration in self._container_phases
+            ],
+        }
+
+    def to_json(self, **extra_fields):
+        # type: (**Any) -> Text
+        trace_dict = self.as_dict()
+        trace_dict.update(extra_fields)
+        return json.dumps(trace_dict, sort_keys=True)
+
+
+__all__ = ["LaunchTrace", "TraceSpan"]
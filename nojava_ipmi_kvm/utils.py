@@ -1,3 +1,4 @@
+import os
 from os import urandom
 
 import collections.abc
@@ -18,3 +19,7 @@ def generate_temp_password(length):
 
     chars = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
     return "".join(chars[c % len(chars)] for c in urandom(length))
+
+
+def get_cache_directory():
+    return os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "nojava-ipmi-kvm")
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import uuid
+
+try:
+    from typing import Any, List, Optional, Text  # noqa: F401  # pylint: disable=unused-import
+except ImportError:
+    pass
+
+from .utils import generate_temp_password
+
+logger = logging.getLogger(__name__)
+
+VIEWER_SECRET_LENGTH = 20
+
+
+class ViewerCommandError(Exception):
+    pass
+
+
+class ViewerNotSupportedError(Exception):
+    pass
+
+
+class SharedViewer:
+    # An additional viewer of a running kvm console. Viewers share the X server, the VNC server and the BMC session (Java)
+    # or the proxy and its BMC session (HTML5) of the console, but have their own credentials which can be revoked.
+    def __init__(self, viewer_id, url, view_only=False, authorization_key=None, authorization_value=None):
+        # type: (Text, Text, bool, Optional[Text], Optional[Text]) -> None
+        self._viewer_id = viewer_id
+        self._url = url
+        self._view_only = view_only
+        self._authorization_key = authorization_key
+        self._authorization_value = authorization_value
+
+    @property
+    def viewer_id(self):
+        # type: () -> Text
+        return self._viewer_id
+
+    @property
+    def url(self):
+        # type: () -> Text
+        return self._url
+
+    @property
+    def view_only(self):
+        # type: () -> bool
+        return self._view_only
+
+    @property
+    def authorization_key(self):
+        # type: () -> Optional[Text]
+        # HTML5 consoles only: the viewer must send this cookie (`None` if the console is not protected by a cookie)
+        return self._authorization_key
+
+    @property
+    def authorization_value(self):
+        # type: () -> Optional[Text]
+        return self._authorization_value
+
+
+async def run_viewer_command(container_name, args, secret=None):
+    # type: (Text, List[Text], Optional[Text]) -> None
+    # Runs `kvm-viewer` in the container, secrets are passed on stdin so they do not show up in process lists
+    from .kvm import add_sudo_if_configured
+
+    process = await asyncio.create_subprocess_exec(
+        *add_sudo_if_configured(["docker", "exec", "-i", container_name, "kvm-viewer"] + args),
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT
+    )
+    output, _ = await process.communicate("{}\n".format(secret or "").encode("utf-8"))
+    if process.returncode != 0:
+        output_lines = output.decode("utf-8", errors="replace").strip().splitlines()
+        raise ViewerCommandError(
+            "`kvm-viewer {}` failed in the container {}: {}".format(
+                args[0], container_name, output_lines[-1] if output_lines else process.returncode
+            )
+        )
+
+
+async def add_java_viewer(container_name, external_vnc_dns, web_port, session=None, view_only=False):
+    # type: (Text, Text, int, Optional[int], bool) -> SharedViewer
+    # `session` is the session number in a shared Java container
+    from .kvm import get_java_console_url
+
+    viewer_id = uuid.uuid4().hex[:12]
+    vnc_password = generate_temp_password(VIEWER_SECRET_LENGTH)
+    await run_viewer_command(
+        container_name,
+        ["add"]
+        + (["--view-only"] if view_only else [])
+        + [viewer_id]
+        + ([str(session)] if session is not None else []),
+        vnc_password,
+    )
+    return SharedViewer(viewer_id, get_java_console_url(external_vnc_dns, web_port, vnc_password, view_only), view_only)
+
+
+async def add_html5_viewer(container_name, url, authorization_key=None, view_only=False):
+    # type: (Text, Text, Optional[Text], bool) -> SharedViewer
+    if view_only:
+        raise ViewerNotSupportedError("View-only viewers are not supported for HTML5 consoles.")
+    viewer_id = uuid.uuid4().hex[:12]
+    if authorization_key is None:
+        # The proxy accepts every request, so the viewer only needs the url
+        return SharedViewer(viewer_id, url)
+    authorization_value = generate_temp_password(VIEWER_SECRET_LENGTH)
+    await run_viewer_command(container_name, ["add", viewer_id], authorization_value)
+    return SharedViewer(viewer_id, url, False, authorization_key, authorization_value)
+
+
+async def add_viewer(kvm_viewer, view_only=False):
+    # type: (Any, bool) -> SharedViewer
+    # Adds a viewer to a kvm console started by `start_kvm_container`. The cost of a viewer is one VNC (or proxy)
+    # connection instead of a new container, JVM and BMC session.
+    from .kvm import HTML5KvmViewer, JavaKvmViewer
+
+    if isinstance(kvm_viewer, JavaKvmViewer):
+        return await add_java_viewer(
+            kvm_viewer.container_name, kvm_viewer.external_vnc_dns, kvm_viewer.web_port, kvm_viewer.session, view_only
+        )
+    elif isinstance(kvm_viewer, HTML5KvmViewer):
+        return await add_html5_viewer(
+            kvm_viewer.container_name, kvm_viewer.url, kvm_viewer.authorization_key, view_only
+        )
+    raise ValueError("Invalid kvm viewer class")
+
+
+async def remove_viewer(container_name, viewer_id, session=None):
+    # type: (Text, Text, Optional[int]) -> None
+    # Revokes the credentials of a viewer; established connections are not closed
+    await run_viewer_command(container_name, ["remove", viewer_id] + ([str(session)] if session is not None else []))
+
+
+__all__ = [
+    "SharedViewer",
+    "ViewerCommandError",
+    "ViewerNotSupportedError",
+    "add_html5_viewer",
+    "add_java_viewer",
+    "add_viewer",
+    "remove_viewer",
+]
@@ -22,7 +22,7 @@ long_description = get_long_description_from_readme()
 setup(
     name="nojava-ipmi-kvm",
     version=version,
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "benchmarks.*"]),
     python_requires="~=3.5",
     install_requires=["requests", "yacl", "pyyaml"],
     extras_require={"GUI": ["PyQt5>=5.12", "PyQtWebEngine>=5.12"]},